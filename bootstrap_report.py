@@ -0,0 +1,155 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Reports where the bootstrap of a deployment spent its time.
+
+    python bootstrap_report.py --bucket my-deployment-bucket-xyz
+    python bootstrap_report.py timing/*.jsonl
+
+Reads the JSON lines timing logs the startup scripts upload to timing/ in the
+deployment bucket, prints the per-phase p50/p95 across nodes and the critical
+path, i.e. the chain of phases the last node to finish had to wait for,
+following barrier waits back to the node that signalled the barrier.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import math
+import subprocess
+
+# Waits shorter than this are not followed to the signalling node
+MIN_WAIT_SEC = 1.0
+
+
+def ParseRecords(lines):
+  """Returns the timing records of the latest boot of every instance."""
+  records = [json.loads(line) for line in lines if line.strip()]
+  latest_boot = {}
+  for record in records:
+    instance = record['instance']
+    latest_boot[instance] = max(latest_boot.get(instance, 0), record['boot'])
+  return [r for r in records if r['boot'] == latest_boot[r['instance']]]
+
+
+def ReadBucket(bucket):
+  """Returns the lines of all timing logs in the deployment bucket."""
+  output = subprocess.check_output(
+      ['gsutil', 'cat', 'gs://%s/timing/*.jsonl' % bucket])
+  return output.decode('utf-8').splitlines()
+
+
+def Percentile(values, percent):
+  """Returns the nearest-rank percentile of a non-empty list of values."""
+  ordered = sorted(values)
+  rank = int(math.ceil(percent / 100.0 * len(ordered)))
+  return ordered[max(rank, 1) - 1]
+
+
+def PhaseStats(records):
+  """Returns (phase, count, p50, p95, max) rows ordered by median start."""
+  durations = collections.defaultdict(list)
+  starts = collections.defaultdict(list)
+  for record in records:
+    if record['phase'].startswith('signal_'):
+      continue
+    durations[record['phase']].append(record['end'] - record['start'])
+    starts[record['phase']].append(record['start'])
+  rows = []
+  for phase in sorted(durations, key=lambda p: Percentile(starts[p], 50)):
+    values = durations[phase]
+    rows.append((phase, len(values), Percentile(values, 50),
+                 Percentile(values, 95), max(values)))
+  return rows
+
+
+def CriticalPath(records):
+  """Returns the critical path as (instance, phase, start, end) segments.
+
+  The walk starts at the end of the last node to finish and goes back
+  through its phases. A barrier wait is cut at the moment the barrier was
+  signalled and the walk continues on the signalling node from there.
+  """
+  phases = collections.defaultdict(list)
+  signals = collections.defaultdict(list)
+  finished = {}
+  for record in records:
+    if record['phase'] == 'bootstrap':
+      finished[record['instance']] = record['end']
+    elif record['phase'].startswith('signal_'):
+      signals[record['phase'][len('signal_'):]].append(
+          (record['end'], record['instance']))
+    else:
+      phases[record['instance']].append(record)
+  if not finished:
+    return []
+
+  instance = max(finished, key=finished.get)
+  time = finished[instance]
+  path = []
+  while True:
+    earlier = [p for p in phases[instance] if p['start'] < time]
+    if not earlier:
+      break
+    phase = max(earlier, key=lambda p: p['start'])
+    end = min(phase['end'], time)
+    if end < time:
+      path.append((instance, '(outside phases)', end, time))
+    signalled = None
+    if (phase['phase'].startswith('wait_') and
+        end - phase['start'] >= MIN_WAIT_SEC):
+      candidates = [s for s in signals[phase['phase'][len('wait_'):]]
+                    if phase['start'] <= s[0] <= end and s[1] != instance]
+      if candidates:
+        signalled = min(candidates)
+    if signalled:
+      path.append((instance, phase['phase'], signalled[0], end))
+      time, instance = signalled
+    else:
+      path.append((instance, phase['phase'], phase['start'], end))
+      time = phase['start']
+  path.reverse()
+  return path
+
+
+def PrintReport(records):
+  """Prints the per-phase statistics and the critical path."""
+  instances = set(r['instance'] for r in records)
+  print('%d nodes' % len(instances))
+  print()
+  print('%-24s %6s %9s %9s %9s' % ('phase', 'nodes', 'p50', 'p95', 'max'))
+  for phase, count, p50, p95, longest in PhaseStats(records):
+    print('%-24s %6d %8.1fs %8.1fs %8.1fs' % (phase, count, p50, p95, longest))
+
+  path = CriticalPath(records)
+  if not path:
+    return
+  print()
+  print('critical path, %.1fs' % (path[-1][3] - path[0][2]))
+  for instance, phase, start, end in path:
+    print('  %8.1fs %-32s %-24s %8.1fs' % (start - path[0][2], instance,
+                                           phase, end - start))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('logs', nargs='*',
+                      help='Timing logs downloaded from the deployment bucket')
+  parser.add_argument('--bucket',
+                      help='Deployment bucket to read the timing logs from')
+  args = parser.parse_args()
+  if bool(args.logs) == bool(args.bucket):
+    parser.error('give either timing logs or --bucket')
+  if args.bucket:
+    lines = ReadBucket(args.bucket)
+  else:
+    lines = []
+    for log in args.logs:
+      with open(log) as f:
+        lines.extend(f.readlines())
+  PrintReport(ParseRecords(lines))
+
+
+if __name__ == '__main__':
+  main()
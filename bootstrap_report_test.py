@@ -0,0 +1,89 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Tests of the bootstrap timing report."""
+
+import json
+import unittest
+
+import bootstrap_report
+
+
+def Record(instance, phase, start, end, boot=0, status='ok'):
+  """Returns a timing record as the startup scripts log it."""
+  return {'instance': instance, 'role': 'non-seed', 'boot': boot,
+          'phase': phase, 'start': start, 'end': end, 'status': status}
+
+
+# Seed 0 installs and signals seed_0 at 100. node-1 waits on seed_0 from 40
+# to 102 and finishes last at 160.
+RECORDS = [
+    Record('seed-0', 'install_java', 0, 60),
+    Record('seed-0', 'deploy_dse', 60, 100),
+    Record('seed-0', 'signal_seed_0', 100, 100),
+    Record('seed-0', 'bootstrap', 0, 110),
+    Record('node-1', 'install_java', 0, 40),
+    Record('node-1', 'wait_seed_0', 40, 102),
+    Record('node-1', 'deploy_dse', 102, 150),
+    Record('node-1', 'bootstrap', 0, 160),
+]
+
+
+class ParseRecordsTest(unittest.TestCase):
+
+  def testKeepsTheLatestBootOnly(self):
+    lines = [json.dumps(Record('node-1', 'deploy_dse', 0, 10, boot=1)),
+             '',
+             json.dumps(Record('node-1', 'deploy_dse', 0, 20, boot=2)),
+             json.dumps(Record('node-2', 'deploy_dse', 0, 30, boot=1))]
+    records = bootstrap_report.ParseRecords(lines)
+    self.assertEqual(sorted((r['instance'], r['end']) for r in records),
+                     [('node-1', 20), ('node-2', 30)])
+
+
+class PhaseStatsTest(unittest.TestCase):
+
+  def testPercentile(self):
+    self.assertEqual(bootstrap_report.Percentile([3, 1, 2, 4], 50), 2)
+    self.assertEqual(bootstrap_report.Percentile([3, 1, 2, 4], 95), 4)
+    self.assertEqual(bootstrap_report.Percentile([7], 0), 7)
+
+  def testRowsByMedianStartWithoutSignals(self):
+    rows = bootstrap_report.PhaseStats(RECORDS)
+    # bootstrap and install_java both start at 0
+    self.assertEqual(sorted(row[0] for row in rows[:2]),
+                     ['bootstrap', 'install_java'])
+    self.assertEqual([row[0] for row in rows[2:]],
+                     ['wait_seed_0', 'deploy_dse'])
+    self.assertIn(('install_java', 2, 40, 60, 60), rows)
+
+
+class CriticalPathTest(unittest.TestCase):
+
+  def testFollowsBarrierWaitToTheSignallingNode(self):
+    path = bootstrap_report.CriticalPath(RECORDS)
+    self.assertEqual(path, [
+        ('seed-0', 'install_java', 0, 60),
+        ('seed-0', 'deploy_dse', 60, 100),
+        ('node-1', 'wait_seed_0', 100, 102),
+        ('node-1', 'deploy_dse', 102, 150),
+        ('node-1', '(outside phases)', 150, 160),
+    ])
+
+  def testShortWaitsAreNotFollowed(self):
+    records = [
+        Record('seed-0', 'signal_seed_0', 10, 10),
+        Record('node-1', 'install_java', 0, 10),
+        Record('node-1', 'wait_seed_0', 10, 10.5),
+        Record('node-1', 'bootstrap', 0, 10.5),
+    ]
+    path = bootstrap_report.CriticalPath(records)
+    self.assertEqual([segment[0] for segment in path], ['node-1', 'node-1'])
+
+  def testUnfinishedDeployment(self):
+    self.assertEqual(
+        bootstrap_report.CriticalPath([Record('node-1', 'deploy_dse', 0, 5)]),
+        [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,86 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Generates the Packer definition of the prebaked DDAC node image.
+
+    python build_image.py --project my-project > ddac-image.json
+    packer build ddac-image.json
+
+The image is built from the same release naming as regional_igm.py and
+lands in the image family that imageMode: prebaked boots from, so nodes skip
+the apt-get, OpenJDK install and tarball download at boot.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+import regional_igm
+
+
+def BakeCommands(release):
+  """Returns the shell commands installing Java and the DDAC artifacts."""
+  prebaked_dir = regional_igm.PREBAKED_DIR
+  install_pkg = regional_igm.DdacInstallPkg(release)
+  return [
+      # The base image may still run its own apt jobs right after boot
+      'while ps -A | grep -e apt -e dpkg >/dev/null 2>&1; do sleep 10s; done',
+      'apt-get -y update',
+      'apt-get -y install openjdk-8-jdk',
+      'mkdir -p ' + prebaked_dir,
+      'cd ' + prebaked_dir,
+      'gsutil cp gs://' + regional_igm.DDAC_GCP_MP_BUCKET + '/' + install_pkg + ' .',
+      'tar -xzf ' + install_pkg,
+      'rm ' + install_pkg,
+      'mv ' + regional_igm.DdacRepoDir(release) + ' ' + regional_igm.DDAC_REPO,
+      'mv ' + regional_igm.DDAC_REPO + '/' + regional_igm.DDAC_TARBALL + ' .',
+      # Startup scripts only trust the image if it carries this release
+      'echo ' + regional_igm.PrebakedImageFamily(release) + ' > release',
+      'apt-get clean',
+  ]
+
+
+def GeneratePackerTemplate(project, zone, machine_type, release):
+  """Returns the Packer template building the prebaked image."""
+  family = regional_igm.PrebakedImageFamily(release)
+  return {
+      'builders': [{
+          'type': 'googlecompute',
+          'project_id': project,
+          'zone': zone,
+          'machine_type': machine_type,
+          'source_image_project_id': regional_igm.BASE_IMAGE_PROJECT,
+          'source_image': regional_igm.BASE_IMAGE,
+          'image_name': family + '-{{timestamp}}',
+          'image_family': family,
+          'image_description': 'DDAC %s with ddac-gcp-install %s' % (
+              regional_igm.DDAC_TARBALL, release),
+          'ssh_username': 'ubuntu',
+      }],
+      'provisioners': [{
+          'type': 'shell',
+          'execute_command': "sudo -E bash '{{.Path}}'",
+          'inline': ['set -e'] + BakeCommands(release),
+      }],
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--project', required=True,
+                      help='Project the image is built and stored in')
+  parser.add_argument('--zone', default='us-west1-a',
+                      help='Zone of the temporary build VM')
+  parser.add_argument('--machine-type', default='n1-standard-2',
+                      help='Machine type of the temporary build VM')
+  parser.add_argument('--release', default=regional_igm.RELEASE,
+                      help='ddac-gcp-install release baked in, matching '
+                      'the ddacRelease of the deployments booting the image')
+  args = parser.parse_args()
+  template = GeneratePackerTemplate(args.project, args.zone, args.machine_type,
+                                    args.release)
+  print(json.dumps(template, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+  main()
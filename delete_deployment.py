@@ -0,0 +1,86 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Empties the deployment bucket and deletes the deployment.
+
+    python delete_deployment.py --project my-project --deployment my-cluster \\
+        --keep ./my-cluster-logs
+
+Deployment Manager can't delete a bucket that still holds objects, and the
+deployment bucket keeps the timing logs, staged artifacts, join slots, node
+registry and benchmark results until its lifecycle rule expires them a day
+later. Deleting the deployment with gcloud alone therefore fails, and leaves
+behind a bucket whose name the next deployment of the same name needs.
+
+This copies the timing logs and benchmark results to --keep, a local
+directory or gs:// location, removes every object of the bucket and then
+deletes the deployment. bootstrap_report.py reads the kept logs with
+`python bootstrap_report.py <keep>/timing/*.jsonl`. A node still booting can
+write to the bucket after it was emptied, in which case the deletion fails
+and running this again finishes it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import subprocess
+
+import regional_igm
+
+# Prefixes of the deployment bucket worth keeping once the deployment is gone
+KEPT_PREFIXES = ['timing', 'benchmark']
+
+
+def Gsutil(args):
+  """Runs a gsutil command and returns its output lines."""
+  output = subprocess.check_output(['gsutil'] + args)
+  return output.decode('utf-8').splitlines()
+
+
+def BucketObjects(bucket):
+  """Returns the top level objects and prefixes of the bucket."""
+  try:
+    return Gsutil(['ls', 'gs://%s/' % bucket])
+  except subprocess.CalledProcessError:
+    # No bucket, e.g. after a partially deleted deployment
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--project', required=True)
+  parser.add_argument('--deployment', required=True)
+  parser.add_argument('--keep',
+                      help='Directory or gs:// location to copy the timing '
+                           'logs and benchmark results to')
+  parser.add_argument('--dry-run', action='store_true',
+                      help='Only list what would be copied and removed')
+  args = parser.parse_args()
+
+  bucket = regional_igm.DeploymentBucket(args.project, args.deployment)
+  objects = BucketObjects(bucket)
+  if objects is None:
+    print('gs://%s does not exist' % bucket)
+  elif objects:
+    if args.keep:
+      for prefix in KEPT_PREFIXES:
+        source = 'gs://%s/%s/' % (bucket, prefix)
+        if source not in objects:
+          continue
+        print('copying %s to %s' % (source, args.keep))
+        if not args.dry_run:
+          subprocess.check_call(['gsutil', '-m', '-q', 'cp', '-r',
+                                 source[:-1], args.keep])
+    print('emptying gs://%s' % bucket)
+    if not args.dry_run:
+      subprocess.check_call(['gsutil', '-m', '-q', 'rm', '-r', '-a',
+                             'gs://%s/**' % bucket])
+
+  print('deleting deployment %s' % args.deployment)
+  if not args.dry_run:
+    subprocess.check_call(['gcloud', 'deployment-manager', 'deployments',
+                           'delete', args.deployment, '--project',
+                           args.project, '--quiet'])
+
+
+if __name__ == '__main__':
+  main()
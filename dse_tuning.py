@@ -0,0 +1,160 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""DSE JVM and cassandra.yaml tuning derived from the GCE machine type."""
+
+import collections
+import re
+
+# Memory per vCPU of the predefined GCE machine types, in GB
+MEMORY_PER_VCPU_GB = {
+    'n1-standard': 3.75,
+    'n1-highmem': 6.5,
+    'n1-highcpu': 0.9,
+    'n1-megamem': 14.9333,
+    'n1-ultramem': 24.025,
+    'n2-standard': 4,
+    'n2-highmem': 8,
+    'n2-highcpu': 1,
+    'n2d-standard': 4,
+    'n2d-highmem': 8,
+    'n2d-highcpu': 1,
+    'n4-standard': 4,
+    'n4-highmem': 8,
+    'n4-highcpu': 2,
+    'e2-standard': 4,
+    'e2-highmem': 8,
+    'e2-highcpu': 1,
+    't2d-standard': 4,
+    't2a-standard': 4,
+    'c2-standard': 4,
+    'c2d-standard': 4,
+    'c2d-highmem': 8,
+    'c2d-highcpu': 2,
+    'c3-standard': 4,
+    'c3-highmem': 8,
+    'c3-highcpu': 2,
+    'c3d-standard': 4,
+    'c3d-highmem': 8,
+    'c3d-highcpu': 2,
+    'm1-megamem': 14.9333,
+    'm1-ultramem': 24.025,
+    'm2-megamem': 14.1538,
+    'm2-hypermem': 21.2308,
+    'm2-ultramem': 28.3077,
+    'm3-megamem': 15.25,
+    'm3-ultramem': 30.5,
+}
+
+# Above this much memory the nodes run G1 with a larger heap, below it the
+# stock CMS setup sized the way cassandra-env.sh would
+G1_MIN_MEMORY_MB = 32 * 1024
+# Largest heap that still gets compressed object pointers
+MAX_HEAP_MB = 31 * 1024
+
+# Profile keys that end up in cassandra.yaml, in rendering order
+YAML_KEYS = [
+    'concurrent_reads',
+    'concurrent_writes',
+    'concurrent_counter_writes',
+    'concurrent_compactors',
+    'compaction_throughput_mb_per_sec',
+    'memtable_flush_writers',
+    'memtable_allocation_type',
+    'memtable_heap_space_in_mb',
+    'memtable_offheap_space_in_mb',
+]
+
+
+def MachineShape(machine_type):
+  """Returns the (vcpus, memory_mb) of a predefined or custom machine type."""
+  custom = re.match(r'^(?:[a-z0-9]+-)?custom-(\d+)-(\d+)(?:-ext)?$',
+                    machine_type)
+  if custom:
+    return int(custom.group(1)), int(custom.group(2))
+  # c3 and c3d types with local SSDs attached carry an -lssd suffix
+  predefined = re.match(r'^([a-z0-9]+-[a-z]+)-(\d+)(?:-lssd)?$', machine_type)
+  if not predefined or predefined.group(1) not in MEMORY_PER_VCPU_GB:
+    raise ValueError('Unknown machine type %s, set vcpus and memory_mb in '
+                     'machineTuningOverrides' % machine_type)
+  vcpus = int(predefined.group(2))
+  return vcpus, int(vcpus * MEMORY_PER_VCPU_GB[predefined.group(1)] * 1024)
+
+
+def TuningProfile(machine_type, overrides=None):
+  """Returns the tuning profile of a DSE node on the given machine type.
+
+  Any key of overrides replaces the derived value. vcpus and memory_mb
+  override the machine shape the rest of the profile is derived from.
+  """
+  overrides = overrides or {}
+  if 'vcpus' in overrides and 'memory_mb' in overrides:
+    vcpus, memory_mb = overrides['vcpus'], overrides['memory_mb']
+  else:
+    vcpus, memory_mb = MachineShape(machine_type)
+
+  profile = {'vcpus': vcpus, 'memory_mb': memory_mb}
+  if memory_mb >= G1_MIN_MEMORY_MB:
+    heap_mb = max(min(memory_mb // 4, MAX_HEAP_MB), 8 * 1024)
+    profile.update({
+        'gc': 'G1',
+        'heap_mb': heap_mb,
+        # Memtables move off heap, leaving the heap to reads and compaction
+        'memtable_allocation_type': 'offheap_objects',
+        'memtable_heap_space_in_mb': heap_mb // 4,
+        'memtable_offheap_space_in_mb': heap_mb // 4,
+    })
+  else:
+    heap_mb = max(min(memory_mb // 2, 1024), min(memory_mb // 4, 8 * 1024))
+    profile.update({
+        'gc': 'CMS',
+        'heap_mb': heap_mb,
+        'new_gen_mb': min(100 * vcpus, heap_mb // 4),
+        'memtable_allocation_type': 'heap_buffers',
+        'memtable_heap_space_in_mb': heap_mb // 4,
+    })
+
+  # Thread pools sized for SSD backed nodes, growing with the core count
+  concurrent_compactors = min(8, max(2, vcpus // 4))
+  profile.update({
+      'concurrent_reads': min(128, max(32, 4 * vcpus)),
+      'concurrent_writes': min(256, max(32, 8 * vcpus)),
+      'concurrent_counter_writes': min(128, max(32, 4 * vcpus)),
+      'concurrent_compactors': concurrent_compactors,
+      'compaction_throughput_mb_per_sec': 16 * concurrent_compactors,
+      'memtable_flush_writers': min(8, max(2, vcpus // 8)),
+  })
+  profile.update(overrides)
+  return profile
+
+
+def JvmOptions(profile):
+  """Returns the jvm.options lines of a tuning profile.
+
+  They are appended to the stock jvm.options, where the last occurrence of
+  a flag wins, so the collector switch also turns the CMS flags off.
+  """
+  heap = '%dM' % profile['heap_mb']
+  options = ['-Xms' + heap, '-Xmx' + heap]
+  if profile['gc'] == 'G1':
+    options.extend([
+        '-XX:-UseParNewGC',
+        '-XX:-UseConcMarkSweepGC',
+        '-XX:+UseG1GC',
+        '-XX:G1RSetUpdatingPauseTimePercent=5',
+        '-XX:MaxGCPauseMillis=500',
+        '-XX:InitiatingHeapOccupancyPercent=70',
+    ])
+  else:
+    new_gen_mb = profile.get('new_gen_mb',
+                             min(100 * profile['vcpus'], profile['heap_mb'] // 4))
+    options.append('-Xmn%dM' % new_gen_mb)
+  return options
+
+
+def YamlOverrides(profile):
+  """Returns the cassandra.yaml overrides of a tuning profile."""
+  overrides = collections.OrderedDict()
+  for key in YAML_KEYS:
+    if key in profile:
+      overrides[key] = profile[key]
+  return overrides
@@ -0,0 +1,134 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Tests of the tuning profiles derived from GCE machine types."""
+
+import unittest
+
+import dse_tuning
+
+# Machine types the schema accepts (8 vCPUs and 16 GB at least) with their
+# GCE shape, (vcpus, memory_gb)
+MACHINE_SHAPES = {
+    'n1-standard-8': (8, 30),
+    'n1-highmem-16': (16, 104),
+    'n1-highcpu-32': (32, 28.8),
+    'n1-megamem-96': (96, 1433.6),
+    'n1-ultramem-40': (40, 961),
+    'n2-standard-8': (8, 32),
+    'n2-highmem-8': (8, 64),
+    'n2-highcpu-16': (16, 16),
+    'n2d-standard-8': (8, 32),
+    'n4-standard-8': (8, 32),
+    'n4-highcpu-8': (8, 16),
+    'e2-standard-8': (8, 32),
+    'e2-highmem-8': (8, 64),
+    't2d-standard-8': (8, 32),
+    't2a-standard-8': (8, 32),
+    'c2-standard-8': (8, 32),
+    'c2d-standard-8': (8, 32),
+    'c2d-highcpu-8': (8, 16),
+    'c3-standard-8': (8, 32),
+    'c3-standard-8-lssd': (8, 32),
+    'c3-highcpu-44': (44, 88),
+    'c3d-standard-8': (8, 32),
+    'm1-megamem-96': (96, 1433.6),
+    'm1-ultramem-40': (40, 961),
+    'm2-ultramem-208': (208, 5888),
+    'm2-megamem-416': (416, 5888),
+    'm2-hypermem-416': (416, 8832),
+    'm3-megamem-64': (64, 976),
+    'm3-ultramem-32': (32, 976),
+    'custom-8-32768': (8, 32),
+    'n2-custom-16-65536': (16, 64),
+    'e2-custom-8-16384': (8, 16),
+    'n1-custom-8-61440-ext': (8, 60),
+}
+
+
+class MachineShapeTest(unittest.TestCase):
+
+  def testKnownTypes(self):
+    for machine_type, (vcpus, memory_gb) in sorted(MACHINE_SHAPES.items()):
+      shape = dse_tuning.MachineShape(machine_type)
+      self.assertEqual(shape[0], vcpus, machine_type)
+      # The table rounds the memory per vCPU of the large families
+      self.assertAlmostEqual(shape[1] / 1024.0, memory_gb,
+                             delta=memory_gb * 0.001, msg=machine_type)
+
+  def testEveryFamilyOfTheTable(self):
+    for family, memory_gb in dse_tuning.MEMORY_PER_VCPU_GB.items():
+      vcpus, memory_mb = dse_tuning.MachineShape(family + '-8')
+      self.assertEqual(vcpus, 8)
+      self.assertEqual(memory_mb, int(8 * memory_gb * 1024))
+
+  def testUnknownTypes(self):
+    for machine_type in ['z9-standard-8', 'n1-standard', 'f1-micro']:
+      self.assertRaises(ValueError, dse_tuning.MachineShape, machine_type)
+
+
+class TuningProfileTest(unittest.TestCase):
+
+  def testEveryKnownTypeGetsAProfile(self):
+    for machine_type in sorted(MACHINE_SHAPES):
+      profile = dse_tuning.TuningProfile(machine_type)
+      self.assertIn(profile['gc'], ['G1', 'CMS'])
+      self.assertLessEqual(profile['heap_mb'], dse_tuning.MAX_HEAP_MB)
+      self.assertLess(profile['heap_mb'], profile['memory_mb'])
+      self.assertGreaterEqual(profile['concurrent_compactors'], 2)
+      self.assertLessEqual(profile['concurrent_compactors'], 8)
+      self.assertLessEqual(profile['concurrent_reads'], 128)
+      self.assertLessEqual(profile['concurrent_writes'], 256)
+
+  def testSmallMachineRunsCms(self):
+    profile = dse_tuning.TuningProfile('n1-standard-8')
+    self.assertEqual(profile['gc'], 'CMS')
+    self.assertEqual(profile['heap_mb'], 7680)
+    self.assertEqual(profile['new_gen_mb'], 800)
+    self.assertEqual(profile['memtable_allocation_type'], 'heap_buffers')
+    self.assertNotIn('memtable_offheap_space_in_mb', profile)
+
+  def testLargeMachineRunsG1WithCappedHeap(self):
+    profile = dse_tuning.TuningProfile('n1-highmem-32')
+    self.assertEqual(profile['gc'], 'G1')
+    self.assertEqual(profile['heap_mb'], dse_tuning.MAX_HEAP_MB)
+    self.assertEqual(profile['memtable_allocation_type'], 'offheap_objects')
+    self.assertEqual(profile['concurrent_compactors'], 8)
+
+  def testOverrides(self):
+    profile = dse_tuning.TuningProfile('n1-standard-8',
+                                       {'concurrent_writes': 96})
+    self.assertEqual(profile['concurrent_writes'], 96)
+    self.assertEqual(profile['concurrent_reads'], 32)
+
+  def testShapeOverridesDescribeUnknownTypes(self):
+    profile = dse_tuning.TuningProfile('z9-standard-8',
+                                       {'vcpus': 16, 'memory_mb': 65536})
+    self.assertEqual(profile['gc'], 'G1')
+    self.assertEqual(profile['heap_mb'], 16384)
+    self.assertEqual(profile['concurrent_reads'], 64)
+
+
+class RenderingTest(unittest.TestCase):
+
+  def testCmsOptions(self):
+    options = dse_tuning.JvmOptions(dse_tuning.TuningProfile('n1-standard-8'))
+    self.assertEqual(options, ['-Xms7680M', '-Xmx7680M', '-Xmn800M'])
+
+  def testG1OptionsTurnCmsOff(self):
+    options = dse_tuning.JvmOptions(dse_tuning.TuningProfile('n2-highmem-8'))
+    self.assertEqual(options[:2], ['-Xms16384M', '-Xmx16384M'])
+    self.assertIn('-XX:-UseConcMarkSweepGC', options)
+    self.assertIn('-XX:+UseG1GC', options)
+    self.assertFalse([o for o in options if o.startswith('-Xmn')])
+
+  def testYamlOverridesKeepTheirOrder(self):
+    for machine_type in sorted(MACHINE_SHAPES):
+      overrides = dse_tuning.YamlOverrides(
+          dse_tuning.TuningProfile(machine_type))
+      self.assertEqual(list(overrides),
+                       [k for k in dse_tuning.YAML_KEYS if k in overrides])
+      self.assertNotIn('heap_mb', overrides)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Shows which resources a deployment update would touch.
+
+    python plan.py --deployment my-cluster --project my-project \\
+        deployed.yaml updated.yaml
+
+Generates the resources of both Deployment Manager configs offline and lists
+the resources the update adds, deletes or changes, with the changed fields.
+Instance templates cannot be updated in place, so a changed template is
+recreated and its instance group rolls onto the new template.
+"""
+
+from __future__ import print_function
+
+import argparse
+
+import yaml
+
+import regional_igm
+import simulate
+
+# Resource types Deployment Manager replaces instead of patching
+IMMUTABLE_TYPES = ['compute.v1.instanceTemplate']
+
+
+def Resources(config, deployment, project):
+  """Returns {name: resource} of the regional_igm.py resources of a config."""
+  with open(config) as f:
+    template = [r for r in yaml.safe_load(f)['resources']
+                if r['type'] == 'regional_igm.py'][0]
+  context = simulate.FakeContext(dict(template['properties']), deployment,
+                                 project)
+  resources = yaml.safe_load(regional_igm.GenerateConfig(context))['resources']
+  return dict((r['name'], r) for r in resources)
+
+
+def ChangedPaths(old, new, path=''):
+  """Returns the paths of the fields that differ between old and new."""
+  if isinstance(old, dict) and isinstance(new, dict):
+    paths = []
+    for key in sorted(set(old) | set(new)):
+      paths.extend(ChangedPaths(old.get(key), new.get(key),
+                                '%s.%s' % (path, key) if path else key))
+    return paths
+  if (isinstance(old, list) and isinstance(new, list) and
+      len(old) == len(new)):
+    paths = []
+    for index, (old_item, new_item) in enumerate(zip(old, new)):
+      paths.extend(ChangedPaths(old_item, new_item,
+                                '%s[%d]' % (path, index)))
+    return paths
+  return [] if old == new else [path]
+
+
+def Plan(old, new):
+  """Returns (action, name, type, changed paths) rows of an update."""
+  rows = []
+  for name in sorted(set(old) | set(new)):
+    if name not in old:
+      rows.append(('add', name, new[name]['type'], []))
+    elif name not in new:
+      rows.append(('delete', name, old[name]['type'], []))
+    else:
+      paths = ChangedPaths(old[name], new[name])
+      if paths:
+        action = 'update'
+        if new[name]['type'] in IMMUTABLE_TYPES:
+          action = 'recreate'
+        rows.append((action, name, new[name]['type'], paths))
+  return rows
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('deployed', help='Config the deployment runs today')
+  parser.add_argument('updated', help='Config the deployment is updated to')
+  parser.add_argument('--deployment', required=True,
+                      help='Name of the deployment')
+  parser.add_argument('--project', required=True,
+                      help='Project of the deployment')
+  args = parser.parse_args()
+  rows = Plan(Resources(args.deployed, args.deployment, args.project),
+              Resources(args.updated, args.deployment, args.project))
+  if not rows:
+    print('no changes')
+  for action, name, resource_type, paths in rows:
+    print('%-8s %s (%s)' % (action, name, resource_type))
+    for path in paths:
+      print('           %s' % path)
+
+
+if __name__ == '__main__':
+  main()
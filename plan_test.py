@@ -0,0 +1,61 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Tests of the deployment update plan."""
+
+import unittest
+
+import plan
+import simulate
+
+
+class ChangedPathsTest(unittest.TestCase):
+
+  def testEqualValues(self):
+    self.assertEqual(plan.ChangedPaths({'a': [1, {'b': 2}]},
+                                       {'a': [1, {'b': 2}]}), [])
+
+  def testNestedChanges(self):
+    old = {'properties': {'targetSize': 3, 'zones': ['a', 'b'],
+                          'metadata': {'items': [{'value': 'x'}]}}}
+    new = {'properties': {'targetSize': 5, 'zones': ['a', 'c'],
+                          'metadata': {'items': [{'value': 'x'}]}}}
+    self.assertEqual(plan.ChangedPaths(old, new),
+                     ['properties.targetSize', 'properties.zones[1]'])
+
+  def testAddedAndRemovedKeys(self):
+    self.assertEqual(plan.ChangedPaths({'a': 1, 'b': 2}, {'b': 2, 'c': 3}),
+                     ['a', 'c'])
+
+  def testListsOfDifferentLengthChangeAsAWhole(self):
+    self.assertEqual(plan.ChangedPaths({'zones': ['a']},
+                                       {'zones': ['a', 'b']}), ['zones'])
+
+
+class PlanTest(unittest.TestCase):
+
+  def testUnchangedConfig(self):
+    self.assertEqual(plan.Plan(simulate.ExampleResources(),
+                               simulate.ExampleResources()), [])
+
+  def testResizeOnlyTouchesThePool(self):
+    rows = plan.Plan(simulate.ExampleResources(clusterSize=3),
+                     simulate.ExampleResources(clusterSize=6))
+    self.assertEqual([row[:2] for row in rows],
+                     [('update', 'sim-dse-non-seed-pool-igm')])
+    self.assertEqual(rows[0][3], ['properties.targetSize'])
+
+  def testTemplateChangesRecreate(self):
+    rows = plan.Plan(simulate.ExampleResources(),
+                     simulate.ExampleResources(osTuningProfile='latency'))
+    actions = dict((name, action) for action, name, _, _ in rows)
+    self.assertEqual(actions['sim-dse-non-seed-it'], 'recreate')
+
+  def testAddedResources(self):
+    rows = plan.Plan(simulate.ExampleResources(),
+                     simulate.ExampleResources(autohealing=True))
+    self.assertIn(('add', 'sim-dse-health-check', 'compute.v1.healthCheck',
+                   []), rows)
+
+
+if __name__ == '__main__':
+  unittest.main()
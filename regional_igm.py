@@ -1,173 +1,1005 @@
 # Copyright 2019 DataStax, Inc. All rights reserved.
 
+import base64
+import collections
+import hashlib
+import re
 import yaml
-import random
-import string
+
+import dse_tuning
 
 URL_BASE = 'https://www.googleapis.com/compute/v1/projects/'
 
-def GenerateConfig(context):
-  """Generates the configuration."""
+# Default release tag for ddac-gcp-install tarball in a GCP bucket
+RELEASE = 'master'
+# DDAC release tarball
+DDAC_TARBALL = 'ddac-5.1.12-bin.tar.gz'
+# DDAC GCP marketplace bucket
+DDAC_GCP_MP_BUCKET = 'ddac-gcp-marketplace'
+# ddac-gcp-install bucket item name
+DDAC_REPO = 'ddac-gcp-install'
+# Sliced downloads of the install package, so one node pulls it through
+# several streams
+SLICED_DOWNLOAD_OPTIONS = ('-o GSUtil:sliced_object_download_threshold=32M '
+                           '-o GSUtil:sliced_object_download_max_components=8')
 
-  config = {'resources': []}
+# Public DSE image every node boots from, and the prebaked images build on
+BASE_IMAGE_PROJECT = 'datastax-public'
+BASE_IMAGE = 'datastax-enterprise-ubuntu-1604-xenial-v20180824'
+# Where a prebaked image keeps Java-ready DDAC install artifacts
+PREBAKED_DIR = '/opt/ddac'
 
-  # Release tag for ddac-gcp-install tarball in a GCP bucket
-  release = 'master'
-  # DDAC release tarball
-  ddac_tarball = 'ddac-5.1.12-bin.tar.gz'
-  # DDAC GCP marketplace bucket
-  ddac_gcp_mp_bucket = 'ddac-gcp-marketplace'
-  # ddac-gcp-install bucket item name
-  ddac_repo = 'ddac-gcp-install'
-  # ddac-gcp-install release
-  ddac_repo_dir = ddac_repo + '-' + release
-  ddac_install_pkg = ddac_repo_dir + '.tar.gz'
-  ddac_install_pkg_uri = ddac_gcp_mp_bucket + '/' + ddac_install_pkg
 
-  deployment = context.env['deployment']
-  cluster_size = str(context.properties['clusterSize'])
-  # GCP Instance Templates
-  dse_seed_0_it = deployment + '-dse-seed-0-it'
-  dse_seed_1_it = deployment + '-dse-seed-1-it'
-  dse_non_seed_it = deployment + '-dse-non-seed-it'
-  dev_ops_it = deployment + '-dev-ops-it'
-  # GCP Instance Group Manager
-  dse_seed_0_igm = deployment + '-dse-seed-0-igm'
-  dse_seed_1_igm = deployment + '-dse-seed-1-igm'
-  dse_non_seed_pool_igm = deployment + '-dse-non-seed-pool-igm'
-  dev_ops_igm = deployment + '-dev-ops-igm'
 
-  # GCP subnet
-  region = context.properties['region']
-  # Hardcode DDAC subnet's CIDR to 10.8.0.0/16
-  cidr = '10.8.0.0/16'
-  dse_subnet = deployment + '-dse-subnet-' + region
-  ddac_network_name = context.properties['network']
-  ddac_network = URL_BASE + context.env['project'] + '/global/networks/' + ddac_network_name
-  
-  # DDAC firewall
-  ddac_fw = deployment + '-ddac-fw'  
+def DdacRepoDir(release):
+  """Returns the directory the ddac-gcp-install package of release unpacks to."""
+  return DDAC_REPO + '-' + release
 
-  # DSE seed 0 and seed 1 IP addresses based on user provided CIDR
-  # In GCP, auto IP address assignment for first and second IP addresses are .2 and .3
-  int_ip_octet = cidr.split(".")
-  int_ip_prefix = int_ip_octet[0] + "."  + int_ip_octet[1] + "." + int_ip_octet[2] 
-  dse_seed_0_ip_addr = int_ip_prefix + ".2"
-  dse_seed_1_ip_addr = int_ip_prefix + ".3"
-  seeds = dse_seed_0_ip_addr + ',' + dse_seed_1_ip_addr
 
-  # DSE cluster info
-  cluster_name = context.properties['clusterName']
-  cluster_size = str(context.properties['clusterSize'])
-  dc_name = context.properties['dcName']
+def DdacInstallPkg(release):
+  """Returns the object name of the ddac-gcp-install package of release."""
+  return DdacRepoDir(release) + '.tar.gz'
 
-  # Generate a random bucket name for each deployment
-  bucket_suffix = ''.join([random.choice(string.ascii_lowercase + string.digits) for n in xrange(10)])
-  deployment_bucket = context.env['deployment'] + '-deployment-bucket-' + bucket_suffix
 
-  # DSE seed node startup script
-  dse_seed_0_script = '''
-      #!/usr/bin/env bash
+def PrebakedImageFamily(release):
+  """Returns the image family of the prebaked images carrying release."""
+  return (DDAC_TARBALL.replace('-bin.tar.gz', '') + '-' +
+          release).replace('.', '-')
 
-      # Install Java
-      echo "Performing package OpenJDK install"
-      # check for lock
-      echo -e "Checking if apt/dpkg running, start: $(date +%r)"
-      while ps -A | grep -e apt -e dpkg >/dev/null 2>&1; do sleep 10s; done;
-      echo -e "No other procs: $(date +%r)"
-      apt-get -y update
-      apt-get -y install openjdk-8-jdk
 
-      pushd ~ubuntu
-      # Install and configure the dse seed 0
-      # Download ddac-gcp-install module
-      ddac_install_pkg_uri=''' + ddac_install_pkg_uri + '''
-      gsutil cp gs://$ddac_install_pkg_uri .
-      ddac_install_pkg=''' + ddac_install_pkg + '''
-      tar -xvf $ddac_install_pkg
-      ddac_repo_dir=''' +  ddac_repo_dir + '''
-      ddac_repo=''' + ddac_repo + '''
-      # Standardize repo name: ddac-gcp-install
-      mv $ddac_repo_dir $ddac_repo
-      ddac_tarball=''' +  ddac_tarball + '''
-      mv $ddac_repo/$ddac_tarball .
+# JSON lines timing log of the bootstrap phases on every node
+TIMING_LOG = '/var/log/bootstrap-timing.jsonl'
+# Metadata key of the bootstrap functions template holding the helpers
+BOOTSTRAP_FUNCTIONS_KEY = 'bootstrap-functions'
 
-      # Deploy DDAC
-      cluster_name=''' + cluster_name + '''
-      dc_name=''' + dc_name + '''
-      seeds=''' + seeds + '''
-      ./$ddac_repo/deploy-dse.sh $cluster_name $dc_name $seeds
+# DDAC install location laid down by deploy-dse.sh
+DSE_HOME = '/usr/share/dse'
 
-      # Send flag to start seed 1 install 
-      deployment_bucket=''' + deployment_bucket + '''
-      echo seed_0 > seed_0
-      gsutil cp ./seed_0 gs://$deployment_bucket/
-      popd
-      '''
+# DSE data directories live below this mount point when DDAC doesn't manage
+# the data disk itself, and belong to the user DSE runs as
+DSE_DATA_MOUNT = '/mnt/dse-data'
+DSE_COMMITLOG_MOUNT = '/mnt/dse-commitlog'
+DSE_USER = 'cassandra'
+DSE_MOUNT_OPTIONS = 'defaults,noatime,nodiratime,discard'
+# CQL native transport port, only open once a node has joined the ring
+DSE_NATIVE_PORT = 9042
+# Local JMX port nodetool and the metrics reporter read DSE from
+DSE_JMX_PORT = 7199
 
-  dse_seed_1_script = '''
+# Backups of a node go to <cluster>/<dc>/<node>/ in the backup bucket, with
+# a snapshot every day and the SSTables flushed since every 15 minutes by
+# default. A deployment restores from backups only while it is younger than
+# RESTORE_WINDOW_SEC, so a node autohealed later never takes over the token
+# ranges of a backup.
+BACKUP_SCHEDULE = '0 3 * * *'
+BACKUP_INCREMENTAL_MINUTES = 15
+RESTORE_WINDOW_SEC = 21600
 
-      # Install Java
-      echo "Performing package OpenJDK install"
-      # check for lock
-      echo -e "Checking if apt/dpkg running, start: $(date +%r)"
-      while ps -A | grep -e apt -e dpkg >/dev/null 2>&1; do sleep 10s; done;
-      echo -e "No other procs: $(date +%r)"
-      apt-get -y update
-      apt-get -y install openjdk-8-jdk
+# Subnet of the only datacenter when none are listed. Listed datacenters
+# default to 10.8.0.0/16, 10.9.0.0/16 and so on.
+DEFAULT_CIDR = '10.8.0.0/16'
+# Keys of a datacenters entry and the property each one overrides
+DATACENTER_PROPERTIES = {
+    'name': 'dcName',
+    'region': 'region',
+    'size': 'clusterSize',
+    'cidr': 'cidr',
+    'zones': 'zones',
+    'machineType': 'machineType',
+    'dataDiskType': 'dataDiskType',
+    'dataDiskSize': 'dataDiskSize',
+    'dataDiskKind': 'dataDiskKind',
+    'localSsdCount': 'localSsdCount',
+    'commitlogDiskType': 'commitlogDiskType',
+    'commitlogDiskSize': 'commitlogDiskSize',
+}
 
-      pushd ~ubuntu
-      deployment_bucket=''' + deployment_bucket + '''
-      gsutil cp gs://$deployment_bucket/seed_0 .
-      while [ $? -ne 0 ]
-      do
-          sleep 10s
-          gsutil cp gs://$deployment_bucket/seed_0 . 
-      done
+# Local SSD counts GCE accepts per machine family. Shared-core and E2
+# machines can't have local SSDs at all.
+LOCAL_SSD_COUNTS = {
+    'n1': [1, 2, 3, 4, 5, 6, 7, 8, 16, 24],
+    'n2': [1, 2, 4, 8, 16, 24],
+    'n2d': [1, 2, 4, 8, 16, 24],
+    'c2': [1, 2, 4, 8],
+}
 
-      # Install and configure the dse seed 1
-      # Download ddac-gcp-install module
-      ddac_install_pkg_uri=''' + ddac_install_pkg_uri + '''
-      gsutil cp gs://$ddac_install_pkg_uri .
-      ddac_install_pkg=''' + ddac_install_pkg + '''
-      tar -xvf $ddac_install_pkg
-      ddac_repo_dir=''' +  ddac_repo_dir + '''
-      ddac_repo=''' + ddac_repo + '''
-      # Standardize repo name: ddac-gcp-install
-      mv $ddac_repo_dir $ddac_repo
-      ddac_tarball=''' +  ddac_tarball + '''
-      mv $ddac_repo/$ddac_tarball .
+# Smallest vCPU count per machine family that gets Tier_1 egress bandwidth
+TIER_1_MIN_VCPUS = {
+    'n2': 32,
+    'n2d': 32,
+    'c2': 30,
+    'c2d': 32,
+    'c3': 44,
+    'm3': 32,
+}
 
-      # Deploy DDAC
-      cluster_name=''' + cluster_name + '''
-      dc_name=''' + dc_name + '''
-      seeds=''' + seeds + '''
-      ./$ddac_repo/deploy-dse.sh $cluster_name $dc_name $seeds
+# Machine families that accept a compact placement policy, and the most
+# VMs one compact policy can hold
+COMPACT_PLACEMENT_FAMILIES = ['n2', 'n2d', 'c2', 'c2d', 'c3', 'a2']
+COMPACT_PLACEMENT_MAX_VMS = 22
+# Range of availability domains of a spread placement policy
+SPREAD_PLACEMENT_DOMAINS = (2, 8)
 
-      # Send flag to start non-seed nodes install
-      echo seed_1 > seed_1
-      gsutil cp ./seed_1 gs://$deployment_bucket/
+# Partitions written before a read or mixed benchmark, which then reads them
+BENCHMARK_PARTITIONS = 1000000
 
-      # Wait until all DSE nodes are up and have joined the cluster:
-      cluster_size=''' + cluster_size + '''
-      size=`/usr/share/dse/bin/nodetool status | grep -o 'UN' | wc -l`
-      while [ $size -lt $cluster_size ]; do
-          echo The Current DSE cluster size is $size
-          echo Keep looping until the DSE cluster size reaches $cluster_size
+# Time a node of the non-seed pool takes to start DSE and join the ring,
+# with headroom for streaming contention. Sizes how long the deployment
+# waits for nodes taking turns through the join slots.
+JOIN_SEC = 450
+# Longest initial delay GCE accepts on an autohealing policy
+AUTOHEALING_MAX_DELAY_SEC = 3600
+
+# Kernel settings of the dse-recommended OS tuning profile
+OS_TUNING_SYSCTLS = [
+    ('vm.max_map_count', 1048575),
+    ('vm.swappiness', 1),
+    ('vm.zone_reclaim_mode', 0),
+    ('net.core.rmem_max', 16777216),
+    ('net.core.wmem_max', 16777216),
+    ('net.core.rmem_default', 16777216),
+    ('net.core.wmem_default', 16777216),
+    ('net.core.optmem_max', 40960),
+    ('net.core.somaxconn', 4096),
+    ('net.ipv4.tcp_rmem', '4096 87380 16777216'),
+    ('net.ipv4.tcp_wmem', '4096 65536 16777216'),
+    ('net.ipv4.tcp_keepalive_time', 60),
+    ('net.ipv4.tcp_keepalive_probes', 3),
+    ('net.ipv4.tcp_keepalive_intvl', 10),
+]
+# Settings the latency profile adds or changes on top of dse-recommended
+OS_TUNING_LATENCY_SYSCTLS = [
+    ('net.core.somaxconn', 8192),
+    ('net.core.netdev_max_backlog', 16384),
+    ('net.ipv4.tcp_max_syn_backlog', 8192),
+    ('net.ipv4.tcp_slow_start_after_idle', 0),
+    ('vm.dirty_background_ratio', 5),
+    ('vm.dirty_ratio', 10),
+    ('kernel.numa_balancing', 0),
+]
+
+# Cloud Monitoring metrics the non-seed pool autoscaler can scale on, with
+# their default per-node target
+DSE_METRIC_PREFIX = 'custom.googleapis.com/dse/'
+AUTOSCALER_METRICS = {
+    'pending_compactions': ('pending_compactions', 20),
+    'read_latency': ('read_latency_p99_ms', 10),
+}
+
+# Curated DSE metrics the reporter publishes, with the JMX reading of the
+# reporter returning their value. gcstat indexes the max, total, ... GC
+# elapsed ms since the previous run, as nodetool gcstats prints them.
+DSE_METRICS = collections.OrderedDict([
+    ('pending_compactions', "metric('type=Compaction,name=PendingTasks')"),
+    ('read_latency_p99_ms', "latency_p99('Read')"),
+    ('write_latency_p99_ms', "latency_p99('Write')"),
+    ('read_pending', "pool('request', 'ReadStage', 'PendingTasks')"),
+    ('mutation_pending', "pool('request', 'MutationStage', 'PendingTasks')"),
+    ('native_transport_blocked',
+     "pool('transport', 'Native-Transport-Requests', 'CurrentlyBlockedTasks')"),
+    ('dropped_mutations', "dropped('MUTATION')"),
+    ('dropped_reads', "dropped('READ')"),
+    ('gc_max_ms', 'gcstat(1)'),
+    ('gc_total_ms', 'gcstat(2)'),
+    ('heap_used_mb', 'heap_used()'),
+])
+# DSE_METRICS counting from the DSE start, published as their increase
+# since the previous run so a single drop doesn't alert forever
+DSE_COUNTER_METRICS = ['dropped_mutations', 'dropped_reads']
+
+# Alert policies of monitoring mode: metric, title, threshold and how long
+# the threshold has to be exceeded in seconds
+MONITORING_ALERTS = [
+    ('read_latency_p99_ms', 'Read latency p99 above 50 ms', 50, 300),
+    ('write_latency_p99_ms', 'Write latency p99 above 20 ms', 20, 300),
+    ('pending_compactions', 'Compaction backlog above 100', 100, 900),
+    ('dropped_mutations', 'Dropped mutations', 0, 300),
+    ('native_transport_blocked', 'Blocked native transport requests', 0, 300),
+    ('gc_max_ms', 'GC pauses above 1 s', 1000, 300),
+]
+
+# Shutdown script of the DSE nodes. Draining flushes the memtables and
+# leaves gossip before the VM stops, so the other replicas stop routing to
+# the node right away and it restarts without commitlog replay.
+DSE_SHUTDOWN_SCRIPT = '''#!/usr/bin/env bash
+if pgrep -f CassandraDaemon >/dev/null; then
+    echo "shutdown: draining DSE"
+    timeout 60 ''' + DSE_HOME + '''/bin/nodetool drain
+fi
+'''
+
+# Bash helpers shared by every startup script. Each stage below brackets its
+# work with phase_begin/phase_end so the serial console shows where the
+# bootstrap time goes.
+BOOTSTRAP_FUNCTIONS = '''
+      timing_record() {
+          # Append one JSON line to the timing log: phase, start, end, status
+          printf '{"instance": "%s", "role": "%s", "boot": %s, "phase": "%s", "start": %s, "end": %s, "status": "%s"}\\n' \\
+              $(hostname) $role $bootstrap_start $1 $2 $3 $4 >> $timing_log
+      }
+
+      phase_begin() {
+          phase_name=$1
+          phase_start=$(date +%s.%N | cut -c1-14)
+          echo "bootstrap: phase $phase_name started at $(date +%r)"
+      }
+
+      phase_end() {
+          phase_stop=$(date +%s.%N | cut -c1-14)
+          timing_record $phase_name $phase_start $phase_stop ${1:-ok}
+          echo "bootstrap: phase $phase_name took $(( ${phase_stop%.*} - ${phase_start%.*} ))s"
+          phase_name=
+      }
+
+      upload_timing() {
+          # Runs on exit, so a failed bootstrap still reports where it stopped
+          [ $? -eq 0 ] && exit_status=ok || exit_status=failed
+          [ -n "$phase_name" ] && phase_end failed
+          timing_record bootstrap $bootstrap_start $(date +%s.%N | cut -c1-14) $exit_status
+          release_health_check
+          gsutil -q cp $timing_log gs://$deployment_bucket/timing/$(hostname).jsonl
+      }
+
+      barrier_wait() {
+          # Block until the named barrier has been signalled by another node
+          if [ -n "$rejoin" ]; then
+              echo "bootstrap: rejoining, not waiting on barrier $1"
+              return 0
+          fi
+          echo "bootstrap: waiting on barrier $1 ($barrier_backend)"
+          case $barrier_backend in
+          runtimeconfig)
+              # The barrier variables are created as pending by the deployment,
+              # so a watch returns as soon as the signalling node updates one
+              while true; do
+                  since=$(date -u +%Y-%m-%dT%H:%M:%S.000000Z)
+                  value=$(gcloud beta runtime-config configs variables get-value barriers/$1 --config-name $runtime_config 2>/dev/null)
+                  [ "$value" = "ready" ] && break
+                  gcloud beta runtime-config configs variables watch barriers/$1 --config-name $runtime_config \
+                      --newer-than $since --max-wait 300 >/dev/null 2>&1 || sleep 1s
+              done
+              ;;
+          local)
+              # Offline fake: barriers are files in $barrier_dir
+              mkdir -p $barrier_dir
+              until [ -e $barrier_dir/$1 ]; do
+                  if which inotifywait >/dev/null 2>&1; then
+                      inotifywait -qq -t 60 -e create -e moved_to $barrier_dir
+                  else
+                      sleep 1s
+                  fi
+              done
+              ;;
+          *)
+              # Poll for the flag file in the deployment bucket
+              until gsutil -q cp gs://$deployment_bucket/$1 . ; do
+                  sleep 10s
+              done
+              ;;
+          esac
+      }
+
+      barrier_signal() {
+          echo "bootstrap: signalling barrier $1 ($barrier_backend)"
+          case $barrier_backend in
+          runtimeconfig)
+              gcloud beta runtime-config configs variables set barriers/$1 ready --is-text --config-name $runtime_config
+              # Record who signalled, which is also what the deployment waiter counts
+              gcloud beta runtime-config configs variables set signalled/$1/$(hostname) ready --is-text --config-name $runtime_config
+              ;;
+          local)
+              mkdir -p $barrier_dir
+              echo $(hostname) > $barrier_dir/.$1 && mv $barrier_dir/.$1 $barrier_dir/$1
+              ;;
+          *)
+              echo $1 > $1
+              gsutil cp ./$1 gs://$deployment_bucket/
+              ;;
+          esac
+          signalled_at=$(date +%s.%N | cut -c1-14)
+          timing_record signal_$1 $signalled_at $signalled_at ok
+      }
+
+      acquire_join_slot() {
+          # Slots are objects created with an if-generation-match:0
+          # precondition, so only $max_concurrent_joins nodes can hold one.
+          # Give up and join anyway once no slot changed hands for
+          # $join_slot_timeout seconds, so a node that died holding a slot
+          # cannot stall the pool while a long queue keeps waiting its turn.
+          join_slot=
+          [ -z "$rejoin" ] || return 0
+          hostname > join_slot
+          waited=0
+          slots_seen=
+          while true; do
+              for slot in $(seq 0 $(( max_concurrent_joins - 1 ))); do
+                  if gsutil -q -h x-goog-if-generation-match:0 cp ./join_slot gs://$deployment_bucket/join-slots/$slot 2>/dev/null; then
+                      join_slot=$slot
+                      echo "bootstrap: holding join slot $join_slot"
+                      return 0
+                  fi
+              done
+              slots_now=$(gsutil ls -a gs://$deployment_bucket/join-slots/ 2>/dev/null)
+              if [ "$slots_now" != "$slots_seen" ]; then
+                  slots_seen=$slots_now
+                  waited=0
+              fi
+              if [ $waited -ge $join_slot_timeout ]; then
+                  echo "bootstrap: join slots unchanged for ${waited}s, joining without one"
+                  join_slot=
+                  return 0
+              fi
+              sleep 10s
+              waited=$(( waited + 10 ))
+          done
+      }
+
+      hold_health_check() {
+          # Answer the autohealing health check on the CQL port while this
+          # node waits for a join slot, so a long queue doesn't get it
+          # recreated before DSE even started
+          python3 -c 'import socket; s = socket.socket(); s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1); s.bind(("", ''' + str(DSE_NATIVE_PORT) + ''')); s.listen(16); [s.accept()[0].close() for _ in iter(int, 1)]' &
+          health_check_holder=$!
+      }
+
+      release_health_check() {
+          if [ -n "$health_check_holder" ]; then
+              kill $health_check_holder
+              wait $health_check_holder 2>/dev/null
+              health_check_holder=
+          fi
+      }
+
+      release_join_slot() {
+          if [ -n "$join_slot" ]; then
+              gsutil -q rm gs://$deployment_bucket/join-slots/$join_slot
+          fi
+      }
+
+      wait_for_local_normal() {
+          # Wait until this node finished bootstrapping and owns its ranges
+          until $dse_home/bin/nodetool netstats 2>/dev/null | grep -q 'Mode: NORMAL'; do
+              sleep 10s
+          done
+      }
+
+      prepare_dse_dir() {
+          # DSE runs as $dse_user, which deploy-dse.sh may not have created yet
+          id -u $dse_user >/dev/null 2>&1 || useradd --system --no-create-home $dse_user
+          mkdir -p $1
+          chown -R $dse_user $1
+      }
+
+      format_and_mount() {
+          # Format the device unless it already holds a filesystem, then mount
+          # it by UUID so a renamed device still comes back after a reboot
+          if ! blkid $1 >/dev/null 2>&1; then
+              mkfs.ext4 -F -m 0 $1
+          fi
+          mkdir -p $2
+          uuid=$(blkid -s UUID -o value $1)
+          grep -qs " $2 " /etc/fstab || echo "UUID=$uuid $2 ext4 $dse_mount_options,nofail 0 2" >> /etc/fstab
+          grep -qs " $2 " /proc/mounts || mount $2
+      }
+
+      mount_dse_data() {
+          # Mount the DSE data device and prepare the directories on it. Data
+          # that already holds the system keyspace means this node comes back
+          # with its old identity and rejoins without bootstrapping.
+          format_and_mount $1 $dse_data_mount
+          for dir in data commitlog hints saved_caches cdc_raw; do
+              prepare_dse_dir $dse_data_mount/$dir
+          done
+          if [ -d $dse_data_mount/data/system ]; then
+              rejoin=1
+              echo "bootstrap: found existing data in $dse_data_mount, rejoining"
+          fi
+      }
+
+      detect_replacement() {
+          # A node recreated under the name of a registered node, but without
+          # its data, takes over the old token ranges instead of bootstrapping
+          [ -z "$rejoin" ] || return 0
+          replaced_ip=$(gsutil -q cat gs://$deployment_bucket/nodes/$(hostname) 2>/dev/null)
+          if [ -n "$replaced_ip" ]; then
+              echo "bootstrap: replacing $(hostname) at $replaced_ip"
+              echo "-Dcassandra.replace_address_first_boot=$replaced_ip" >> dse-jvm.options
+          fi
+      }
+
+      restore_node() {
+          # Take over a node backed up to $1, the datacenter directory of a
+          # backup: restore its snapshot $2, or its latest one, and start DSE
+          # with its tokens instead of bootstrapping. Every backed-up node is
+          # claimed by one node only, preferably one in the same rack. Nodes
+          # of a deployment older than $3 seconds bootstrap as usual.
+          rm -f dse-restore.yaml
+          [ -z "$rejoin" ] || return 0
+          created=$(gsutil ls -L -b gs://$deployment_bucket | awk '/Time created/ {sub(/^[^:]*:[ \t]*/, ""); print}')
+          if [ $(( $(date +%s) - $(date -d "$created" +%s) )) -gt $3 ]; then
+              echo "bootstrap: deployment older than $3s, not restoring"
+              return 0
+          fi
+          same_rack=
+          other_racks=
+          for node in $(gsutil ls $1/); do
+              node=${node%/}
+              if [ "$2" = latest ]; then
+                  manifest=$(gsutil ls "$node/snapshots/*/manifest" 2>/dev/null | sort | tail -1)
+              else
+                  manifest=$(gsutil ls $node/snapshots/$2/manifest 2>/dev/null)
+              fi
+              [ -n "$manifest" ] || continue
+              if [ "$(gsutil -q cat ${manifest%/manifest}/rack)" = "${rack:-rack1}" ]; then
+                  same_rack="$same_rack $manifest"
+              else
+                  other_racks="$other_racks $manifest"
+              fi
+          done
+          hostname > restore_claim
+          for manifest in $same_rack $other_racks; do
+              node=${manifest%/snapshots/*}
+              if gsutil -q -h x-goog-if-generation-match:0 cp ./restore_claim gs://$deployment_bucket/restore-claims/${node#gs://} 2>/dev/null; then
+                  case " $other_racks " in
+                  *" $manifest "*) echo "bootstrap: $node was in another rack, repair the restored cluster" ;;
+                  esac
+                  restore_snapshot $node ${manifest%/manifest}
+                  return 0
+              fi
+          done
+          echo "bootstrap: no backed-up node left in $1, bootstrapping"
+      }
+
+      restore_snapshot() {
+          # Download the files of snapshot $2 of the backed-up node $1 and of
+          # its incremental backups taken since, one directory at a time with
+          # parallel transfers, and pin the tokens of the node. The objects
+          # carry the md5 of the file after its name, which is dropped again.
+          tag=${2##*/}
+          echo "bootstrap: restoring $1 snapshot $tag"
+          gsutil -q cat $2/manifest > restore_files
+          for list in $(gsutil ls $1/incremental/ 2>/dev/null); do
+              if [[ ${list##*/} > $tag ]]; then
+                  gsutil -q cat $list >> restore_files
+              fi
+          done
+          for dir in $(sed 's|/[^/]*$||' restore_files | sort -u); do
+              mkdir -p $dse_data_mount/data/$dir
+              grep "^$dir/[^/]*$" restore_files | sort -u | sed "s|^|$1/data/|" \
+                  | gsutil -q -m $sliced_download_options cp -I $dse_data_mount/data/$dir/ || exit 1
+              for file in $dse_data_mount/data/$dir/*; do
+                  if [[ $file =~ ^(.*)\\.[0-9a-f]{32}$ ]]; then
+                      mv $file ${BASH_REMATCH[1]}
+                  fi
+              done
+          done
+          chown -R $dse_user $dse_data_mount/data
+          tokens=$(gsutil -q cat $2/tokens)
+          [ -n "$tokens" ] || exit 1
+          printf '%s\n' "initial_token: $tokens" "num_tokens: $(echo $tokens | tr , '\n' | wc -l)" \
+              'auto_bootstrap: false' > dse-restore.yaml
+      }
+
+      register_node() {
+          # Record the address this node serves under. The hourly refresh
+          # keeps the deployment bucket lifecycle rule from expiring it.
+          register="hostname -I | awk '{print \\$1}' | gsutil -q cp - gs://$deployment_bucket/nodes/\\$(hostname)"
+          sh -c "$register"
+          echo "$(( RANDOM % 60 )) * * * * root $register" > /etc/cron.d/dse-register
+      }
+
+      fetch_artifact() {
+          # Download an install artifact from the regional copy staged in the
+          # deployment bucket, or from its source bucket once that copy has
+          # expired, and check it against the md5 of the object
+          src=gs://$deployment_bucket/artifacts/$1
+          gsutil -q stat $src || src=gs://$ddac_source_bucket/$1
+          expected=$(gsutil stat $src | awk '/Hash \\(md5\\)/ {print $3}')
+          for attempt in 1 2 3; do
+              gsutil -q $sliced_download_options cp $src .
+              actual=$(openssl md5 -binary $1 | base64)
+              if [ -z "$expected" ] || [ "$actual" = "$expected" ]; then
+                  echo "bootstrap: fetched $1 ($(stat -c %s $1) bytes) from $src"
+                  return 0
+              fi
+              echo "bootstrap: checksum mismatch on $1, $actual != $expected"
+          done
+          exit 1
+      }
+
+      apply_dse_overrides() {
+          # Layer the generated jvm.options and cassandra.yaml overrides onto
+          # the conf shipped in the DDAC tarball, so deploy-dse.sh lays down a
+          # conf that already carries them when DSE first starts.
+          if [ -s dse-restore.yaml ]; then
+              cat dse-restore.yaml >> dse-cassandra.yaml
+          fi
+          [ -s dse-jvm.options ] || [ -s dse-cassandra.yaml ] || [ -s dse-rackdc.properties ] || return 0
+          work=$(mktemp -d)
+          tar -xzf $ddac_tarball -C $work
+          conf=$(dirname $(find $work -path '*conf/cassandra.yaml' | head -1))
+          if [ -s dse-jvm.options ]; then
+              cat dse-jvm.options >> $conf/jvm.options
+          fi
+          if [ -s dse-cassandra.yaml ]; then
+              for key in $(grep -o '^[a-z_]*:' dse-cassandra.yaml); do
+                  # Drop the existing top level key together with its nested lines
+                  awk -v k="$key" 'skip && /^[ \\t-]/ {next} {skip=0} index($0, k) == 1 {skip=1; next} {print}' \\
+                      $conf/cassandra.yaml > $conf/cassandra.yaml.new
+                  mv $conf/cassandra.yaml.new $conf/cassandra.yaml
+              done
+              cat dse-cassandra.yaml >> $conf/cassandra.yaml
+          fi
+          if [ -s dse-rackdc.properties ]; then
+              cp dse-rackdc.properties $conf/cassandra-rackdc.properties
+          fi
+          tar -czf $ddac_tarball -C $work $(ls $work)
+          rm -rf $work
+      }
+
+      run_stage() {
+          # Run a stage kept in the helpers. A node booting the script of an
+          # older template after the helpers were updated finds the stage
+          # gone, and stops rather than skip it.
+          if ! declare -F $1 >/dev/null; then
+              echo "bootstrap: stage $1 is not in the helpers of this deployment"
+              exit 1
+          fi
+          $1
+      }
+'''
+
+
+def BootDisk(source_image):
+  """Returns the boot disk of an instance template."""
+  return {
+      'deviceName': 'boot-disk',
+      'type': 'PERSISTENT',
+      'boot': True,
+      'autoDelete': True,
+      'initializeParams': {
+          'sourceImage': source_image
+      }
+  }
+
+
+def PersistentDisk(device_name, disk_type, disk_size):
+  """Returns a persistent data disk of an instance template."""
+  return {
+      'deviceName': device_name,
+      'type': 'PERSISTENT',
+      'boot': False,
+      'autoDelete': True,
+      'initializeParams': {
+          'diskType': disk_type,
+          'diskSizeGb': disk_size
+      }
+  }
+
+
+def LocalSsdDisks(count):
+  """Returns the NVMe local SSDs of an instance template."""
+  return [{
+      'type': 'SCRATCH',
+      'interface': 'NVME',
+      'autoDelete': True,
+      'initializeParams': {
+          'diskType': 'local-ssd'
+      }
+  } for _ in range(count)]
+
+
+def DseDataDisks(properties):
+  """Returns the data disks of a DSE node for the configured disk layout."""
+  if properties.get('dataDiskKind', 'persistent') == 'local-ssd':
+    disks = LocalSsdDisks(properties.get('localSsdCount', 1))
+  else:
+    disks = [PersistentDisk('vm-data-disk', properties['dataDiskType'],
+                            properties['dataDiskSize'])]
+  if 'commitlogDiskType' in properties:
+    disks.append(PersistentDisk('vm-commitlog-disk',
+                                properties['commitlogDiskType'],
+                                properties.get('commitlogDiskSize', 50)))
+  return disks
+
+
+def ValidateLocalSsd(machine_type, count):
+  """Raises ValueError if GCE can't attach count local SSDs to machine_type."""
+  family = machine_type.split('-')[0]
+  if family == 'custom':
+    family = 'n1'
+  if family not in LOCAL_SSD_COUNTS:
+    raise ValueError('Local SSDs are not supported on %s' % machine_type)
+  if count not in LOCAL_SSD_COUNTS[family]:
+    raise ValueError('%s supports %s local SSDs, not %d' % (
+        machine_type, ', '.join(map(str, LOCAL_SSD_COUNTS[family])), count))
+
+
+def MachineVcpus(machine_type):
+  """Returns the vCPU count a predefined or custom machine type is named with."""
+  match = re.match(r'^(?:[a-z0-9]+-)?custom-(\d+)-\d+(?:-ext)?$', machine_type)
+  if not match:
+    match = re.match(r'^[a-z0-9]+-[a-z]+-(\d+)(?:-lssd)?$', machine_type)
+  if not match:
+    raise ValueError('Can not tell the vCPUs of machine type %s' %
+                     machine_type)
+  return int(match.group(1))
+
+
+def ValidateNetworking(machine_type, nic_type, tier_1):
+  """Raises ValueError if machine_type can't get the requested networking."""
+  if not tier_1:
+    return
+  family = machine_type.split('-')[0]
+  if nic_type != 'GVNIC':
+    raise ValueError('Tier_1 networking needs nicType GVNIC')
+  if family not in TIER_1_MIN_VCPUS:
+    raise ValueError('Tier_1 networking is not supported on %s' % machine_type)
+  vcpus = MachineVcpus(machine_type)
+  if vcpus < TIER_1_MIN_VCPUS[family]:
+    raise ValueError('Tier_1 networking needs at least %d vCPUs on %s, not %d'
+                     % (TIER_1_MIN_VCPUS[family], family, vcpus))
+
+
+def ValidatePlacement(placement, machine_type, zones, max_nodes, domains):
+  """Raises ValueError if GCE won't place max_nodes nodes as requested."""
+  if placement == 'compact':
+    family = machine_type.split('-')[0]
+    if family not in COMPACT_PLACEMENT_FAMILIES:
+      raise ValueError('Compact placement is not supported on %s' %
+                       machine_type)
+    if len(zones) != 1:
+      raise ValueError('Compact placement needs exactly one zone in zones')
+    if max_nodes > COMPACT_PLACEMENT_MAX_VMS:
+      raise ValueError('Compact placement holds at most %d nodes, not %d' %
+                       (COMPACT_PLACEMENT_MAX_VMS, max_nodes))
+  elif placement == 'spread':
+    low, high = SPREAD_PLACEMENT_DOMAINS
+    if not low <= domains <= high:
+      raise ValueError('Spread placement needs %d to %d availability '
+                       'domains, not %d' % (low, high, domains))
+
+
+def PlacementPolicy(name, region, placement, domains):
+  """Returns the placement resource policy of the DSE nodes."""
+  if placement == 'compact':
+    group_placement = {'collocation': 'COLLOCATED'}
+  else:
+    group_placement = {'availabilityDomainCount': domains}
+  return {
+      'name': name,
+      'type': 'compute.v1.resourcePolicy',
+      'properties': {
+          'name': name,
+          'region': region,
+          'description': '%s placement of the DSE nodes' % placement,
+          'groupPlacementPolicy': group_placement
+      }
+  }
+
+
+def NetworkInterface(network, subnetwork, nic_type, external_ip):
+  """Returns the network interface of an instance template."""
+  interface = {
+      'network': network,
+      'subnetwork': subnetwork
+  }
+  # Left out for the default, so existing templates stay unchanged
+  if nic_type != 'VIRTIO_NET':
+    interface['nicType'] = nic_type
+  if external_ip:
+    interface['accessConfigs'] = [{
+        'name': 'External NAT',
+        'type': 'ONE_TO_ONE_NAT'
+    }]
+  return interface
+
+
+def DistributionPolicy(project, zones):
+  """Returns the distribution policy spreading a regional IGM over zones."""
+  return {
+      'zones': [{'zone': URL_BASE + project + '/zones/' + zone}
+                for zone in zones]
+  }
+
+
+def StatefulPolicy(device_names):
+  """Returns the stateful policy preserving the data disks and internal IP."""
+  return {
+      'preservedState': {
+          'disks': dict((device_name, {'autoDelete': 'NEVER'})
+                        for device_name in device_names),
+          'internalIPs': {
+              'nic0': {'autoDelete': 'NEVER'}
+          }
+      }
+  }
+
+
+def UpdatePolicy(minimal_action, zone_count):
+  """Returns the update policy of an instance group of DSE nodes.
+
+  Template changes are only picked up by instances that get recreated, and
+  rolling_update.py recreates them a zone, i.e. a rack, at a time. Instances
+  keep their names and disks and are never moved between zones. A regional
+  group needs maxUnavailable to be 0 or at least its zone count.
+  """
+  return {
+      'type': 'OPPORTUNISTIC',
+      'minimalAction': minimal_action,
+      'replacementMethod': 'RECREATE',
+      'instanceRedistributionType': 'NONE',
+      'maxSurge': {'fixed': 0},
+      'maxUnavailable': {'fixed': zone_count}
+  }
+
+
+def InstanceTemplate(name, machine_type, network_interface, disks, scopes,
+                     subnet, startup_script):
+  """Returns an instance template booting into the startup script."""
+  return {
+      # Create the Instance Template
+      'name': name,
+      'type': 'compute.v1.instanceTemplate',
+      'properties': {
+          'properties': {
+              'machineType': machine_type,
+              'networkInterfaces': [network_interface],
+              'disks': disks,
+              'serviceAccounts': [{
+                  'email': 'default',
+                  'scopes': list(scopes)
+              }],
+              'metadata': {
+                  'dependsOn': [
+                      subnet,
+                  ],
+                  'items': [{
+                      'key': 'startup-script',
+                      'value': startup_script
+                  }]
+              }
+          }
+      }
+  }
+
+
+def InstanceGroupManager(name, region, base_instance_name, template,
+                         target_size, update_policy, depends_on=None):
+  """Returns a regional instance group of VMs of the instance template."""
+  igm = {
+      # Instance Group Manager
+      'name': name,
+      'type': 'compute.v1.regionInstanceGroupManager',
+      'properties': {
+          'region': region,
+          'baseInstanceName': base_instance_name,
+          'instanceTemplate': '$(ref.%s.selfLink)' % template,
+          'targetSize': target_size,
+          'updatePolicy': update_policy
+      }
+  }
+  if depends_on:
+    igm['metadata'] = {'dependsOn': list(depends_on)}
+  return igm
+
+
+def DeploymentBucket(project, deployment):
+  """Returns the deployment bucket name.
+
+  Bucket names are global, so the bucket gets a suffix hashed from the
+  project and deployment. It stays the same across updates, which keeps the
+  startup scripts and instance templates unchanged.
+  """
+  suffix = hashlib.sha1(
+      (project + '/' + deployment).encode('utf-8')).hexdigest()[:10]
+  return deployment + '-deployment-bucket-' + suffix
+
+
+def CidrRange(cidr):
+  """Returns the first and last address of an IPv4 CIDR range as integers."""
+  match = re.match(r'^(\d+)\.(\d+)\.(\d+)\.(\d+)/(\d+)$', cidr)
+  if not match or int(match.group(5)) > 29:
+    raise ValueError('Invalid subnet range %s, expected e.g. %s' %
+                     (cidr, DEFAULT_CIDR))
+  start = 0
+  for octet in match.groups()[:4]:
+    start = start * 256 + int(octet)
+  size = 2 ** (32 - int(match.group(5)))
+  start -= start % size
+  return start, start + size - 1
+
+
+def CidrHost(cidr, host):
+  """Returns the address of the given host number of a CIDR range."""
+  address = CidrRange(cidr)[0] + host
+  return '.'.join(str(address >> shift & 255) for shift in (24, 16, 8, 0))
+
+
+def DatacenterSlug(dc_name):
+  """Returns the form of a datacenter name used in resource names."""
+  return re.sub(r'[^a-z0-9]+', '-', dc_name.lower()).strip('-')
+
+
+def Datacenters(properties):
+  """Returns the properties of each DSE datacenter of the deployment.
+
+  Without datacenters the top-level properties describe the only one.
+  Otherwise every entry overrides the top-level properties for its
+  datacenter, except that zones are not carried over to another region.
+  """
+  entries = properties.get('datacenters')
+  if not entries:
+    datacenter = dict(properties)
+    datacenter.setdefault('cidr', DEFAULT_CIDR)
+    return [datacenter]
+
+  datacenters = []
+  for index, entry in enumerate(entries):
+    unknown = sorted(set(entry) - set(DATACENTER_PROPERTIES))
+    if unknown:
+      raise ValueError('Unknown datacenter properties %s' % ', '.join(unknown))
+    if not re.match(r'^[A-Za-z0-9_-]+$', entry.get('name', '')):
+      raise ValueError('Datacenter %d needs a name of letters, digits, _ '
+                       'and -' % index)
+    datacenter = dict(properties)
+    del datacenter['datacenters']
+    datacenter['cidr'] = '10.%d.0.0/16' % (8 + index)
+    if entry.get('region', properties['region']) != properties['region']:
+      datacenter.pop('zones', None)
+    for key, value in entry.items():
+      datacenter[DATACENTER_PROPERTIES[key]] = value
+    datacenters.append(datacenter)
+
+  for index, datacenter in enumerate(datacenters):
+    start, end = CidrRange(datacenter['cidr'])
+    for other in datacenters[:index]:
+      if DatacenterSlug(other['dcName']) == DatacenterSlug(datacenter['dcName']):
+        raise ValueError('Datacenters %s and %s share their resource names' %
+                         (other['dcName'], datacenter['dcName']))
+      other_start, other_end = CidrRange(other['cidr'])
+      if start <= other_end and other_start <= end:
+        raise ValueError('Subnets %s of %s and %s of %s overlap' %
+                         (other['cidr'], other['dcName'], datacenter['cidr'],
+                          datacenter['dcName']))
+  return datacenters
+
+
+def ShellQuote(value):
+  """Quotes a value for use as a single bash word."""
+  return "'" + str(value).replace("'", "'\\''") + "'"
+
+
+def YamlLines(overrides):
+  """Renders cassandra.yaml overrides, lists as block sequences."""
+  lines = []
+  for key, value in overrides.items():
+    if isinstance(value, list):
+      lines.append(key + ':')
+      lines.extend(['    - ' + str(item) for item in value])
+    else:
+      lines.append(key + ': ' + str(value))
+  return lines
+
+
+def WriteFileStage(path, lines):
+  """Returns a script line writing the given lines to a file on the node."""
+  if not lines:
+    return '''
+      : > ''' + path + '''
+'''
+  return '''
+      printf '%s\\n' ''' + ' '.join([ShellQuote(line) for line in lines]) + ''' > ''' + path + '''
+'''
+
+
+def InstallFileStage(path, content, mode='0644'):
+  """Returns a script line installing a file with the given content."""
+  encoded = base64.b64encode(content.encode('utf-8')).decode('ascii')
+  return '''
+      echo ''' + encoded + ''' | base64 -d > ''' + path + '''
+      chmod ''' + mode + ' ' + path + '''
+'''
+
+
+def SharedStage(stages, stage, kind=None):
+  """Returns the script line running a stage kept in the bootstrap helpers.
+
+  stages maps the names of the stage functions to their bodies. A stage is
+  named after its kind, by default its first phase, and a hash of its body,
+  so the roles and datacenters running the same stage share one function,
+  and a changed stage changes the scripts calling it.
+  """
+  if not stage:
+    return stage
+  if not kind:
+    kind = re.search(r'phase_begin (\w+)', stage).group(1)
+  name = 'stage_%s_%s' % (kind, hashlib.sha1(
+      stage.encode('utf-8')).hexdigest()[:8])
+  stages[name] = stage
+  return '''
+      run_stage ''' + name + '''
+'''
+
+
+def StageFunctions(stages):
+  """Returns the bash functions of the stages SharedStage collected."""
+  return ''.join('''
+      ''' + name + '''() {''' + body + '''      }
+''' for name, body in stages.items())
+
+
+def BootstrapFunctionsTemplate(name, machine_type, network_interface,
+                               source_image, subnet, stages):
+  """Returns the instance template holding BOOTSTRAP_FUNCTIONS and the stages.
+
+  No VM is created from it. The startup scripts of all roles load the
+  helpers and stages from its metadata, so they are kept once per
+  deployment rather than once per instance template, and the scripts
+  themselves only wait for and signal the barriers between the stages.
+  """
+  template = InstanceTemplate(name, machine_type, network_interface,
+                              [BootDisk(source_image)], [], subnet, '')
+  template['properties']['properties']['metadata']['items'] = [{
+      'key': BOOTSTRAP_FUNCTIONS_KEY,
+      'value': BOOTSTRAP_FUNCTIONS + StageFunctions(stages)
+  }]
+  return template
+
+
+def ScriptHeader(role, functions_template, deployment_bucket, barrier_backend,
+                 runtime_config, max_concurrent_joins):
+  """Returns the shebang, shared helpers and variables of a startup script.
+
+  The helpers are loaded from the metadata of the functions template. Every
+  phase of the script is logged as a JSON line to the timing log, which is
+  uploaded to timing/ in the deployment bucket on exit.
+  """
+  return '''#!/usr/bin/env bash
+      # BOOTSTRAP_FUNCTIONS_FILE runs the helpers from a local copy offline
+      bootstrap_functions=${BOOTSTRAP_FUNCTIONS_FILE:-/var/tmp/bootstrap-functions.sh}
+      until [ -n "$BOOTSTRAP_FUNCTIONS_FILE" ] || gcloud compute instance-templates describe ''' + functions_template + ''' --format json \\
+          | python3 -c 'import json, sys; print([i["value"] for i in json.load(sys.stdin)["properties"]["metadata"]["items"] if i["key"] == "''' + BOOTSTRAP_FUNCTIONS_KEY + '''"][0])' > $bootstrap_functions; do
+          echo "bootstrap: waiting for the helpers of ''' + functions_template + '''"
           sleep 10s
-          size=`/usr/share/dse/bin/nodetool status | grep -o 'UN' | wc -l`
       done
+      source $bootstrap_functions
+      bootstrap_start=$(date +%s)
+      role=''' + role + '''
+      timing_log=''' + TIMING_LOG + '''
+      phase_name=
+      dse_home=''' + DSE_HOME + '''
+      deployment_bucket=''' + deployment_bucket + '''
+      # BARRIER_BACKEND=local and BARRIER_DIR run the barriers offline
+      barrier_backend=${BARRIER_BACKEND:-''' + barrier_backend + '''}
+      barrier_dir=${BARRIER_DIR:-/var/tmp/bootstrap-barriers}
+      runtime_config=''' + runtime_config + '''
+      dse_user=''' + DSE_USER + '''
+      dse_mount_options=''' + DSE_MOUNT_OPTIONS + '''
+      dse_data_mount=''' + DSE_DATA_MOUNT + '''
+      rejoin=
+      max_concurrent_joins=''' + str(max_concurrent_joins) + '''
+      ddac_source_bucket=''' + DDAC_GCP_MP_BUCKET + '''
+      sliced_download_options="''' + SLICED_DOWNLOAD_OPTIONS + '''"
+      join_slot_timeout=1800
+      trap upload_timing EXIT
+      pushd ~ubuntu
+'''
+
 
-      # Once all up and joined the cluster, ready to start dev ops vm install
-      echo dev_ops > dev_ops
-      gsutil cp ./dev_ops gs://$deployment_bucket/
+def ScriptFooter():
+  """Returns the closing lines of a startup script."""
+  return '''
+      echo "bootstrap: done after $(( $(date +%s) - bootstrap_start ))s"
       popd
-      '''
+'''
 
-  dse_non_seed_script = '''
-      #!/usr/bin/env bash
 
+def InstallJavaStage():
+  """Returns the stage installing OpenJDK from the distro packages."""
+  return '''
       # Install Java
+      phase_begin install_java
       echo "Performing package OpenJDK install"
       # check for lock
       echo -e "Checking if apt/dpkg running, start: $(date +%r)"
@@ -175,66 +1007,947 @@ def GenerateConfig(context):
       echo -e "No other procs: $(date +%r)"
       apt-get -y update
       apt-get -y install openjdk-8-jdk
+      phase_end
+'''
+
+
+def StageArtifactsStage(release):
+  """Returns the stage copying the install package into the deployment bucket.
+
+  The copy is regional, and as a copy of one object generation it also pins
+  the exact package every node of the deployment installs.
+  """
+  return '''
+      # Stage the install package next to the nodes
+      phase_begin stage_artifacts
+      gsutil -q cp gs://''' + DDAC_GCP_MP_BUCKET + '/' + DdacInstallPkg(release) + ''' gs://$deployment_bucket/artifacts/
+      barrier_signal artifacts_staged
+      phase_end
+'''
 
-      pushd ~ubuntu
-      deployment_bucket=''' + deployment_bucket + '''
-      gsutil cp gs://$deployment_bucket/seed_1 .
-      while [ $? -ne 0 ]
-      do
-          sleep 10s
-          gsutil cp gs://$deployment_bucket/seed_1 .        
-      done
 
-      # Install and conifgure non-seed node
+def FetchDdacStage(release, wait_for_staging=True):
+  """Returns the stage downloading and unpacking the ddac-gcp-install module."""
+  wait = ''
+  if wait_for_staging:
+    wait = WaitForBarrierStage('artifacts_staged')
+  return wait + '''
       # Download ddac-gcp-install module
-      ddac_install_pkg_uri=''' + ddac_install_pkg_uri + '''
-      gsutil cp gs://$ddac_install_pkg_uri .
-      ddac_install_pkg=''' + ddac_install_pkg + '''
-      tar -xvf $ddac_install_pkg
-      ddac_repo_dir=''' +  ddac_repo_dir + '''
-      ddac_repo=''' + ddac_repo + '''
+      phase_begin fetch_ddac
+      ddac_install_pkg=''' + DdacInstallPkg(release) + '''
+      fetch_artifact $ddac_install_pkg
+      phase_end
+      phase_begin unpack_ddac
+      tar -xzf $ddac_install_pkg
+      ddac_repo_dir=''' + DdacRepoDir(release) + '''
+      ddac_repo=''' + DDAC_REPO + '''
       # Standardize repo name: ddac-gcp-install
       mv $ddac_repo_dir $ddac_repo
-      ddac_tarball=''' +  ddac_tarball + '''
+      ddac_tarball=''' + DDAC_TARBALL + '''
       mv $ddac_repo/$ddac_tarball .
+      phase_end
+'''
+
+
+def PrebakedStage(release, fallback):
+  """Returns the stage picking up the artifacts baked into the image.
+
+  Nodes booted from an image that does not carry this release run the
+  fallback stages instead, so a stale image still yields a working node.
+  """
+  return '''
+      ddac_repo=''' + DDAC_REPO + '''
+      ddac_tarball=''' + DDAC_TARBALL + '''
+      if [ "$(cat ''' + PREBAKED_DIR + '''/release 2>/dev/null)" = "''' + PrebakedImageFamily(release) + '''" ]; then
+          phase_begin prebaked
+          cp -r ''' + PREBAKED_DIR + '''/$ddac_repo .
+          cp ''' + PREBAKED_DIR + '''/$ddac_tarball .
+          phase_end
+      else
+          echo "bootstrap: image is not prebaked for ''' + PrebakedImageFamily(release) + ''', installing at boot"
+''' + fallback + '''
+      fi
+'''
 
+
+def DeployDseStage(cluster_name, dc_name, seeds, jvm_options, yaml_overrides,
+                   replacing=False):
+  """Returns the stage configuring and starting DSE through deploy-dse.sh.
+
+  With replacing, a node recreated in place of a registered node takes over
+  that node's token ranges.
+  """
+  detect_replacement = ''
+  if replacing:
+    detect_replacement = '''
+      detect_replacement'''
+  return (WriteFileStage('dse-jvm.options', jvm_options) +
+          WriteFileStage('dse-cassandra.yaml', YamlLines(yaml_overrides)) + '''
       # Deploy DDAC
+      phase_begin deploy_dse''' + detect_replacement + '''
+      apply_dse_overrides
       cluster_name=''' + cluster_name + '''
       dc_name=''' + dc_name + '''
       seeds=''' + seeds + '''
       ./$ddac_repo/deploy-dse.sh $cluster_name $dc_name $seeds
-      popd
-      '''
+      phase_end
+''')
 
-  dev_ops_script = '''
-      #!/usr/bin/env bash
 
-      # Install Java
-      echo "Performing package OpenJDK install"
-      # check for lock
-      echo -e "Checking if apt/dpkg running, start: $(date +%r)"
-      while ps -A | grep -e apt -e dpkg >/dev/null 2>&1; do sleep 10s; done;
-      echo -e "No other procs: $(date +%r)"
-      apt-get -y update
-      apt-get -y install openjdk-8-jdk
+def LocalSsdStage(count):
+  """Returns the stage assembling the local SSDs into the DSE data mount."""
+  return '''
+      # Stripe the local NVMe SSDs into one RAID0 array for the DSE data
+      phase_begin local_ssd
+      ssds=$(ls /dev/disk/by-id/google-local-nvme-ssd-*)
+      if [ ''' + str(count) + ''' -eq 1 ]; then
+          data_device=$ssds
+      else
+          data_device=/dev/md0
+          if ! mdadm --detail $data_device >/dev/null 2>&1; then
+              which mdadm >/dev/null 2>&1 || apt-get -y install mdadm
+              mdadm --create $data_device --level=0 --raid-devices=''' + str(count) + ''' $ssds --force --run
+          fi
+      fi
+      mount_dse_data $data_device
+      phase_end
+'''
 
-      pushd ~ubuntu
-      deployment_bucket=''' + deployment_bucket + '''
 
-      gsutil cp gs://$deployment_bucket/dev_ops .
-      while [ $? -ne 0 ]
-      do
+def DataDiskStage():
+  """Returns the stage mounting vm-data-disk as the DSE data mount."""
+  return '''
+      # Mount the persistent data disk, keeping whatever data it carries
+      phase_begin data_disk
+      mount_dse_data /dev/disk/by-id/google-vm-data-disk
+      phase_end
+'''
+
+
+def CommitlogDiskStage():
+  """Returns the stage mounting the dedicated commitlog disk."""
+  return '''
+      # Mount the dedicated commitlog disk
+      phase_begin commitlog_disk
+      format_and_mount /dev/disk/by-id/google-vm-commitlog-disk ''' + DSE_COMMITLOG_MOUNT + '''
+      prepare_dse_dir ''' + DSE_COMMITLOG_MOUNT + '''/commitlog
+      phase_end
+'''
+
+
+def OsTuningStage(profile):
+  """Returns the stage applying the named OS tuning profile.
+
+  Every setting is rewritten from scratch, so running the stage again on a
+  reboot leaves the node in the same state. The values read back at the end
+  are what the kernel actually applied.
+  """
+  if profile == 'none':
+    return ''
+  sysctls = collections.OrderedDict(OS_TUNING_SYSCTLS)
+  if profile == 'latency':
+    sysctls.update(OS_TUNING_LATENCY_SYSCTLS)
+  sysctl_lines = ['%s = %s' % (key, value) for key, value in sysctls.items()]
+  return '''
+      # OS tuning profile: ''' + profile + '''
+      phase_begin os_tuning
+''' + WriteFileStage('/etc/sysctl.d/60-dse.conf', sysctl_lines) + '''
+      sysctl -q -p /etc/sysctl.d/60-dse.conf
+      thp=/sys/kernel/mm/transparent_hugepage
+      if [ -d $thp ]; then
+          echo never > $thp/enabled
+          echo never > $thp/defrag
+      fi
+      swapoff -a
+      sed -i '/\\sswap\\s/s/^[^#]/#&/' /etc/fstab
+      printf '%s\\n' "$dse_user - memlock unlimited" "$dse_user - nofile 1048576" \\
+          "$dse_user - nproc 32768" "$dse_user - as unlimited" > /etc/security/limits.d/dse.conf
+      for device in /dev/md0 /dev/disk/by-id/google-vm-data-disk \\
+              /dev/disk/by-id/google-vm-commitlog-disk /dev/disk/by-id/google-local-nvme-ssd-*; do
+          [ -b $device ] || continue
+          blockdev --setra 8 $device
+          block=$(basename $(readlink -f $device))
+          scheduler=/sys/block/$block/queue/scheduler
+          if [ -f $scheduler ]; then
+              echo none > $scheduler 2>/dev/null || echo noop > $scheduler 2>/dev/null
+          fi
+          echo "os_tuning: $block readahead=$(blockdev --getra $device) scheduler=$(cat $scheduler 2>/dev/null)"
+      done
+      for key in ''' + ' '.join(sysctls.keys()) + '''; do
+          echo "os_tuning: $key=$(sysctl -n $key 2>/dev/null)"
+      done
+      echo "os_tuning: transparent_hugepage=$(cat $thp/enabled 2>/dev/null) defrag=$(cat $thp/defrag 2>/dev/null)"
+      echo "os_tuning: swap devices=$(tail -n +2 /proc/swaps | wc -l)"
+      echo "os_tuning: $dse_user limits $(tr '\\n' ' ' < /etc/security/limits.d/dse.conf)"
+      phase_end
+'''
+
+
+def UntunedStage(machine_type):
+  """Returns the line noting a machine type DSE is not tuned for."""
+  return '''
+      echo "bootstrap: no tuning profile for ''' + machine_type + ''', keeping the DDAC defaults"
+'''
+
+
+def RackStage(dc_name):
+  """Returns the stage making the zone of the node its Cassandra rack."""
+  return '''
+      # The zone this node landed in is its rack
+      zone=$(curl -s -H 'Metadata-Flavor: Google' http://metadata.google.internal/computeMetadata/v1/instance/zone)
+      rack=${zone##*/}
+      echo "bootstrap: dc ''' + dc_name + ''' rack $rack"
+      printf '%s\\n' dc=''' + dc_name + ''' rack=$rack > dse-rackdc.properties
+'''
+
+
+def WaitForBarrierStage(barrier):
+  """Returns the stage blocking until another node signalled the barrier."""
+  return '''
+      phase_begin wait_''' + barrier + '''
+      barrier_wait ''' + barrier + '''
+      phase_end
+'''
+
+
+def SignalBarrierStage(barrier):
+  """Returns the stage signalling the barrier to the nodes waiting on it."""
+  return '''
+      barrier_signal ''' + barrier + '''
+'''
+
+
+def JoinStage(deploy_dse, autohealing=False):
+  """Wraps the deploy stage of a non-seed node in a bounded join slot.
+
+  With autohealing, the node answers the health check while it waits.
+  """
+  acquire = '''
+      acquire_join_slot'''
+  if autohealing:
+    acquire = '''
+      hold_health_check''' + acquire + '''
+      release_health_check'''
+  return '''
+      phase_begin join_slot''' + acquire + '''
+      phase_end
+''' + deploy_dse + '''
+      phase_begin wait_normal
+      wait_for_local_normal
+      phase_end
+      release_join_slot
+'''
+
+
+def JoinRounds(cluster_size, join_in_slots, max_concurrent_joins):
+  """Returns how many turns the non-seed pool takes to join the ring.
+
+  Without join slots the pool starts at once, but Cassandra still refuses
+  every bootstrap but one, so its nodes join one at a time as well.
+  """
+  if not join_in_slots:
+    max_concurrent_joins = 1
+  return max(1, -(-(cluster_size - 2) // max_concurrent_joins))
+
+
+def DseMetricsReporter(cluster_name, dc_name):
+  """Returns the script publishing a node's DSE_METRICS to Cloud Monitoring.
+
+  Every series carries the cluster and dc labels the dashboards and alert
+  policies filter on. One jrunscript JVM reads all metrics over JMX, where
+  nodetool would start a JVM per command. A node whose DSE doesn't answer
+  publishes nothing.
+  """
+  readings = ''.join("print('%s ' + %s);\n" % (metric, reading)
+                     for metric, reading in DSE_METRICS.items())
+  return '''#!/usr/bin/env bash
+cluster=''' + ShellQuote(cluster_name) + '''
+dc=''' + ShellQuote(dc_name) + '''
+# Last value of every counter metric
+state_dir=/var/tmp/dse-metrics
+metadata() {
+    curl -s -H 'Metadata-Flavor: Google' http://metadata.google.internal/computeMetadata/v1/$1
+}
+project=$(metadata project/project-id)
+instance_id=$(metadata instance/id)
+zone=$(metadata instance/zone)
+zone=${zone##*/}
+token=$(metadata instance/service-accounts/default/token |
+    python3 -c 'import json, sys; print(json.load(sys.stdin)["access_token"])')
+now=$(date -u +%Y-%m-%dT%H:%M:%SZ)
+
+jmx_readings=$(cat <<'EOF'
+var ObjectName = Java.type('javax.management.ObjectName');
+var mbeans;
+try {
+    mbeans = Java.type('javax.management.remote.JMXConnectorFactory').connect(
+        new (Java.type('javax.management.remote.JMXServiceURL'))(
+            'service:jmx:rmi:///jndi/rmi://127.0.0.1:''' + str(DSE_JMX_PORT) + '''/jmxrmi')
+    ).getMBeanServerConnection();
+} catch (e) {
+    exit(1);
+}
+function metric(name, attribute) {
+    return mbeans.getAttribute(
+        new ObjectName('org.apache.cassandra.metrics:' + name),
+        attribute || 'Value');
+}
+function latency_p99(scope) {
+    return metric('type=ClientRequest,scope=' + scope + ',name=Latency',
+                  '99thPercentile') / 1000;
+}
+function pool(path, scope, name) {
+    return metric('type=ThreadPools,path=' + path + ',scope=' + scope +
+                  ',name=' + name, name == 'PendingTasks' ? 'Value' : 'Count');
+}
+function dropped(scope) {
+    return metric('type=DroppedMessage,scope=' + scope + ',name=Dropped', 'Count');
+}
+// Resets the GC stats, read them once per run
+var gc_stats;
+function gcstat(index) {
+    gc_stats = gc_stats || mbeans.invoke(
+        new ObjectName('org.apache.cassandra.service:type=GCInspector'),
+        'getAndResetStats', null, null);
+    return gc_stats[index];
+}
+function heap_used() {
+    return mbeans.getAttribute(new ObjectName('java.lang:type=Memory'),
+                               'HeapMemoryUsage').get('used') / 1048576;
+}
+''' + readings + '''EOF
+)
+readings=$(jrunscript -e "$jmx_readings" 2>/dev/null) && [ -n "$readings" ] || exit 0
+
+increase() {
+    # A counter below its last value means DSE restarted and counts from 0
+    previous=$(cat $state_dir/$1 2>/dev/null)
+    echo $2 > $state_dir/$1
+    if [ -z "$previous" ]; then
+        echo 0
+    elif [ $2 -ge $previous ]; then
+        echo $(($2 - previous))
+    else
+        echo $2
+    fi
+}
+
+series() {
+    printf '{"metric": {"type": "''' + DSE_METRIC_PREFIX + '''%s", "labels": {"cluster": "%s", "dc": "%s"}}, ' $1 "$cluster" "$dc"
+    printf '"resource": {"type": "gce_instance", "labels": {"project_id": "%s", "instance_id": "%s", "zone": "%s"}}, ' \\
+        $project $instance_id $zone
+    printf '"points": [{"interval": {"endTime": "%s"}, "value": {"doubleValue": %s}}]}\\n' $now ${2:-0}
+}
+
+mkdir -p $state_dir
+time_series=$(echo "$readings" | while read metric value; do
+    case " ''' + ' '.join(DSE_COUNTER_METRICS) + ''' " in
+    *" $metric "*) value=$(increase $metric $value) ;;
+    esac
+    series $metric $value
+done | paste -sd, -)
+curl -s -X POST -H "Authorization: Bearer $token" -H 'Content-Type: application/json' \\
+    -d "{\\"timeSeries\\": [$time_series]}" \\
+    https://monitoring.googleapis.com/v3/projects/$project/timeSeries
+'''
+
+
+def MetricsReporterStage(cluster_name, dc_name):
+  """Returns the stage publishing this node's DSE metrics every minute."""
+  return (InstallFileStage('/usr/local/bin/dse-metrics.sh',
+                           DseMetricsReporter(cluster_name, dc_name),
+                           '0755') +
+          InstallFileStage('/etc/cron.d/dse-metrics',
+                           '* * * * * root /usr/local/bin/dse-metrics.sh '
+                           '>/dev/null 2>&1\n'))
+
+
+def DseBackup(backup_bucket, cluster_name, dc_name):
+  """Returns the script backing up a node's SSTables to the backup bucket.
+
+  snapshot uploads a snapshot of every keyspace, incremental the SSTables
+  DSE linked into backups/ since the last run. SSTables never change once
+  written, so data/ in the bucket holds every file once and a snapshot only
+  lists the files it is made of. Objects are named after the file and its
+  md5, so a file reusing the name of an uploaded one, e.g. a generation
+  number reused after a truncate and a restart, never replaces the object
+  older snapshots list. The system keyspace holds the identity of the node
+  and is left out.
+  """
+  return '''#!/usr/bin/env bash
+nodetool=''' + DSE_HOME + '''/bin/nodetool
+data=''' + DSE_DATA_MOUNT + '''/data
+staging=''' + DSE_DATA_MOUNT + '''/backup-staging
+# md5 of the files seen before, by name, size and mtime
+checksums=''' + DSE_DATA_MOUNT + '''/backup-checksums
+dest=gs://''' + backup_bucket + '/' + ShellQuote(cluster_name) + '/' + ShellQuote(dc_name) + '''/$(hostname)
+tag=$(date -u +%Y%m%d%H%M%S)
+# One run at a time. A snapshot waits for a running incremental backup, an
+# incremental backup is skipped while another run goes on.
+exec 9> /var/lock/dse-backup
+case $1 in
+snapshot)
+    flock 9
+    from=snapshots/$tag
+    ;;
+incremental)
+    flock -n 9 || exit 0
+    from=backups
+    ;;
+*)
+    echo "usage: $0 snapshot|incremental" >&2
+    exit 1
+    ;;
+esac
+$nodetool info >/dev/null 2>&1 || exit 0
+if [ $1 = snapshot ]; then
+    $nodetool snapshot -t $tag >/dev/null || exit 1
+fi
+
+# Hard link the files into the layout of data/ in the bucket, which rsync
+# uploads in parallel, skipping the objects already there
+cd $data
+files=$(find . -type f -path "./*/*/$from/*" ! -path './system/*' | cut -c3- | sort)
+targets=$(echo "$files" | sed "s|/$from/|/|")
+rm -rf $staging
+declare -A cached
+if [ -f $checksums ]; then
+    while read key md5; do cached[$key]=$md5; done < $checksums
+fi
+objects=
+seen=
+while read file target; do
+    [ -n "$file" ] || continue
+    key=$target:$(stat -c %s:%Y $file)
+    md5=${cached[$key]:-$(md5sum < $file | cut -c1-32)}
+    seen="$seen$key $md5"$'\\n'
+    objects="$objects$target.$md5"$'\\n'
+    mkdir -p $staging/$(dirname $target)
+    ln $file $staging/$target.$md5
+done < <(paste <(echo "$files") <(echo "$targets"))
+objects=${objects%$'\\n'}
+# A snapshot sees every live file, so it also drops the checksums of
+# compacted ones
+if [ $1 = snapshot ]; then
+    printf '%s' "$seen" > $checksums
+else
+    printf '%s' "$seen" >> $checksums
+fi
+status=0
+if [ -d $staging ]; then
+    gsutil -q -m rsync -r $staging $dest/data || status=1
+fi
+rm -rf $staging
+
+if [ $1 = snapshot ]; then
+    if [ $status -eq 0 ]; then
+        $nodetool info -T | awk '/^Token/ {print $3}' | paste -sd, - | gsutil -q cp - $dest/snapshots/$tag/tokens
+        $nodetool info | awk '/^Rack/ {print $3}' | gsutil -q cp - $dest/snapshots/$tag/rack
+        # Written last, a snapshot without a manifest is incomplete
+        echo "$objects" | gsutil -q cp - $dest/snapshots/$tag/manifest
+    fi
+    $nodetool clearsnapshot -t $tag >/dev/null
+elif [ $status -eq 0 ] && [ -n "$files" ]; then
+    echo "$objects" | gsutil -q cp - $dest/incremental/$tag
+    # Uploaded, the links in backups/ only take up space
+    echo "$files" | xargs rm -f
+fi
+exit $status
+'''
+
+
+def BackupStage(backup_bucket, cluster_name, dc_name, schedule,
+                incremental_minutes):
+  """Returns the stage scheduling the snapshots and incremental backups."""
+  cron = ('%s root /usr/local/bin/dse-backup.sh snapshot 2>&1 '
+          '| logger -t dse-backup\n' % schedule)
+  if incremental_minutes:
+    cron += ('*/%d * * * * root /usr/local/bin/dse-backup.sh incremental 2>&1 '
+             '| logger -t dse-backup\n' % incremental_minutes)
+  return (InstallFileStage('/usr/local/bin/dse-backup.sh',
+                           DseBackup(backup_bucket, cluster_name, dc_name),
+                           '0755') +
+          InstallFileStage('/etc/cron.d/dse-backup', cron))
+
+
+def RestoreStage(restore_from, snapshot, dc_name):
+  """Returns the stage restoring a backed-up node of the datacenter.
+
+  It runs before any barrier, so all nodes of a rebuilt cluster download
+  their data at the same time.
+  """
+  return '''
+      phase_begin restore_data
+      restore_node ''' + restore_from.rstrip('/') + '/' + ShellQuote(dc_name) + ' ' + ShellQuote(snapshot) + ' ' + str(RESTORE_WINDOW_SEC) + '''
+      phase_end
+'''
+
+
+def MetricFilter(metric, cluster_name, dc_name):
+  """Returns the Cloud Monitoring filter of a DSE metric of one datacenter."""
+  return ('metric.type="%s%s" metric.label.cluster="%s" metric.label.dc="%s"' %
+          (DSE_METRIC_PREFIX, metric, cluster_name, dc_name))
+
+
+def Dashboard(name, project, cluster_name, dc_name):
+  """Returns the Cloud Monitoring dashboard charting DSE_METRICS per node."""
+  widgets = []
+  for metric in DSE_METRICS:
+    widgets.append({
+        'title': metric.replace('_', ' '),
+        'xyChart': {
+            'dataSets': [{
+                'plotType': 'LINE',
+                'timeSeriesQuery': {
+                    'timeSeriesFilter': {
+                        'filter': MetricFilter(metric, cluster_name, dc_name),
+                        'aggregation': {
+                            'alignmentPeriod': '60s',
+                            'perSeriesAligner': 'ALIGN_MEAN'
+                        }
+                    }
+                }
+            }]
+        }
+    })
+  return {
+      'name': name,
+      'type': 'gcp-types/monitoring-v1:projects.dashboards',
+      'properties': {
+          'parent': 'projects/' + project,
+          'displayName': 'DSE %s %s' % (cluster_name, dc_name),
+          'gridLayout': {
+              'columns': 3,
+              'widgets': widgets
+          }
+      }
+  }
+
+
+def AlertPolicy(name, project, cluster_name, dc_name, condition,
+                notification_channels):
+  """Returns a Cloud Monitoring alert policy on the DSE nodes of a dc."""
+  return {
+      'name': name,
+      'type': 'gcp-types/monitoring-v3:projects.alertPolicies',
+      'properties': {
+          'name': 'projects/' + project,
+          'displayName': 'DSE %s %s: %s' % (cluster_name, dc_name,
+                                            condition['displayName']),
+          'combiner': 'OR',
+          'conditions': [condition],
+          'notificationChannels': list(notification_channels)
+      }
+  }
+
+
+def AlertPolicies(deployment, project, cluster_name, dc_name,
+                  notification_channels):
+  """Returns the MONITORING_ALERTS policies plus one on silent nodes."""
+  def Aggregations():
+    return [{'alignmentPeriod': '60s', 'perSeriesAligner': 'ALIGN_MEAN'}]
+
+  conditions = []
+  for metric, title, threshold, duration in MONITORING_ALERTS:
+    conditions.append((metric, {
+        'displayName': title,
+        'conditionThreshold': {
+            'filter': MetricFilter(metric, cluster_name, dc_name),
+            'comparison': 'COMPARISON_GT',
+            'thresholdValue': threshold,
+            'duration': '%ds' % duration,
+            'aggregations': Aggregations()
+        }
+    }))
+  # The reporter goes quiet when DSE stops answering on a node
+  conditions.append(('node_down', {
+      'displayName': 'Node not reporting',
+      'conditionAbsent': {
+          'filter': MetricFilter('heap_used_mb', cluster_name, dc_name),
+          'duration': '600s',
+          'aggregations': Aggregations()
+      }
+  }))
+  return [AlertPolicy('%s-%s-alert' % (deployment, metric.replace('_', '-')),
+                      project, cluster_name, dc_name, condition,
+                      notification_channels)
+          for metric, condition in conditions]
+
+
+def Autoscaler(name, region, igm, properties):
+  """Returns the autoscaler of the non-seed pool.
+
+  The autoscaler only adds nodes. Removing a node needs a nodetool
+  decommission first, which nothing runs when the group deletes a VM, so
+  scaling in would drop a replica of its ranges every time. The cooldown
+  covers a node bootstrap so a joining node isn't measured yet.
+  """
+  min_size = properties.get('autoscalerMinSize',
+                            properties['clusterSize'] - 2)
+  max_size = properties['autoscalerMaxSize']
+  if min_size < 1 or max_size < min_size:
+    raise ValueError('Autoscaler needs 1 <= autoscalerMinSize (%d) <= '
+                     'autoscalerMaxSize (%d)' % (min_size, max_size))
+  policy = {
+      'minNumReplicas': min_size,
+      'maxNumReplicas': max_size,
+      'coolDownPeriodSec': properties.get('autoscalerCooldownSec', 900),
+      'cpuUtilization': {
+          'utilizationTarget': properties.get('autoscalerCpuTarget', 0.75)
+      },
+      'mode': 'ONLY_SCALE_OUT'
+  }
+  metric = properties.get('autoscalerMetric', 'none')
+  if metric != 'none':
+    metric_name, default_target = AUTOSCALER_METRICS[metric]
+    policy['customMetricUtilizations'] = [{
+        'metric': DSE_METRIC_PREFIX + metric_name,
+        'utilizationTarget': properties.get('autoscalerMetricTarget',
+                                            default_target),
+        'utilizationTargetType': 'GAUGE'
+    }]
+  return {
+      'name': name,
+      'type': 'compute.v1.regionAutoscaler',
+      'properties': {
+          'name': name,
+          'region': region,
+          'target': '$(ref.%s.selfLink)' % igm,
+          'autoscalingPolicy': policy
+      }
+  }
+
+
+def ReadyStage():
+  """Returns the stage ending a DSE node bootstrap once the node is UN.
+
+  The uploaded timing log then tells rolling_update.py the node is back.
+  """
+  return '''
+      phase_begin wait_ready
+      wait_for_local_normal
+      phase_end
+'''
+
+
+def RegisterNodeStage():
+  """Returns the stage registering a DSE node once it serves its ranges."""
+  return '''
+      phase_begin register_node
+      wait_for_local_normal
+      register_node
+      phase_end
+'''
+
+
+def HealthCheck(name):
+  """Returns the health check probing the CQL native port of a node."""
+  return {
+      'name': name,
+      'type': 'compute.v1.healthCheck',
+      'properties': {
+          'name': name,
+          'description': 'DSE CQL native transport',
+          'type': 'TCP',
+          'tcpHealthCheck': {
+              'port': DSE_NATIVE_PORT
+          },
+          'checkIntervalSec': 30,
+          'timeoutSec': 10,
+          'healthyThreshold': 1,
+          'unhealthyThreshold': 4
+      }
+  }
+
+
+def WaitForClusterStage(non_seed_igm, region, dc_name):
+  """Returns the stage waiting until every DSE node of the dc is up and normal.
+
+  The expected size is read from the non-seed pool at run time rather than
+  baked into the script, so resizing the pool leaves seed 1 untouched.
+  """
+  return '''
+      # Wait until all DSE nodes of the datacenter are up and have joined the cluster:
+      phase_begin wait_cluster
+      non_seed_igm=''' + non_seed_igm + '''
+      region=''' + region + '''
+      until non_seed_size=$(gcloud compute instance-groups managed describe $non_seed_igm --region $region --format 'value(targetSize)') \\
+          && [ -n "$non_seed_size" ]; do
           sleep 10s
-          gsutil cp gs://$deployment_bucket/dev_ops .
       done
+      cluster_size=$(( non_seed_size + 2 ))
+      count_normal() {
+          $dse_home/bin/nodetool status | awk -v dc=''' + dc_name + ''' '$1 == "Datacenter:" {in_dc = $2 == dc} in_dc && $1 == "UN"' | wc -l
+      }
+      size=$(count_normal)
+      while [ $size -lt $cluster_size ]; do
+          echo The Current DSE cluster size is $size
+          echo Keep looping until the DSE cluster size reaches $cluster_size
+          sleep 10s
+          size=$(count_normal)
+      done
+      phase_end
+'''
+
 
+def DevOpsStage():
+  """Returns the stage installing the dev ops VM software."""
+  return '''
       # install and configure the dev ops vm below
+      phase_begin dev_ops_install
       echo install Dev Ops VM software components
       sleep 120
+      # Top level flag files only, the timing logs under timing/ stay
       gsutil rm gs://$deployment_bucket/*
-      popd
-      '''
- 
+      phase_end
+'''
+
+
+def DurationSec(duration):
+  """Returns the seconds of a cassandra-stress duration such as 5m."""
+  match = re.match(r'^(\d+)([smh])$', duration)
+  if not match:
+    raise ValueError('Invalid duration %s, expected e.g. 300s, 5m or 1h' %
+                     duration)
+  return int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600}[match.group(2)]
+
+
+def BenchmarkStage(workload, threads, duration, seeds, dc_name,
+                   replication_factor):
+  """Returns the stage running cassandra-stress against the new cluster.
+
+  Reads and mixed workloads first populate BENCHMARK_PARTITIONS partitions.
+  The log, HdrHistogram and a JSON summary of each run end up under
+  benchmark/ in the deployment bucket.
+  """
+  # cassandra-stress takes the command and its settings such as cl= first,
+  # then the dash options, which swallow any plain argument after them
+  options = (' -node ' + seeds +
+             ' -schema "replication(strategy=NetworkTopologyStrategy,' +
+             dc_name + '=' + str(replication_factor) + ')"')
+  population = ' -pop dist=uniform\\(1..%d\\)' % BENCHMARK_PARTITIONS
+  runs = []
+  if workload != 'write':
+    runs.append(('populate', 'write n=%d' % BENCHMARK_PARTITIONS,
+                 ' -pop seq=1..%d' % BENCHMARK_PARTITIONS, 32))
+  if workload == 'mixed':
+    runs.append((workload, "mixed 'ratio(write=1,read=3)' duration=" +
+                 duration, population, threads))
+  elif workload == 'read':
+    runs.append((workload, 'read duration=' + duration, population, threads))
+  else:
+    runs.append((workload, 'write duration=' + duration, '', threads))
+  stress_runs = ''
+  for name, command, run_population, run_threads in runs:
+    stress_runs += '''
+      $stress ''' + command + ' cl=LOCAL_QUORUM' + run_population + options + ''' -rate threads=''' + str(run_threads) + ''' \\
+          -log hdrfile=benchmark/''' + name + '''.hdr 2>&1 | tee benchmark/''' + name + '.log'
+  return '''
+      # Benchmark the new cluster with the cassandra-stress of the DDAC tarball
+      phase_begin benchmark
+      tar -xzf $ddac_tarball
+      stress=$(find $PWD -path '*tools/bin/cassandra-stress' | head -1)
+      mkdir -p benchmark''' + stress_runs + '''
+      awk -F' *: *' -v workload=''' + workload + ''' -v threads=''' + str(threads) + ''' -v duration=''' + duration + ''' \\
+          'BEGIN {printf "{\\"workload\\": \\"%s\\", \\"threads\\": %s, \\"duration\\": \\"%s\\"", workload, threads, duration}
+           /^(Op rate|Latency|Total errors)/ {split($2, v, " "); gsub(",", "", v[1]); key = tolower($1); gsub(/[ .]/, "_", key);
+                                             printf ", \\"%s\\": %s", key, v[1]}
+           END {print "}"}' benchmark/''' + workload + '''.log > benchmark/summary.json
+      cat benchmark/summary.json
+      gsutil -q cp -r benchmark gs://$deployment_bucket/
+      if [ $barrier_backend = runtimeconfig ]; then
+          gcloud beta runtime-config configs variables set benchmark/summary "$(cat benchmark/summary.json)" --is-text --config-name $runtime_config
+      fi
+      phase_end
+'''
+
+
+def GenerateConfig(context):
+  """Generates the configuration."""
+
+  config = {'resources': []}
+
+  deployment = context.env['deployment']
+  # GCP Instance Template and Instance Group Manager of the dev ops VM
+  dev_ops_it = deployment + '-dev-ops-it'
+  dev_ops_igm = deployment + '-dev-ops-igm'
+  # GCP Instance Template holding the helpers of all startup scripts
+  functions_it = deployment + '-bootstrap-functions-it'
+
+  # DSE datacenters. A single one is named after the deployment alone, with
+  # datacenters the resources and barriers of each one carry its name.
+  datacenters = Datacenters(context.properties)
+  multi_dc = bool(context.properties.get('datacenters'))
+  if multi_dc:
+    slugs = [DatacenterSlug(dc['dcName']) for dc in datacenters]
+    name_prefixes = [deployment + '-' + slug for slug in slugs]
+    barrier_prefixes = [slug.replace('-', '_') + '_' for slug in slugs]
+  else:
+    name_prefixes = [deployment]
+    barrier_prefixes = ['']
+  first_dc = datacenters[0]
+
+  # The bucket and the dev ops VM live in the region of the first datacenter
+  region = first_dc['region']
+  ddac_network_name = context.properties['network']
+  ddac_network = URL_BASE + context.env['project'] + '/global/networks/' + ddac_network_name
+
+  # DDAC firewall
+  ddac_fw = deployment + '-ddac-fw'
+
+  # DSE seed 0 and seed 1 IP addresses based on the CIDR of each datacenter
+  # In GCP, auto IP address assignment for first and second IP addresses are .2 and .3
+  # Every node gets the seeds of all datacenters.
+  seed_ips = [(CidrHost(dc['cidr'], 2), CidrHost(dc['cidr'], 3))
+              for dc in datacenters]
+  dse_seed_0_ip_addr, dse_seed_1_ip_addr = seed_ips[0]
+  seeds = ','.join(ip for dc_seeds in seed_ips for ip in dc_seeds)
+
+  # DSE cluster info
+  cluster_name = context.properties['clusterName']
+
+  deployment_bucket = DeploymentBucket(context.env['project'], deployment)
+
+  # Bootstrap ordering. serial starts each node only after the previous one
+  # finished; parallel installs everywhere at once and only gates the DSE
+  # start, letting up to maxConcurrentJoins non-seed nodes join at a time.
+  bootstrap_mode = context.properties.get('bootstrapMode', 'serial')
+  max_concurrent_joins = context.properties.get('maxConcurrentJoins', 1)
+  base_jvm_options = []
+  # An autoscaled pool keeps adding nodes after the deployment, so its nodes
+  # always join through the join slots, one at a time by default. So do the
+  # nodes of an autohealed pool, which answer the health check while they
+  # wait for their turn.
+  autoscaling = 'autoscalerMaxSize' in context.properties
+  autohealing = context.properties.get('autohealing', False)
+  join_in_slots = bootstrap_mode == 'parallel' or autoscaling or autohealing
+  if join_in_slots and max_concurrent_joins > 1:
+    # Cassandra refuses concurrent bootstraps unless this is disabled
+    base_jvm_options.append('-Dcassandra.consistent.rangemovement=false')
+
+  # ddac-gcp-install release the nodes install
+  release = context.properties.get('ddacRelease', RELEASE)
+
+  # Boot image. install boots the public DSE image and installs Java and
+  # DDAC on every node, prebaked boots an image built by build_image.py.
+  image_mode = context.properties.get('imageMode', 'install')
+  if image_mode == 'prebaked':
+    source_image = context.properties.get(
+        'prebakedImage',
+        'global/images/family/' + PrebakedImageFamily(release))
+    if not source_image.startswith('https://'):
+      source_image = URL_BASE + context.env['project'] + '/' + source_image
+  else:
+    source_image = URL_BASE + BASE_IMAGE_PROJECT + '/global/images/' + BASE_IMAGE
+
+  # Stateful nodes keep their data disks and internal IP when recreated, and
+  # the startup script mounts the data disk itself so it is never reformatted
+  stateful = context.properties.get('stateful', False)
+  if stateful and autoscaling:
+    raise ValueError('Stateful IGMs can not be autoscaled')
+
+  # Backups go to backupBucket, an existing bucket outliving the deployment.
+  # restoreFrom rebuilds the cluster from the gs://<bucket>/<cluster> backup
+  # of one. Both need the data directories on a mount the startup script
+  # sets up itself, like stateful nodes.
+  backup_bucket = context.properties.get('backupBucket')
+  backup_incremental_minutes = context.properties.get(
+      'backupIncrementalMinutes', BACKUP_INCREMENTAL_MINUTES)
+  restore_from = context.properties.get('restoreFrom')
+  if backup_bucket and '/' in backup_bucket:
+    raise ValueError('backupBucket is a bucket name, not %s' % backup_bucket)
+  if restore_from and not restore_from.startswith('gs://'):
+    raise ValueError('restoreFrom is a gs://<bucket>/<cluster> path, not %s' %
+                     restore_from)
+  mount_data = bool(stateful or backup_bucket or restore_from)
+
+  # Networking. gVNIC and Tier_1 egress speed up streaming and repair,
+  # internal-only nodes reach GCS and the other Google APIs through Private
+  # Google Access, which can't serve the apt-get of an install boot.
+  nic_type = context.properties.get('nicType', 'VIRTIO_NET')
+  tier_1 = context.properties.get('tier1Networking', False)
+  external_ip = context.properties.get('externalIp', True)
+  # The dev ops VM, which also runs the benchmark client, is sized on its own
+  dev_ops_machine_type = context.properties.get(
+      'devOpsMachineType', first_dc['machineType'])
+  ValidateNetworking(dev_ops_machine_type, nic_type, tier_1)
+  # Neither the public xenial image nor the images of build_image.py carry
+  # the gVNIC driver and GVNIC guest OS feature, only a prebakedImage of
+  # the user's own can
+  if nic_type == 'GVNIC' and (image_mode != 'prebaked' or
+                              'prebakedImage' not in context.properties):
+    raise ValueError('nicType GVNIC needs a prebakedImage with the gVNIC '
+                     'driver and the GVNIC guest OS feature')
+  if not external_ip and image_mode != 'prebaked':
+    raise ValueError('Nodes without external IPs need imageMode prebaked')
+
+  # Monitoring mode publishes DSE_METRICS from every DSE node, autoscaling
+  # only needs them from the non-seed pool
+  monitoring = context.properties.get('monitoring', False)
+
+  # Service account scopes of every node
+  scopes = ['https://www.googleapis.com/auth/compute',
+            'https://www.googleapis.com/auth/cloudruntimeconfig',
+            'https://www.googleapis.com/auth/devstorage.full_control']
+  if autoscaling or monitoring:
+    # Nodes publish the DSE metrics the autoscaler and dashboards use
+    scopes.append('https://www.googleapis.com/auth/monitoring.write')
+
+  # Readiness barriers between the node roles. runtimeconfig wakes waiting
+  # nodes through Runtime Config watches, gcs polls flag files in the bucket.
+  # Every datacenter adds its seed barriers in the loop below.
+  barrier_backend = context.properties.get('barrierBackend', 'runtimeconfig')
+  runtime_config = deployment + '-bootstrap-config'
+  barriers = ['artifacts_staged']
+  # Benchmark mode makes the dev ops VM load the new cluster, and the
+  # deployment wait for the results
+  benchmark = context.properties.get('benchmarkWorkload', 'none')
+  benchmark_duration = context.properties.get('benchmarkDuration', '5m')
+  benchmark_waiter = deployment + '-benchmark-waiter'
+  # Deployment waits on the dev_ops barrier, i.e. on every DSE node being up
+  cluster_ready_waiter = deployment + '-cluster-ready-waiter'
+
+  install_java = InstallJavaStage()
+  fetch_ddac = FetchDdacStage(release)
+  # Seed 0 of the first datacenter stages the install package for everybody
+  # else
+  stage_artifacts = StageArtifactsStage(release)
+  seed_0_fetch_ddac = FetchDdacStage(release, wait_for_staging=False)
+  if image_mode == 'prebaked':
+    # Java and the DDAC artifacts already sit in the image
+    fetch_ddac = PrebakedStage(release, install_java + fetch_ddac)
+    seed_0_fetch_ddac = PrebakedStage(release, install_java + seed_0_fetch_ddac)
+    install_java = ''
+  # The stages live in the functions template, the startup scripts of the
+  # roles only run them between their barriers
+  stages = collections.OrderedDict()
+  install_java = SharedStage(stages, install_java)
+  fetch_ddac = SharedStage(stages, fetch_ddac)
+  stage_artifacts = SharedStage(stages, stage_artifacts)
+  seed_0_fetch_ddac = SharedStage(stages, seed_0_fetch_ddac)
+  # Kernel tuning runs once the data devices exist and before DSE starts
+  os_tuning = SharedStage(stages, OsTuningStage(
+      context.properties.get('osTuningProfile', 'none')))
+
+  # Autohealing recreates dead nodes. Non-seed nodes that come back empty
+  # replace their old selves, which every node registers once it is up.
+  dse_health_check = deployment + '-dse-health-check'
+  if barrier_backend == 'gcs' and (autohealing or autoscaling):
+    # The flag files are gone once the deployment is up, so nodes added
+    # later would wait on them forever
+    raise ValueError('Autohealing and autoscaling need barrierBackend '
+                     'runtimeconfig')
+
+  # Template changes roll out through rolling_update.py, and every DSE node
+  # drains when its VM is stopped or recreated. Without zones the groups
+  # spread over three zones of the region.
+  update_minimal_action = context.properties.get('updateMinimalAction',
+                                                 'REPLACE')
+  # Compact placement puts the DSE nodes close together for low RTT, spread
+  # placement keeps them on separate hosts and racks
+  placement = context.properties.get('placementPolicy', 'none')
+  domains = context.properties.get('placementAvailabilityDomains', 3)
+
   # Create a dictionary which represents the resources
   # (Intstance Template, IGM, etc.)
   resources = [
@@ -243,6 +1956,8 @@ def GenerateConfig(context):
         'type': 'storage.v1.bucket',
         'properties': {
             'name': deployment_bucket,
+            # Regional, so the staged artifacts are read from inside the region
+            'location': region,
             'lifecycle': {
           	"rule": [ {
       		    "action": {"type": "Delete"},
@@ -260,22 +1975,6 @@ def GenerateConfig(context):
                 'autoCreateSubnetworks': False,
           }
       },
-      {
-          'name': dse_subnet,
-          'type': 'compute.v1.subnetwork',
-          'properties': {
-                'name': dse_subnet,
-                'description': 'Subnetwork of %s in %s' % (ddac_network_name, dse_subnet),
-                'ipCidrRange': cidr,
-                'region': region,
-                'network': ddac_network,
-          },
-          'metadata': {
-                'dependsOn': [
-                     ddac_network_name,
-                ]
-          }
-      },
       {
           'name': ddac_fw,
           'type': 'compute.v1.firewalls',
@@ -298,279 +1997,448 @@ def GenerateConfig(context):
                     ddac_network_name,
                 ]
           }
-      },
-      {
-          # Create the Instance Template
-          'name': dse_seed_0_it,
-          'type': 'compute.v1.instanceTemplate',
-          'properties': {
-              'properties': {
-                  'machineType':
-                      context.properties['machineType'],
-                  'networkInterfaces': [{
-                      'network': ddac_network,
-                      'subnetwork': '$(ref.%s.selfLink)' % dse_subnet,
-                      'accessConfigs': [{
-                          'name': 'External NAT',
-                          'type': 'ONE_TO_ONE_NAT'
-                      }]
-                  }],
-                  'disks': [{
-                      'deviceName': 'boot-disk',
-                      'type': 'PERSISTENT',
-                      'boot': True,
-                      'autoDelete': True, 
-                      'initializeParams': {
-                          'sourceImage':
-                            URL_BASE + 'datastax-public/global/images/datastax-enterprise-ubuntu-1604-xenial-v20180824'
-                      }
-                    }, 
-		    {
-                      'deviceName': 'vm-data-disk',
-                      'type': 'PERSISTENT',
-                      'boot': False,
-                      'autoDelete': True,
-                      'initializeParams': {
-                          'diskType': context.properties['dataDiskType'],
-                          'diskSizeGb': context.properties['dataDiskSize']
-                      }
-                    }
-                  ],
-                  'serviceAccounts': [{
-                     'email': 'default',
-                     'scopes': ['https://www.googleapis.com/auth/compute', 'https://www.googleapis.com/auth/cloudruntimeconfig', 'https://www.googleapis.com/auth/devstorage.full_control']
-                  }],
-                  'metadata': {
-                      'dependsOn': [
-                          dse_subnet,
-                      ],
-                      'items': [ {
-                          'key': 'startup-script',
-                          'value': dse_seed_0_script
-                      }]
-                  }
-              }
-          }
-      },
-      {
-          # Create the Instance Template
-          'name': dse_seed_1_it,
-          'type': 'compute.v1.instanceTemplate',
-          'properties': {
-              'properties': {
-                  'machineType':
-                      context.properties['machineType'],
-                  'networkInterfaces': [{
-                      'network': ddac_network,
-                      'subnetwork': '$(ref.%s.selfLink)' % dse_subnet,
-                      'accessConfigs': [{
-                          'name': 'External NAT',
-                          'type': 'ONE_TO_ONE_NAT'
-                      }]
-                  }],
-                  'disks': [{
-                      'deviceName': 'boot-disk',
-                      'type': 'PERSISTENT',
-                      'boot': True,
-                      'autoDelete': True,
-                      'initializeParams': {
-                          'sourceImage':
-                            URL_BASE + 'datastax-public/global/images/datastax-enterprise-ubuntu-1604-xenial-v20180824'
-                      }
-                    },
-                    {
-                      'deviceName': 'vm-data-disk',
-                      'type': 'PERSISTENT',
-                      'boot': False,
-                      'autoDelete': True,
-                      'initializeParams': {
-                          'diskType': context.properties['dataDiskType'],
-                          'diskSizeGb': context.properties['dataDiskSize']
-                      }
-                    }
-                  ],
-                  'serviceAccounts': [{
-                     'email': 'default',
-                     'scopes': ['https://www.googleapis.com/auth/compute', 'https://www.googleapis.com/auth/cloudruntimeconfig', 'https://www.googleapis.com/auth/devstorage.full_control']
-                  }],
-                  'metadata': {
-                      'dependsOn': [
-                          dse_subnet,
-                      ],
-                      'items': [ {
-                          'key': 'startup-script',
-                          'value': dse_seed_1_script
-                      }]
-                  }
-              }
-          }
-      },
-      {
-          # Create the Instance Template
-          'name': dse_non_seed_it,
-          'type': 'compute.v1.instanceTemplate',
+      }
+  ]
+  if autohealing:
+    resources.append(HealthCheck(dse_health_check))
+
+  dse_subnets = []
+  dse_seed_0_igms = []
+  dse_non_seed_pool_igms = []
+  for index, dc in enumerate(datacenters):
+    prefix = name_prefixes[index]
+    barrier_prefix = barrier_prefixes[index]
+    dc_name = dc['dcName']
+    dc_region = dc['region']
+    machine_type = dc['machineType']
+    # GCP Instance Templates
+    dse_seed_0_it = prefix + '-dse-seed-0-it'
+    dse_seed_1_it = prefix + '-dse-seed-1-it'
+    dse_non_seed_it = prefix + '-dse-non-seed-it'
+    # GCP Instance Group Manager
+    dse_seed_0_igm = prefix + '-dse-seed-0-igm'
+    dse_seed_1_igm = prefix + '-dse-seed-1-igm'
+    dse_non_seed_pool_igm = prefix + '-dse-non-seed-pool-igm'
+    dse_non_seed_pool_as = prefix + '-dse-non-seed-pool-as'
+    # GCP subnet
+    dse_subnet = prefix + '-dse-subnet-' + dc_region
+    dse_subnets.append(dse_subnet)
+    dse_seed_0_igms.append(dse_seed_0_igm)
+    dse_non_seed_pool_igms.append(dse_non_seed_pool_igm)
+    seed_0_barrier = barrier_prefix + 'seed_0'
+    seed_1_barrier = barrier_prefix + 'seed_1'
+    barriers.extend([seed_0_barrier, seed_1_barrier])
+
+    # Nodes the datacenter can grow to. GCE keeps four addresses of every
+    # subnet and the dev ops VM takes one of the first one.
+    max_nodes = dc['clusterSize']
+    if autoscaling:
+      max_nodes = context.properties['autoscalerMaxSize'] + 2
+    cidr_start, cidr_end = CidrRange(dc['cidr'])
+    if max_nodes + (index == 0) > cidr_end - cidr_start + 1 - 4:
+      raise ValueError('Subnet %s of %s has no room for %d nodes' %
+                       (dc['cidr'], dc_name, max_nodes))
+
+    # JVM heap, GC and thread pool sizing derived from the machine type. A
+    # machine type of unknown shape keeps the DDAC defaults, and its nodes
+    # say so in their bootstrap log.
+    jvm_options = list(base_jvm_options)
+    yaml_overrides = collections.OrderedDict()
+    untuned = ''
+    if context.properties.get('machineTuning', 'auto') == 'auto':
+      try:
+        tuning = dse_tuning.TuningProfile(machine_type,
+                                          dc.get('machineTuningOverrides'))
+      except ValueError:
+        untuned = UntunedStage(machine_type)
+      else:
+        jvm_options.extend(dse_tuning.JvmOptions(tuning))
+        yaml_overrides.update(dse_tuning.YamlOverrides(tuning))
+    ValidateNetworking(machine_type, nic_type, tier_1)
+
+    # Data disks of the DSE nodes. persistent attaches one vm-data-disk that
+    # deploy-dse.sh sets up, local-ssd stripes NVMe local SSDs into a RAID0
+    # array holding all DSE data directories.
+    data_disk_kind = dc.get('dataDiskKind', 'persistent')
+    local_ssd_count = dc.get('localSsdCount', 1)
+    if stateful and data_disk_kind == 'local-ssd':
+      raise ValueError('Local SSDs can not be preserved by a stateful IGM')
+    if data_disk_kind == 'local-ssd':
+      ValidateLocalSsd(machine_type, local_ssd_count)
+    if data_disk_kind == 'local-ssd' or mount_data:
+      yaml_overrides['data_file_directories'] = [DSE_DATA_MOUNT + '/data']
+      yaml_overrides['commitlog_directory'] = DSE_DATA_MOUNT + '/commitlog'
+      yaml_overrides['hints_directory'] = DSE_DATA_MOUNT + '/hints'
+      yaml_overrides['saved_caches_directory'] = DSE_DATA_MOUNT + '/saved_caches'
+      yaml_overrides['cdc_raw_directory'] = DSE_DATA_MOUNT + '/cdc_raw'
+    # Optional dedicated commitlog disk, keeping the sequential commitlog
+    # fsyncs away from the random compaction I/O on the data disk
+    if 'commitlogDiskType' in dc:
+      yaml_overrides['commitlog_directory'] = DSE_COMMITLOG_MOUNT + '/commitlog'
+    if backup_bucket and backup_incremental_minutes:
+      yaml_overrides['incremental_backups'] = 'true'
+
+    # Disks, rack and kernel of a DSE node are set up before any waiting, so
+    # a recreated node knows right away whether it is rejoining
+    prepare_node = untuned
+    if data_disk_kind == 'local-ssd':
+      prepare_node += SharedStage(stages, LocalSsdStage(local_ssd_count))
+    elif mount_data:
+      prepare_node += SharedStage(stages, DataDiskStage())
+    if 'commitlogDiskType' in dc:
+      prepare_node += SharedStage(stages, CommitlogDiskStage())
+    # Rack awareness. The IGMs spread the nodes over the given zones, with
+    # the two seeds in different ones, and every node joins with its zone as
+    # the GossipingPropertyFileSnitch rack.
+    zones = dc.get('zones', [])
+    for zone in zones:
+      if not zone.startswith(dc_region + '-'):
+        raise ValueError('Zone %s is not in region %s' % (zone, dc_region))
+    if zones:
+      yaml_overrides['endpoint_snitch'] = 'GossipingPropertyFileSnitch'
+      prepare_node += SharedStage(stages, RackStage(dc_name), 'rack')
+    prepare_node += os_tuning
+    if restore_from:
+      prepare_node += SharedStage(stages, RestoreStage(
+          restore_from, context.properties.get('restoreSnapshot', 'latest'),
+          dc_name))
+
+    deploy_dse = SharedStage(stages, DeployDseStage(
+        cluster_name, dc_name, seeds, jvm_options, yaml_overrides))
+    register_node = ''
+    join_dse = deploy_dse
+    if autohealing:
+      register_node = SharedStage(stages, RegisterNodeStage())
+      join_dse = SharedStage(stages, DeployDseStage(
+          cluster_name, dc_name, seeds, jvm_options, yaml_overrides,
+          replacing=True))
+    # The join slot waits and signals like a barrier, so it stays in the
+    # script of the pool
+    if join_in_slots:
+      join_dse = JoinStage(join_dse, autohealing)
+    if autoscaling or monitoring:
+      reporter = SharedStage(stages, MetricsReporterStage(cluster_name,
+                                                          dc_name),
+                             'metrics_reporter')
+      join_dse += reporter
+      if monitoring:
+        deploy_dse += reporter
+    if backup_bucket:
+      backup = SharedStage(stages, BackupStage(
+          backup_bucket, cluster_name, dc_name,
+          context.properties.get('backupSchedule', BACKUP_SCHEDULE),
+          backup_incremental_minutes), 'backup')
+      deploy_dse += backup
+      join_dse += backup
+
+    header_args = (functions_it, deployment_bucket, barrier_backend,
+                   runtime_config, max_concurrent_joins)
+    if index == 0:
+      # DSE seed 0 starts the cluster and signals seed 1
+      dse_seed_0_script = (ScriptHeader('seed-0', *header_args) +
+                           stage_artifacts + install_java + prepare_node +
+                           seed_0_fetch_ddac + deploy_dse)
+    elif bootstrap_mode == 'parallel':
+      # The seeds of the other datacenters start once the cluster exists
+      dse_seed_0_script = (ScriptHeader('seed-0', *header_args) +
+                           install_java + prepare_node + fetch_ddac +
+                           WaitForBarrierStage(barrier_prefixes[0] + 'seed_0') +
+                           deploy_dse)
+    else:
+      # or once the previous datacenter is complete
+      dse_seed_0_script = (ScriptHeader('seed-0', *header_args) +
+                           install_java + prepare_node +
+                           WaitForBarrierStage(barrier_prefixes[index - 1] +
+                                               'ready') +
+                           fetch_ddac + deploy_dse)
+    dse_seed_0_script += (SignalBarrierStage(seed_0_barrier) + ReadyStage() +
+                          register_node + ScriptFooter())
+
+    if bootstrap_mode == 'parallel':
+      # Seed 1 and the non-seed nodes download and install right away and
+      # only wait for seed 0 before starting DSE
+      dse_seed_1_script = (ScriptHeader('seed-1', *header_args) +
+                           install_java + prepare_node + fetch_ddac +
+                           WaitForBarrierStage(seed_0_barrier) + deploy_dse +
+                           SignalBarrierStage(seed_1_barrier))
+      dse_non_seed_script = (ScriptHeader('non-seed', *header_args) +
+                             install_java + prepare_node + fetch_ddac +
+                             WaitForBarrierStage(seed_0_barrier) + join_dse +
+                             ReadyStage() + register_node + ScriptFooter())
+    else:
+      dse_seed_1_script = (ScriptHeader('seed-1', *header_args) +
+                           install_java + prepare_node +
+                           WaitForBarrierStage(seed_0_barrier) + fetch_ddac +
+                           deploy_dse + SignalBarrierStage(seed_1_barrier))
+      dse_non_seed_script = (ScriptHeader('non-seed', *header_args) +
+                             install_java + prepare_node +
+                             WaitForBarrierStage(seed_1_barrier) + fetch_ddac +
+                             join_dse + ReadyStage() + register_node +
+                             ScriptFooter())
+
+    # Once all nodes of the datacenter are up and joined the cluster, seed 1
+    # signals it. Seed 1 of the last datacenter then waits for the others
+    # and starts the dev ops vm.
+    dse_seed_1_script += SharedStage(stages, WaitForClusterStage(
+        dse_non_seed_pool_igm, dc_region, dc_name))
+    if index < len(datacenters) - 1:
+      barriers.append(barrier_prefix + 'ready')
+      dse_seed_1_script += SignalBarrierStage(barrier_prefix + 'ready')
+    else:
+      for other_prefix in barrier_prefixes[:-1]:
+        dse_seed_1_script += WaitForBarrierStage(other_prefix + 'ready')
+      dse_seed_1_script += SignalBarrierStage('dev_ops')
+    dse_seed_1_script += ReadyStage() + register_node + ScriptFooter()
+
+    dse_subnet_properties = {
+        'name': dse_subnet,
+        'description': 'Subnetwork of %s in %s' % (ddac_network_name, dse_subnet),
+        'ipCidrRange': dc['cidr'],
+        'region': dc_region,
+        'network': ddac_network,
+    }
+    if not external_ip:
+      dse_subnet_properties['privateIpGoogleAccess'] = True
+    dse_templates = [
+        InstanceTemplate(name, machine_type,
+                         NetworkInterface(ddac_network,
+                                          '$(ref.%s.selfLink)' % dse_subnet,
+                                          nic_type, external_ip),
+                         [BootDisk(source_image)] + DseDataDisks(dc), scopes,
+                         dse_subnet, script)
+        for name, script in [(dse_seed_0_it, dse_seed_0_script),
+                             (dse_seed_1_it, dse_seed_1_script),
+                             (dse_non_seed_it, dse_non_seed_script)]]
+    dse_igms = [
+        InstanceGroupManager(dse_seed_0_igm, dc_region, prefix + '-dse',
+                             dse_seed_0_it, 1,
+                             UpdatePolicy(update_minimal_action,
+                                          len(zones) or 3),
+                             [functions_it]),
+        InstanceGroupManager(dse_seed_1_igm, dc_region, prefix + '-instance',
+                             dse_seed_1_it, 1,
+                             UpdatePolicy(update_minimal_action,
+                                          len(zones) or 3),
+                             [dse_seed_0_igm]),
+        InstanceGroupManager(dse_non_seed_pool_igm, dc_region,
+                             prefix + '-instance', dse_non_seed_it,
+                             dc['clusterSize'] - 2,
+                             UpdatePolicy(update_minimal_action,
+                                          len(zones) or 3),
+                             [dse_seed_1_igm])
+    ]
+    resources.append({
+        'name': dse_subnet,
+        'type': 'compute.v1.subnetwork',
+        'properties': dse_subnet_properties,
+        'metadata': {
+            'dependsOn': [
+                ddac_network_name,
+            ]
+        }
+    })
+    resources.extend(dse_templates + dse_igms)
+
+    for template in dse_templates:
+      template['properties']['properties']['metadata']['items'].append({
+          'key': 'shutdown-script',
+          'value': DSE_SHUTDOWN_SCRIPT
+      })
+
+    if stateful:
+      preserved_disks = ['vm-data-disk']
+      if 'commitlogDiskType' in dc:
+        preserved_disks.append('vm-commitlog-disk')
+      for igm in dse_igms:
+        igm['properties']['statefulPolicy'] = StatefulPolicy(preserved_disks)
+        # GCE only accepts stateful regional groups that never move
+        # instances between zones, whatever their update policy says
+        igm['properties'].setdefault('updatePolicy', {})[
+            'instanceRedistributionType'] = 'NONE'
+
+    if autohealing:
+      # Seeds can't replace themselves, so they are only autohealed when they
+      # come back with their data in stateful mode
+      for igm in dse_igms:
+        if stateful or igm['name'] == dse_non_seed_pool_igm:
+          igm['properties']['autoHealingPolicies'] = [{
+              'healthCheck': '$(ref.%s.selfLink)' % dse_health_check,
+              'initialDelaySec': context.properties.get(
+                  'autohealingInitialDelaySec',
+                  min(AUTOHEALING_MAX_DELAY_SEC,
+                      1800 + JOIN_SEC * (JoinRounds(
+                          dc['clusterSize'], join_in_slots,
+                          max_concurrent_joins) - 1)))
+          }]
+
+    if monitoring:
+      resources.append(Dashboard(prefix + '-dse-dashboard',
+                                 context.env['project'], cluster_name, dc_name))
+      resources.extend(AlertPolicies(
+          prefix, context.env['project'], cluster_name, dc_name,
+          context.properties.get('monitoringNotificationChannels', [])))
+
+    if autoscaling:
+      resources.append(Autoscaler(dse_non_seed_pool_as, dc_region,
+                                  dse_non_seed_pool_igm, dc))
+
+    if placement != 'none':
+      placement_policy = prefix + '-dse-placement'
+      ValidatePlacement(placement, machine_type, zones, max_nodes, domains)
+      resources.append(PlacementPolicy(placement_policy, dc_region, placement,
+                                       domains))
+      for template in dse_templates:
+        # Instance templates name their resource policies, they take no URL
+        template['properties']['properties']['resourcePolicies'] = [
+            placement_policy]
+        template['metadata'] = {'dependsOn': [placement_policy]}
+
+    if zones:
+      igm_zones = {
+          dse_seed_0_igm: zones[:1],
+          dse_seed_1_igm: [zones[1 % len(zones)]],
+          dse_non_seed_pool_igm: zones,
+      }
+      for igm in dse_igms:
+        igm['properties']['distributionPolicy'] = DistributionPolicy(
+            context.env['project'], igm_zones[igm['name']])
+
+  barriers.append('dev_ops')
+  if benchmark != 'none':
+    barriers.append('benchmark_done')
+
+  dev_ops_script = (ScriptHeader('dev-ops', functions_it, deployment_bucket,
+                                 barrier_backend, runtime_config,
+                                 max_concurrent_joins) +
+                    install_java + os_tuning + WaitForBarrierStage('dev_ops'))
+  if benchmark != 'none':
+    # The benchmark client comes with the install package, fetched while the
+    # artifacts_staged flag DevOpsStage removes still exists
+    dev_ops_script += fetch_ddac
+  dev_ops_script += SharedStage(stages, DevOpsStage())
+  if benchmark != 'none':
+    # The benchmark runs against the first datacenter
+    dev_ops_script += (SharedStage(stages, BenchmarkStage(
+        benchmark, context.properties.get('benchmarkThreads', 64),
+        benchmark_duration, ','.join(seed_ips[0]), first_dc['dcName'],
+        min(3, first_dc['clusterSize']))) +
+                       SignalBarrierStage('benchmark_done'))
+  dev_ops_script += ScriptFooter()
+
+  dev_ops_zones = first_dc.get('zones', [])
+  dev_ops_igm_resource = InstanceGroupManager(
+      dev_ops_igm, region, deployment + '-instance', dev_ops_it, 1,
+      UpdatePolicy(update_minimal_action, len(dev_ops_zones) or 3),
+      dse_non_seed_pool_igms)
+  if dev_ops_zones:
+    dev_ops_igm_resource['properties']['distributionPolicy'] = (
+        DistributionPolicy(context.env['project'], dev_ops_zones))
+  resources.extend([
+      BootstrapFunctionsTemplate(
+          functions_it, dev_ops_machine_type,
+          NetworkInterface(ddac_network,
+                           '$(ref.%s.selfLink)' % dse_subnets[0],
+                           nic_type, external_ip),
+          source_image, dse_subnets[0], stages),
+      InstanceTemplate(
+          dev_ops_it, dev_ops_machine_type,
+          NetworkInterface(ddac_network,
+                           '$(ref.%s.selfLink)' % dse_subnets[0],
+                           nic_type, external_ip),
+          [
+              BootDisk(source_image),
+              PersistentDisk('vm-data-disk',
+                             context.properties.get(
+                                 'devOpsDiskType', first_dc['dataDiskType']),
+                             context.properties.get(
+                                 'devOpsDiskSize', first_dc['dataDiskSize']))
+          ], scopes, dse_subnets[0], dev_ops_script),
+      dev_ops_igm_resource
+  ])
+
+  if tier_1:
+    for resource in resources:
+      if resource['type'] == 'compute.v1.instanceTemplate':
+        resource['properties']['properties']['networkPerformanceConfig'] = {
+            'totalEgressBandwidthTier': 'TIER_1'
+        }
+
+  # Pool nodes take turns joining the ring, so the deployment waits longer
+  # for large pools
+  cluster_ready_timeout = 0
+  for dc in datacenters:
+    cluster_ready_timeout += max(3600, 1800 + JOIN_SEC * JoinRounds(
+        dc['clusterSize'], join_in_slots, max_concurrent_joins))
+
+  if barrier_backend == 'runtimeconfig':
+    barrier_resources = [{
+        'name': runtime_config,
+        'type': 'runtimeconfig.v1beta1.config',
+        'properties': {
+            'config': runtime_config,
+            'description': 'Bootstrap barriers of %s' % deployment
+        }
+    }]
+    for barrier in barriers:
+      # Created as pending so that nodes can watch them for the update
+      barrier_resources.append({
+          'name': runtime_config + '-' + barrier.replace('_', '-'),
+          'type': 'runtimeconfig.v1beta1.variable',
           'properties': {
-              'properties': {
-                  'machineType':
-                      context.properties['machineType'],
-                  'networkInterfaces': [{
-                      'network': ddac_network,
-                      'subnetwork': '$(ref.%s.selfLink)' % dse_subnet,
-                      'accessConfigs': [{
-                          'name': 'External NAT',
-                          'type': 'ONE_TO_ONE_NAT'
-                      }]
-                  }],
-                  'disks': [{
-                      'deviceName': 'boot-disk',
-                      'type': 'PERSISTENT',
-                      'boot': True,
-                      'autoDelete': True,
-                      'initializeParams': {
-                          'sourceImage':
-                            URL_BASE + 'datastax-public/global/images/datastax-enterprise-ubuntu-1604-xenial-v20180824'
-                      }
-                    },
-                    {
-                      'deviceName': 'vm-data-disk',
-                      'type': 'PERSISTENT',
-                      'boot': False,
-                      'autoDelete': True,
-                      'initializeParams': {
-                          'diskType': context.properties['dataDiskType'],
-                          'diskSizeGb': context.properties['dataDiskSize']
-                      }
-                    }
-                  ],
-                  'serviceAccounts': [{
-                     'email': 'default',
-                     'scopes': ['https://www.googleapis.com/auth/compute', 'https://www.googleapis.com/auth/cloudruntimeconfig', 'https://www.googleapis.com/auth/devstorage.full_control']
-                  }],
-                  'metadata': {
-                      'dependsOn': [
-                          dse_subnet,
-                      ],
-                      'items': [ {
-                          'key': 'startup-script',
-                          'value': dse_non_seed_script
-                      }]
-                  }
-              }
+              'parent': '$(ref.%s.name)' % runtime_config,
+              'variable': 'barriers/' + barrier,
+              'text': 'pending'
           }
-      },
-      {   
-          # Create the Instance Template
-          'name': dev_ops_it,
-          'type': 'compute.v1.instanceTemplate',
+      })
+    waiters = [{
+        'name': cluster_ready_waiter,
+        'type': 'runtimeconfig.v1beta1.waiter',
+        'properties': {
+            'parent': '$(ref.%s.name)' % runtime_config,
+            'waiter': cluster_ready_waiter,
+            'timeout': '%ds' % cluster_ready_timeout,
+            'success': {
+                'cardinality': {
+                    'path': '/signalled/dev_ops',
+                    'number': 1
+                }
+            }
+        },
+        'metadata': {
+            'dependsOn': [
+                dse_seed_0_igms[0],
+            ]
+        }
+    }]
+    if benchmark != 'none':
+      # Populating, the run itself and installing the client
+      benchmark_timeout = 1800 + 2 * DurationSec(benchmark_duration)
+      waiters.append({
+          'name': benchmark_waiter,
+          'type': 'runtimeconfig.v1beta1.waiter',
           'properties': {
-              'properties': {
-                  'machineType':
-                      context.properties['machineType'],
-                  'networkInterfaces': [{
-                      'network': ddac_network,
-                      'subnetwork': '$(ref.%s.selfLink)' % dse_subnet,
-                      'accessConfigs': [{
-                          'name': 'External NAT',
-                          'type': 'ONE_TO_ONE_NAT'
-                      }]
-                  }],
-                  'disks': [{
-                      'deviceName': 'boot-disk',
-                      'type': 'PERSISTENT',
-                      'boot': True, 
-                      'autoDelete': True, 
-                      'initializeParams': {
-                          'sourceImage':
-                            URL_BASE + 'datastax-public/global/images/datastax-enterprise-ubuntu-1604-xenial-v20180824'
-                      }
-                    },
-                    { 
-                      'deviceName': 'vm-data-disk',
-                      'type': 'PERSISTENT',
-                      'boot': False,
-                      'autoDelete': True, 
-                      'initializeParams': {
-                          'diskType': context.properties['dataDiskType'],
-                          'diskSizeGb': context.properties['dataDiskSize']
-                      }
-                    }
-                  ],
-                  'serviceAccounts': [{
-                     'email': 'default',
-                     'scopes': ['https://www.googleapis.com/auth/compute', 'https://www.googleapis.com/auth/cloudruntimeconfig', 'https://www.googleapis.com/auth/devstorage.full_control']
-                  }],
-                  'metadata': {
-                      'dependsOn': [
-                          dse_subnet,
-                      ],
-                      'items': [ {
-                          'key': 'startup-script',
-                          'value': dev_ops_script
-                      }]
+              'parent': '$(ref.%s.name)' % runtime_config,
+              'waiter': benchmark_waiter,
+              'timeout': '%ds' % benchmark_timeout,
+              'success': {
+                  'cardinality': {
+                      'path': '/signalled/benchmark_done',
+                      'number': 1
                   }
               }
-          }
-      },
-      {
-          # Instance Group Manager
-          'name': dse_seed_0_igm,
-          'type': 'compute.v1.regionInstanceGroupManager',
-          'properties': {
-              'region': region,
-              'baseInstanceName': deployment + '-dse',
-              'instanceTemplate': '$(ref.%s.selfLink)' % dse_seed_0_it,
-              'targetSize': 1
-          }
-      },
-      {   
-          # Instance Group Manager
-          'name': dse_seed_1_igm,
-          'type': 'compute.v1.regionInstanceGroupManager',
-          'properties': {
-              'region': region,
-              'baseInstanceName': deployment + '-instance',
-              'instanceTemplate': '$(ref.%s.selfLink)' % dse_seed_1_it,
-              'targetSize': 1
-          },
-          'metadata': {
-              'dependsOn': [
-                   dse_seed_0_igm,
-              ]
-          }
-      },
-      {
-          # Instance Group Manager
-          'name': dse_non_seed_pool_igm,
-          'type': 'compute.v1.regionInstanceGroupManager',
-          'properties': {
-              'region': region,
-              'baseInstanceName': deployment + '-instance',
-              'instanceTemplate': '$(ref.%s.selfLink)' % dse_non_seed_it,
-              'targetSize': context.properties['clusterSize'] - 2
           },
           'metadata': {
               'dependsOn': [
-                   dse_seed_1_igm,
+                  cluster_ready_waiter,
               ]
           }
-      },
-      {
-          # Instance Group Manager
-          'name': dev_ops_igm,
-          'type': 'compute.v1.regionInstanceGroupManager',
-          'properties': {
-              'region': region,
-              'baseInstanceName': deployment + '-instance',
-              'instanceTemplate': '$(ref.%s.selfLink)' % dev_ops_it,
-              'targetSize': 1
-          },
-          'metadata': {
-              'dependsOn': [
-                   dse_non_seed_pool_igm,
-              ]
-          }
-      }
-  ]
+      })
+    # Nodes start signalling and waiting as soon as the seeds 0 boot
+    for resource in resources:
+      if resource['name'] in dse_seed_0_igms:
+        resource['metadata']['dependsOn'].extend(
+            r['name'] for r in barrier_resources)
+    resources.extend(barrier_resources + waiters)
 
   config['resources'] = resources
   outputs = [
@@ -580,7 +2448,7 @@ def GenerateConfig(context):
         },
         {
             'name': 'IG region',
-            'value': '$(ref.' + dse_seed_0_igm + '.region)'
+            'value': '$(ref.' + dse_seed_0_igms[0] + '.region)'
         },
         {
             'name': 'dse_seed_0_ip_addr',
@@ -591,7 +2459,24 @@ def GenerateConfig(context):
             'value': dse_seed_1_ip_addr
         }
   ]
+  if multi_dc:
+    # Seeds of all datacenters, for clients and nodes added by hand
+    outputs.append({
+        'name': 'seeds',
+        'value': seeds
+    })
+  if benchmark != 'none':
+    # Outputs are resolved when the resources are created, so they point at
+    # the summary the dev ops VM writes once the benchmark finished
+    outputs.append({
+        'name': 'benchmark_summary',
+        'value': 'gs://%s/benchmark/summary.json' % deployment_bucket
+    })
+    if barrier_backend == 'runtimeconfig':
+      outputs.append({
+          'name': 'benchmark_summary_variable',
+          'value': '%s/benchmark/summary' % runtime_config
+      })
   config['outputs'] = outputs
 
   return yaml.dump(config)
-
@@ -0,0 +1,646 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Tests of regional_igm.py and the bootstrap helpers of its scripts."""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+import regional_igm
+import simulate
+
+# gsutil stand-in over the directory $FAKE_GCS, honouring the
+# if-generation-match:0 precondition the join slots and restore claims are
+# taken with. Buckets were created at $FAKE_BUCKET_CREATED.
+FAKE_GSUTIL = '''#!/usr/bin/env bash
+precondition=
+while [ "${1#-}" != "$1" ]; do
+    case $1 in
+    -h) precondition=$2; shift 2 ;;
+    -o) shift 2 ;;
+    *) shift ;;
+    esac
+done
+command=$1
+shift
+[ "$1" = -a ] && shift
+object=$FAKE_GCS/${1#gs://}
+case $command in
+cp)
+    if [ "$1" = -I ]; then
+        while read source; do
+            cp $FAKE_GCS/${source#gs://} $2 || exit 1
+        done
+        exit 0
+    fi
+    object=$FAKE_GCS/${2#gs://}
+    [ -n "$precondition" ] && [ -e $object ] && exit 1
+    mkdir -p $(dirname $object)
+    if [ "$1" = - ]; then
+        cat > $object
+    else
+        cp $1 $object
+    fi
+    ;;
+rsync)
+    [ "$1" = -r ] && shift
+    mkdir -p $FAKE_GCS/${2#gs://}
+    cp -r $1/. $FAKE_GCS/${2#gs://}/
+    ;;
+ls)
+    if [ "$1" = -L ]; then
+        echo "    Time created:    ${FAKE_BUCKET_CREATED:-$(date)}"
+        exit 0
+    fi
+    # A trailing / lists the directory
+    [ "${object%/}" != "$object" ] && object=$object*
+    found=
+    for entry in $object; do
+        [ -e "$entry" ] || continue
+        [ -d "$entry" ] && entry=$entry/
+        echo "gs://${entry#$FAKE_GCS/}"
+        found=1
+    done
+    [ -n "$found" ]
+    ;;
+cat)
+    cat $object 2>/dev/null
+    ;;
+rm)
+    rm $object
+    ;;
+esac
+'''
+
+# Datacenter directory of the backups the restore tests read
+BACKUP = 'backups/c/dc-1'
+
+
+def WriteTool(directory, name, script):
+  """Installs an executable stand-in for a command in directory/bin."""
+  path = os.path.join(directory, 'bin', name)
+  if not os.path.isdir(os.path.dirname(path)):
+    os.mkdir(os.path.dirname(path))
+  with open(path, 'w') as f:
+    f.write(script)
+  os.chmod(path, 0o755)
+
+
+def Md5(content):
+  """Returns the hex md5 of a string."""
+  return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+class BootstrapFunctionsTest(unittest.TestCase):
+  """Runs the helpers in bash with the local barrier backend."""
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.dir)
+    with open(os.path.join(self.dir, 'functions.sh'), 'w') as f:
+      f.write(regional_igm.BOOTSTRAP_FUNCTIONS)
+    WriteTool(self.dir, 'gsutil', FAKE_GSUTIL)
+
+  def Bash(self, script, background=False):
+    """Runs script after the helpers, in the temporary directory."""
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(self.dir, 'bin') + ':' + env['PATH']
+    env['FAKE_GCS'] = os.path.join(self.dir, 'gcs')
+    prologue = '''
+        source functions.sh
+        role=non-seed
+        bootstrap_start=0
+        timing_log=timing.jsonl
+        barrier_backend=local
+        barrier_dir=barriers
+        deployment_bucket=bucket
+        max_concurrent_joins=2
+        join_slot_timeout=0
+        rejoin=
+        dse_data_mount=dse-data
+        dse_user=$(id -un)
+        sliced_download_options="-o GSUtil:sliced_object_download_threshold=32M"
+    '''
+    process = subprocess.Popen(['bash', '-c', prologue + script],
+                               cwd=self.dir, env=env,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    if background:
+      return process
+    output = process.communicate()[0].decode('utf-8')
+    self.assertEqual(process.returncode, 0, output)
+    return output
+
+  def testSignalledBarrierDoesNotBlock(self):
+    self.Bash('barrier_signal seed_0 && barrier_wait seed_0')
+    with open(os.path.join(self.dir, 'timing.jsonl')) as f:
+      self.assertIn('"phase": "signal_seed_0"', f.read())
+
+  def testWaitBlocksUntilSignalled(self):
+    waiter = self.Bash('barrier_wait seed_1', background=True)
+    time.sleep(2)
+    self.assertIsNone(waiter.poll())
+    self.Bash('barrier_signal seed_1')
+    waiter.communicate()
+    self.assertEqual(waiter.returncode, 0)
+
+  def testRejoinSkipsBarriers(self):
+    output = self.Bash('rejoin=1; barrier_wait never_signalled')
+    self.assertIn('rejoining, not waiting on barrier never_signalled', output)
+
+  def testJoinSlotsAreBounded(self):
+    output = self.Bash('''
+        for node in 1 2 3; do
+            acquire_join_slot
+            echo "slot=$join_slot"
+        done
+    ''')
+    self.assertEqual(
+        [line for line in output.splitlines() if line.startswith('slot=')],
+        ['slot=0', 'slot=1', 'slot='])
+    self.assertIn('joining without one', output)
+
+  def testReleasedJoinSlotIsReused(self):
+    output = self.Bash('''
+        acquire_join_slot
+        acquire_join_slot
+        join_slot=0
+        release_join_slot
+        acquire_join_slot
+        echo "slot=$join_slot"
+    ''')
+    self.assertIn('slot=0', output)
+
+  def testQueuedNodeAnswersHealthCheck(self):
+    output = self.Bash('''
+        port_open() {
+            python3 -c 'import socket; socket.create_connection(("127.0.0.1", %d), 2)' 2>/dev/null
+        }
+        hold_health_check
+        for attempt in $(seq 50); do port_open && break; sleep 0.1; done
+        port_open && echo held
+        release_health_check
+        port_open || echo released
+    ''' % regional_igm.DSE_NATIVE_PORT)
+    self.assertIn('held', output)
+    self.assertIn('released', output)
+
+  def Upload(self, node, files):
+    """Stores files of a backed-up node of dc-1 and returns their objects."""
+    objects = []
+    for name, content in sorted(files.items()):
+      objects.append('%s.%s' % (name, Md5(content)))
+      path = os.path.join(self.dir, 'gcs', BACKUP, node, 'data', objects[-1])
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write(content)
+    return objects
+
+  def Snapshot(self, node, tag, rack, tokens, files):
+    """Stores a snapshot of a backed-up node of dc-1."""
+    snapshot = os.path.join(self.dir, 'gcs', BACKUP, node, 'snapshots', tag)
+    os.makedirs(snapshot)
+    for name, content in [('manifest', '\n'.join(self.Upload(node, files))),
+                          ('rack', rack), ('tokens', tokens)]:
+      with open(os.path.join(snapshot, name), 'w') as f:
+        f.write(content + '\n')
+
+  def Incremental(self, node, tag, files):
+    """Stores an incremental backup of a backed-up node of dc-1."""
+    incremental = os.path.join(self.dir, 'gcs', BACKUP, node, 'incremental')
+    if not os.path.isdir(incremental):
+      os.makedirs(incremental)
+    with open(os.path.join(incremental, tag), 'w') as f:
+      f.write('\n'.join(self.Upload(node, files)) + '\n')
+
+  def Restore(self, snapshot='latest', rack='rack1'):
+    """Runs restore_node and returns its output."""
+    return self.Bash('rack=%s; restore_node gs://%s %s %d' % (
+        rack, BACKUP, snapshot, regional_igm.RESTORE_WINDOW_SEC))
+
+  def Restored(self, name):
+    """Returns the content of a restored file, or None."""
+    path = os.path.join(self.dir, 'dse-data', 'data', name)
+    if not os.path.exists(path):
+      return None
+    with open(path) as f:
+      return f.read()
+
+  def RestoreSettings(self):
+    """Returns the cassandra.yaml settings of the restore, if any."""
+    path = os.path.join(self.dir, 'dse-restore.yaml')
+    if not os.path.exists(path):
+      return None
+    with open(path) as f:
+      return f.read().splitlines()
+
+  def BackUpNodeA(self):
+    """Backs up node-a twice, reusing an SSTable name in between."""
+    self.Snapshot('node-a', '20200101000000', 'rack1', '1,2',
+                  {'ks/t-1/mc-1-big-Data.db': 'before truncate'})
+    self.Snapshot('node-a', '20200102000000', 'rack1', '3,4',
+                  {'ks/t-1/mc-1-big-Data.db': 'after truncate'})
+    self.Incremental('node-a', '20200101120000',
+                     {'ks/t-1/mc-2-big-Data.db': 'flushed before'})
+    self.Incremental('node-a', '20200102120000',
+                     {'ks/t-1/mc-3-big-Data.db': 'flushed after'})
+
+  def testRestoresTheLatestSnapshot(self):
+    self.BackUpNodeA()
+    self.assertIn('restoring gs://%s/node-a snapshot 20200102000000' % BACKUP,
+                  self.Restore())
+    self.assertEqual(self.Restored('ks/t-1/mc-1-big-Data.db'),
+                     'after truncate')
+    self.assertEqual(self.Restored('ks/t-1/mc-3-big-Data.db'), 'flushed after')
+    self.assertIsNone(self.Restored('ks/t-1/mc-2-big-Data.db'))
+    # The md5 suffix of the objects is dropped
+    self.assertEqual(sorted(os.listdir(os.path.join(
+        self.dir, 'dse-data', 'data', 'ks', 't-1'))),
+                     ['mc-1-big-Data.db', 'mc-3-big-Data.db'])
+    self.assertEqual(self.RestoreSettings(), [
+        'initial_token: 3,4', 'num_tokens: 2', 'auto_bootstrap: false'])
+
+  def testRestoresANamedSnapshot(self):
+    self.BackUpNodeA()
+    self.Restore('20200101000000')
+    self.assertEqual(self.Restored('ks/t-1/mc-1-big-Data.db'),
+                     'before truncate')
+    self.assertEqual(self.Restored('ks/t-1/mc-2-big-Data.db'), 'flushed before')
+    self.assertEqual(self.RestoreSettings()[0], 'initial_token: 1,2')
+
+  def testEveryBackedUpNodeIsClaimedOnce(self):
+    self.Snapshot('node-a', '20200101000000', 'rack1', '1', {'ks/t/a': 'a'})
+    self.Snapshot('node-b', '20200101000000', 'rack2', '2', {'ks/t/b': 'b'})
+    output = self.Restore(rack='rack2')
+    self.assertIn('restoring gs://%s/node-b' % BACKUP, output)
+    self.assertNotIn('another rack', output)
+    output = self.Restore(rack='rack2')
+    self.assertIn('restoring gs://%s/node-a' % BACKUP, output)
+    self.assertIn('was in another rack', output)
+    output = self.Restore(rack='rack2')
+    self.assertIn('no backed-up node left', output)
+    self.assertIsNone(self.RestoreSettings())
+
+  def testOldDeploymentsDoNotRestore(self):
+    self.BackUpNodeA()
+    output = self.Bash('export FAKE_BUCKET_CREATED="2000-01-01 00:00:00"; '
+                       'restore_node gs://%s latest %d' %
+                       (BACKUP, regional_igm.RESTORE_WINDOW_SEC))
+    self.assertIn('deployment older than', output)
+    self.assertIsNone(self.RestoreSettings())
+    self.assertFalse(os.path.exists(os.path.join(self.dir, 'gcs', 'bucket',
+                                                 'restore-claims')))
+
+  def testRejoinSkipsJoinSlots(self):
+    output = self.Bash('rejoin=1; acquire_join_slot; echo "slot=$join_slot"')
+    self.assertIn('slot=', output)
+    self.assertFalse(os.path.exists(os.path.join(self.dir, 'gcs')))
+
+  def testMissingStageStopsTheScript(self):
+    output = self.Bash('''
+        stage_known() { echo "ran known"; }
+        run_stage stage_known
+        (run_stage stage_gone; echo "ran past gone") || echo "stopped"
+    ''')
+    self.assertIn('ran known', output)
+    self.assertIn('stopped', output)
+    self.assertNotIn('ran past gone', output)
+
+
+# nodetool stand-in of a node in rack1 owning token 42, snapshotting the
+# SSTables of $DATA
+FAKE_NODETOOL = '''#!/usr/bin/env bash
+case "$1 $2" in
+"info -T") echo "Token                  : 42" ;;
+"info ") echo "Rack                   : rack1" ;;
+"snapshot -t")
+    for table in $DATA/*/*/; do
+        mkdir -p $table/snapshots/$3
+        ln $table/*.db $table/snapshots/$3/
+    done
+    ;;
+"clearsnapshot -t") rm -rf $DATA/*/*/snapshots/$3 ;;
+esac
+'''
+
+
+class DseBackupTest(unittest.TestCase):
+  """Runs the backup script against a fake data directory and bucket."""
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.dir)
+    WriteTool(self.dir, 'gsutil', FAKE_GSUTIL)
+    WriteTool(self.dir, 'nodetool', FAKE_NODETOOL)
+    self.mount = os.path.join(self.dir, 'mnt')
+    self.script = os.path.join(self.dir, 'dse-backup.sh')
+    with open(self.script, 'w') as f:
+      f.write(regional_igm.DseBackup('backups', 'c', 'dc-1')
+              .replace(regional_igm.DSE_HOME + '/bin/nodetool', 'nodetool')
+              .replace(regional_igm.DSE_DATA_MOUNT, self.mount)
+              .replace('/var/lock/', self.dir + '/'))
+    self.node = os.path.join(self.dir, 'gcs', BACKUP,
+                             socket.gethostname())
+
+  def Write(self, name, content):
+    """Writes a file below the DSE data directory."""
+    path = os.path.join(self.mount, 'data', name)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    if os.path.exists(path):
+      os.remove(path)
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def Run(self, kind):
+    """Runs a snapshot or incremental backup."""
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(self.dir, 'bin') + ':' + env['PATH']
+    env['FAKE_GCS'] = os.path.join(self.dir, 'gcs')
+    env['DATA'] = os.path.join(self.mount, 'data')
+    subprocess.check_call(['bash', self.script, kind], env=env)
+
+  def Read(self, *path):
+    """Returns the content of an object of the backed-up node."""
+    with open(os.path.join(self.node, *path)) as f:
+      return f.read()
+
+  def Manifests(self):
+    """Returns the object lists of the snapshots, oldest first."""
+    snapshots = os.path.join(self.node, 'snapshots')
+    return [self.Read('snapshots', tag, 'manifest').split()
+            for tag in sorted(os.listdir(snapshots))]
+
+  def testReusedNamesNeverReplaceUploadedObjects(self):
+    self.Write('ks/t-1/mc-1-big-Data.db', 'before truncate')
+    self.Write('system/local-1/mc-1-big-Data.db', 'node identity')
+    self.Run('snapshot')
+    # A truncate and restart later, DSE writes generation 1 again
+    time.sleep(1)
+    self.Write('ks/t-1/mc-1-big-Data.db', 'after truncate')
+    self.Run('snapshot')
+    manifests = self.Manifests()
+    self.assertEqual(manifests, [
+        ['ks/t-1/mc-1-big-Data.db.' + Md5('before truncate')],
+        ['ks/t-1/mc-1-big-Data.db.' + Md5('after truncate')]])
+    self.assertEqual(self.Read('data', manifests[0][0]), 'before truncate')
+    self.assertEqual(self.Read('data', manifests[1][0]), 'after truncate')
+    tag = sorted(os.listdir(os.path.join(self.node, 'snapshots')))[0]
+    self.assertEqual(self.Read('snapshots', tag, 'tokens'), '42\n')
+
+  def testIncrementalBackupUploadsAndUnlinksNewFiles(self):
+    self.Write('ks/t-1/backups/mc-2-big-Data.db', 'flushed')
+    self.Run('incremental')
+    incremental = os.listdir(os.path.join(self.node, 'incremental'))
+    self.assertEqual(len(incremental), 1)
+    self.assertEqual(self.Read('incremental', incremental[0]).split(),
+                     ['ks/t-1/mc-2-big-Data.db.' + Md5('flushed')])
+    self.assertFalse(os.listdir(os.path.join(self.mount, 'data', 'ks', 't-1',
+                                             'backups')))
+    # Later runs take the md5 of the file from the cache
+    with open(os.path.join(self.mount, 'backup-checksums')) as f:
+      self.assertIn(Md5('flushed'), f.read())
+
+
+# curl stand-in answering the metadata server and saving the posted time
+# series to $FAKE_POST
+FAKE_CURL = '''#!/usr/bin/env bash
+case "$*" in
+*/token) echo '{"access_token": "token"}' ;;
+*/zone) echo projects/1/zones/us-central1-a ;;
+*metadata.google.internal*) echo 1 ;;
+*) while [ "$1" != -d ]; do shift; done; echo "$2" > $FAKE_POST ;;
+esac
+'''
+
+
+class DseMetricsReporterTest(unittest.TestCase):
+  """Runs the reporter with the JMX readings of $FAKE_READINGS."""
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.dir)
+    WriteTool(self.dir, 'curl', FAKE_CURL)
+    WriteTool(self.dir, 'jrunscript',
+              '#!/usr/bin/env bash\ncat $FAKE_READINGS\n')
+    self.reporter = os.path.join(self.dir, 'dse-metrics.sh')
+    with open(self.reporter, 'w') as f:
+      f.write(regional_igm.DseMetricsReporter('cluster', 'dc').replace(
+          '/var/tmp/dse-metrics', os.path.join(self.dir, 'state')))
+
+  def Report(self, readings):
+    """Returns {metric: value} the reporter posts for the readings."""
+    with open(os.path.join(self.dir, 'readings'), 'w') as f:
+      f.write(''.join('%s %s\n' % reading for reading in readings))
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(self.dir, 'bin') + ':' + env['PATH']
+    env['FAKE_READINGS'] = os.path.join(self.dir, 'readings')
+    env['FAKE_POST'] = os.path.join(self.dir, 'post')
+    subprocess.check_call(['bash', self.reporter], env=env)
+    with open(env['FAKE_POST']) as f:
+      series = json.load(f)['timeSeries']
+    return dict((s['metric']['type'][len(regional_igm.DSE_METRIC_PREFIX):],
+                 s['points'][0]['value']['doubleValue']) for s in series)
+
+  def testCountersPublishTheirIncrease(self):
+    self.assertEqual(self.Report([('dropped_mutations', 40),
+                                  ('heap_used_mb', 512.5)]),
+                     {'dropped_mutations': 0, 'heap_used_mb': 512.5})
+    self.assertEqual(self.Report([('dropped_mutations', 45)]),
+                     {'dropped_mutations': 5})
+    self.assertEqual(self.Report([('dropped_mutations', 45)]),
+                     {'dropped_mutations': 0})
+    # DSE restarted
+    self.assertEqual(self.Report([('dropped_mutations', 3)]),
+                     {'dropped_mutations': 3})
+
+  def testEveryMetricIsRead(self):
+    script = regional_igm.DseMetricsReporter('cluster', 'dc')
+    for metric in regional_igm.DSE_METRICS:
+      self.assertIn("\nprint('%s ' + " % metric, script)
+    self.assertNotIn('nodetool', script)
+
+
+class GenerateConfigTest(unittest.TestCase):
+  """Checks the resources generated for the example deployment."""
+
+  def testUnknownMachineTypeKeepsDdacDefaults(self):
+    resources = simulate.ExampleResources(machineType='x9-standard-8')
+    script = simulate.BootScript(resources, 'sim-dse-non-seed-it')
+    self.assertIn('no tuning profile for x9-standard-8', script)
+    self.assertNotIn('-Xmx', script)
+
+  def testKnownMachineTypeIsTuned(self):
+    resources = simulate.ExampleResources(machineType='c3-standard-8')
+    script = simulate.BootScript(resources, 'sim-dse-non-seed-it')
+    self.assertNotIn('no tuning profile', script)
+    self.assertIn('-Xmx', script)
+
+  def testAutoscalerNeverRemovesNodes(self):
+    resources = simulate.ExampleResources(autoscalerMaxSize=10)
+    policy = resources['sim-dse-non-seed-pool-as']['properties'][
+        'autoscalingPolicy']
+    self.assertEqual(policy['mode'], 'ONLY_SCALE_OUT')
+    self.assertNotIn('scaleInControl', policy)
+    self.assertNotIn('update-autoscaling',
+                     simulate.BootScript(resources, 'sim-dse-non-seed-it'))
+
+  def testStatefulGroupsNeverRedistribute(self):
+    resources = simulate.ExampleResources(stateful=True)
+    for suffix in ['seed-0', 'seed-1', 'non-seed-pool']:
+      group = resources['sim-dse-%s-igm' % suffix]['properties']
+      self.assertIn('statefulPolicy', group)
+      self.assertEqual(group['updatePolicy']['instanceRedistributionType'],
+                       'NONE')
+
+  def AutohealingDelay(self, **properties):
+    """Returns the initial delay of the pool autohealing policy."""
+    properties.setdefault('clusterSize', 12)
+    resources = simulate.ExampleResources(autohealing=True, **properties)
+    return resources['sim-dse-non-seed-pool-igm']['properties'][
+        'autoHealingPolicies'][0]['initialDelaySec']
+
+  def testAutohealingDelayCoversTheJoinQueue(self):
+    self.assertEqual(self.AutohealingDelay(bootstrapMode='serial',
+                                           clusterSize=3), 1800)
+    self.assertEqual(self.AutohealingDelay(bootstrapMode='serial'),
+                     regional_igm.AUTOHEALING_MAX_DELAY_SEC)
+    self.assertEqual(self.AutohealingDelay(bootstrapMode='parallel',
+                                           maxConcurrentJoins=5),
+                     1800 + regional_igm.JOIN_SEC)
+    self.assertEqual(self.AutohealingDelay(bootstrapMode='parallel',
+                                           maxConcurrentJoins=1),
+                     regional_igm.AUTOHEALING_MAX_DELAY_SEC)
+    self.assertEqual(self.AutohealingDelay(autohealingInitialDelaySec=600),
+                     600)
+
+  def testQueuedNodesHoldTheHealthCheck(self):
+    for mode in ['serial', 'parallel']:
+      resources = simulate.ExampleResources(autohealing=True,
+                                            bootstrapMode=mode)
+      self.assertIn('hold_health_check',
+                    simulate.BootScript(resources, 'sim-dse-non-seed-it'))
+    resources = simulate.ExampleResources(bootstrapMode='parallel')
+    self.assertNotIn('hold_health_check',
+                     simulate.BootScript(resources, 'sim-dse-non-seed-it'))
+
+  def testStressSettingsPrecedeItsOptions(self):
+    for workload in ['write', 'read', 'mixed']:
+      resources = simulate.ExampleResources(benchmarkWorkload=workload)
+      runs = [line.split() for line in
+              simulate.BootScript(resources, 'sim-dev-ops-it').splitlines()
+              if line.strip().startswith('$stress ')]
+      self.assertEqual(len(runs), 1 if workload == 'write' else 2)
+      for words in runs:
+        first_option = min(i for i, word in enumerate(words)
+                           if word.startswith('-'))
+        self.assertIn('cl=LOCAL_QUORUM', words[:first_option])
+        self.assertTrue([w for w in words[:first_option]
+                         if w.startswith(('n=', 'duration='))])
+        self.assertEqual(words[first_option + 1:].count('cl=LOCAL_QUORUM'), 0)
+
+  def testClusterReadyWaiterOutlastsSerialPools(self):
+    # Autohealed pools join through the join slots, also in serial mode
+    for autohealing in [False, True]:
+      for size in [3, 15, 50, 100]:
+        properties = dict(simulate.ExampleProperties(), clusterSize=size,
+                          bootstrapMode='serial', autohealing=autohealing)
+        waiter = simulate.ExampleResources(**properties)[
+            'sim-cluster-ready-waiter']
+        timeout = int(waiter['properties']['timeout'].rstrip('s'))
+        ready = simulate.Simulate(properties, 5, 1,
+                                  simulate.DEFAULT_DURATIONS)
+        self.assertGreater(timeout, ready['p95'], (size, autohealing))
+
+  def testScriptsDefineTheirRegion(self):
+    resources = simulate.ExampleResources(clusterSize=4)
+    for name, resource in sorted(resources.items()):
+      if resource['type'] != 'compute.v1.instanceTemplate':
+        continue
+      lines = simulate.BootScript(resources, name).splitlines()
+      uses = [i for i, line in enumerate(lines)
+              if re.search(r'\$\{?region\b', line)]
+      definitions = [i for i, line in enumerate(lines)
+                     if re.match(r'\s*region=\S', line)]
+      for use in uses:
+        self.assertTrue([i for i in definitions if i < use],
+                        '%s uses an undefined $region: %s' %
+                        (name, lines[use]))
+    self.assertIn('--region $region',
+                  simulate.BootScript(resources, 'sim-dse-seed-1-it'))
+
+  def testGcsBarriersRejectNodesAddedLater(self):
+    for properties in [{'autohealing': True}, {'autoscalerMaxSize': 10}]:
+      self.assertRaises(ValueError, simulate.ExampleResources,
+                        barrierBackend='gcs', **properties)
+
+  def testTier1OnEveryListedFamily(self):
+    for machine_type in ['n2-standard-32', 'c2d-highmem-32', 'c3-standard-44',
+                         'm3-megamem-64', 'n2-custom-32-131072']:
+      regional_igm.ValidateNetworking(machine_type, 'GVNIC', True)
+    for machine_type in ['c3-standard-22', 'n1-standard-32', 'e2-standard-32']:
+      self.assertRaises(ValueError, regional_igm.ValidateNetworking,
+                        machine_type, 'GVNIC', True)
+
+  def testGvnicNeedsAnImageOfTheUsersOwn(self):
+    image = 'global/images/ddac-gvnic'
+    self.assertRaises(ValueError, simulate.ExampleResources, nicType='GVNIC')
+    self.assertRaises(ValueError, simulate.ExampleResources, nicType='GVNIC',
+                      imageMode='prebaked')
+    self.assertRaises(ValueError, simulate.ExampleResources, nicType='GVNIC',
+                      prebakedImage=image)
+    resources = simulate.ExampleResources(nicType='GVNIC',
+                                          imageMode='prebaked',
+                                          prebakedImage=image)
+    interface = resources['sim-dse-non-seed-it']['properties']['properties'][
+        'networkInterfaces'][0]
+    self.assertEqual(interface['nicType'], 'GVNIC')
+
+  def testBenchmarkFetchesBeforeTheFlagsAreRemoved(self):
+    for image_mode in ['install', 'prebaked']:
+      resources = simulate.ExampleResources(barrierBackend='gcs',
+                                            imageMode=image_mode,
+                                            benchmarkWorkload='write')
+      script = simulate.BootScript(resources, 'sim-dev-ops-it')
+      flags_removed = script.index('gsutil rm gs://$deployment_bucket/*')
+      self.assertLess(script.index('barrier_wait artifacts_staged'),
+                      flags_removed)
+      self.assertLess(script.index('phase_begin fetch_ddac'), flags_removed)
+      self.assertGreater(script.index('phase_begin benchmark'), flags_removed)
+
+
+  def testRoleScriptsOnlyRunSharedStages(self):
+    resources = simulate.ExampleResources(
+        datacenters=[{'name': 'dc1'}, {'name': 'dc2'}], monitoring=True,
+        backupBucket='backups', benchmarkWorkload='write')
+    helpers = resources['sim-bootstrap-functions-it']['properties'][
+        'properties']['metadata']['items'][0]['value']
+    defined = re.findall(r'^      (stage_\w+)\(\) \{$', helpers, re.M)
+    self.assertEqual(len(defined), len(set(defined)))
+    called = set()
+    for name, resource in sorted(resources.items()):
+      if resource['type'] != 'compute.v1.instanceTemplate':
+        continue
+      script = simulate.StartupScript(resource)
+      called.update(re.findall(r'^      run_stage (\w+)$', script, re.M))
+      # Only the barriers and join slots stay in the scripts of the roles
+      for phase in re.findall(r'phase_begin (\w+)', script):
+        self.assertTrue(phase.startswith('wait_') or phase == 'join_slot',
+                        (name, phase))
+      subprocess.check_call(['bash', '-n', '-c', script])
+    self.assertEqual(called, set(defined))
+    subprocess.check_call(['bash', '-n', '-c', helpers])
+    # Both datacenters install Java the same way, and tune their own DSE
+    self.assertEqual(len([n for n in defined if 'install_java' in n]), 1)
+    self.assertEqual(len([n for n in defined if 'deploy_dse' in n]), 2)
+
+if __name__ == '__main__':
+  unittest.main()
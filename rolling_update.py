@@ -0,0 +1,166 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Rolls a template change over the DSE nodes one zone at a time.
+
+    python rolling_update.py --project my-project --deployment my-cluster
+
+After a deployment update changed an instance template, the instance groups
+only record the new template. This recreates the outdated DSE nodes zone by
+zone, at most --per-zone nodes at a time, going through the datacenters of
+a multi-region deployment one zone after another. With zones mapped to
+racks, one replica of each range is down at most, so LOCAL_QUORUM stays
+available. The
+shutdown script drains every node before it stops. The next batch starts
+once the recreated nodes uploaded a timing log showing they are UN again.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import time
+
+import regional_igm
+
+# Instance groups of a datacenter in rollout order, the dev ops VM last
+IGM_SUFFIXES = ['-dse-seed-0-igm', '-dse-seed-1-igm', '-dse-non-seed-pool-igm',
+                '-dev-ops-igm']
+POLL_SEC = 30
+
+
+def Gcloud(project, args):
+  """Runs a gcloud command in the project and returns its JSON output."""
+  output = subprocess.check_output(['gcloud'] + args + ['--project', project,
+                                                        '--format', 'json'])
+  return json.loads(output.decode('utf-8') or 'null')
+
+
+def BaseName(url):
+  """Returns the last path segment of a resource URL."""
+  return url.rsplit('/', 1)[-1]
+
+
+def ManagedGroups(project, deployment, region):
+  """Returns [(igm, region)] of the instance groups of the deployment.
+
+  With region, only the groups of that region are returned.
+  """
+  resources = Gcloud(project, ['deployment-manager', 'resources', 'list',
+                      '--deployment', deployment])
+  groups = []
+  for resource in resources or []:
+    if resource['type'] != 'compute.v1.regionInstanceGroupManager':
+      continue
+    group_region = resource['url'].split('/regions/')[1].split('/')[0]
+    if region and group_region != region:
+      continue
+    order = [i for i, suffix in enumerate(IGM_SUFFIXES)
+             if resource['name'].endswith(suffix)]
+    groups.append((order[0] if order else len(IGM_SUFFIXES),
+                   resource['name'], group_region))
+  return [(igm, group_region) for _, igm, group_region in sorted(groups)]
+
+
+def OutdatedInstances(project, igm, region, force):
+  """Returns [(zone, instance)] of the group not on its current template."""
+  group = Gcloud(project, ['compute', 'instance-groups', 'managed',
+                           'describe', igm, '--region', region])
+  if not (force or 'statefulPolicy' in group or
+          'autoHealingPolicies' in group or igm.endswith('-dev-ops-igm')):
+    raise SystemExit('%s keeps no data across recreation and its nodes do '
+                     'not replace themselves; deploy with stateful or '
+                     'autohealing, or pass --force' % igm)
+  template = BaseName(group['instanceTemplate'])
+  instances = Gcloud(project, ['compute', 'instance-groups', 'managed',
+                               'list-instances', igm, '--region', region])
+  outdated = []
+  for instance in instances or []:
+    if BaseName(instance['version']['instanceTemplate']) != template:
+      url = instance['instance']
+      outdated.append((url.split('/zones/')[1].split('/')[0], BaseName(url)))
+  return sorted(outdated)
+
+
+def IsReady(bucket, instance, since):
+  """Returns whether the instance finished a bootstrap started after since."""
+  try:
+    log = subprocess.check_output(
+        ['gsutil', '-q', 'cat', 'gs://%s/timing/%s.jsonl' % (bucket, instance)],
+        stderr=subprocess.STDOUT)
+  except subprocess.CalledProcessError:
+    return False
+  for line in log.decode('utf-8').splitlines():
+    record = json.loads(line)
+    if (record['phase'] == 'bootstrap' and record['boot'] >= since and
+        record['status'] == 'ok'):
+      return True
+  return False
+
+
+def Recreate(project, igm, region, instances, minimal_action):
+  """Applies the current template of the group to some of its instances."""
+  subprocess.check_call([
+      'gcloud', 'compute', 'instance-groups', 'managed', 'update-instances',
+      igm, '--project', project, '--region', region,
+      '--instances', ','.join(instances),
+      '--minimal-action', minimal_action,
+      '--most-disruptive-allowed-action', minimal_action])
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--project', required=True)
+  parser.add_argument('--deployment', required=True)
+  parser.add_argument('--region',
+                      help='Only roll the instance groups of this region')
+  parser.add_argument('--per-zone', type=int, default=1,
+                      help='Nodes of a zone recreated at the same time')
+  # refresh applies a change without rebooting, so the node would never log
+  # a new bootstrap and the rollout would wait out --timeout on it
+  parser.add_argument('--minimal-action', default='replace',
+                      choices=['restart', 'replace'],
+                      help='Least disruptive action applying the change')
+  parser.add_argument('--timeout', type=int, default=3600,
+                      help='Seconds a recreated node may take to be UN')
+  parser.add_argument('--force', action='store_true',
+                      help='Also recreate nodes that lose their data')
+  parser.add_argument('--dry-run', action='store_true',
+                      help='Only list the batches')
+  args = parser.parse_args()
+
+  bucket = regional_igm.DeploymentBucket(args.project, args.deployment)
+  by_zone = {}
+  for igm, region in ManagedGroups(args.project, args.deployment,
+                                   args.region):
+    for zone, instance in OutdatedInstances(args.project, igm, region,
+                                            args.force):
+      by_zone.setdefault(zone, []).append((igm, region, instance))
+  if not by_zone:
+    print('all nodes run their current template')
+    return
+
+  for zone in sorted(by_zone):
+    nodes = by_zone[zone]
+    for start in range(0, len(nodes), args.per_zone):
+      batch = nodes[start:start + args.per_zone]
+      print('%s: recreating %s' % (zone, ', '.join(i for _, _, i in batch)))
+      if args.dry_run:
+        continue
+      since = int(time.time())
+      for igm, region in sorted(set((igm, region) for igm, region, _ in batch)):
+        Recreate(args.project, igm, region,
+                 [i for g, _, i in batch if g == igm], args.minimal_action)
+      deadline = since + args.timeout
+      pending = [i for igm, _, i in batch if not igm.endswith('-dev-ops-igm')]
+      while pending:
+        if time.time() > deadline:
+          raise SystemExit('%s not back after %ds, stopping the rollout' %
+                           (', '.join(pending), args.timeout))
+        time.sleep(POLL_SEC)
+        pending = [i for i in pending if not IsReady(bucket, i, since)]
+      print('%s: back' % zone)
+
+
+if __name__ == '__main__':
+  main()
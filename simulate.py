@@ -0,0 +1,576 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Simulates the provisioning of a deployment offline.
+
+    python simulate.py --size 25 --set bootstrapMode=serial
+    python simulate.py --benchmark --sizes 3,12,50,100 --json bench.json
+    python simulate.py --benchmark --baseline bench.json
+    python simulate.py --generation --sizes 3,100,1000
+
+Runs GenerateConfig against a fake Deployment Manager context built from the
+example regional_igm.yaml, turns the resources into a dependency DAG and the
+startup scripts into their phases, barriers and join slots, and replays it all
+as a discrete event simulation with randomized phase durations. Nothing is
+deployed and no network is needed, so every template change can be checked
+for its effect on the time until the cluster is ready. --generation instead
+measures GenerateConfig itself, its time and the size of what it generates.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import timeit
+
+import yaml
+
+import regional_igm
+
+# Durations of the startup script phases and of creating each resource type,
+# in seconds, as ('lognormal', median, sigma) or ('uniform', low, high)
+DEFAULT_DURATIONS = {
+    # Node phases
+    'vm_boot': ('lognormal', 40, 0.2),
+    'install_java': ('lognormal', 90, 0.3),
+    'stage_artifacts': ('lognormal', 5, 0.3),
+    'fetch_ddac': ('lognormal', 20, 0.4),
+    'unpack_ddac': ('lognormal', 5, 0.2),
+    'prebaked': ('lognormal', 3, 0.2),
+    'deploy_dse': ('lognormal', 150, 0.2),
+    'dev_ops_install': ('lognormal', 125, 0.05),
+    'benchmark': ('lognormal', 420, 0.1),
+    # Downloading the SSTables of a backed-up node in restoreFrom mode
+    'restore_data': ('lognormal', 300, 0.4),
+    # Streaming a non-seed node's ranges once DSE runs, stretched by every
+    # other node streaming at the same time
+    'join_streaming': ('lognormal', 120, 0.3),
+    # A node refused to bootstrap while another one does, restarting DSE
+    # once the ring is clear
+    'bootstrap_retry': ('lognormal', 90, 0.3),
+    'phase': ('lognormal', 5, 0.3),
+    # Delay between a barrier signal and a waiting node noticing it
+    'barrier_runtimeconfig': ('uniform', 0.5, 2),
+    'barrier_gcs': ('uniform', 1, 11),
+    'barrier_local': ('uniform', 0, 1),
+    # Resource creation
+    'storage.v1.bucket': ('lognormal', 3, 0.3),
+    'compute.v1.network': ('lognormal', 25, 0.2),
+    'compute.v1.subnetwork': ('lognormal', 15, 0.2),
+    'compute.v1.firewalls': ('lognormal', 10, 0.2),
+    'compute.v1.instanceTemplate': ('lognormal', 3, 0.2),
+    'compute.v1.regionInstanceGroupManager': ('lognormal', 15, 0.2),
+    'runtimeconfig.v1beta1.config': ('lognormal', 2, 0.2),
+    'runtimeconfig.v1beta1.variable': ('lognormal', 1, 0.2),
+    'runtimeconfig.v1beta1.waiter': ('lognormal', 1, 0.2),
+    'resource': ('lognormal', 5, 0.3),
+}
+
+# Extra streaming time per other node streaming at the same time
+JOIN_CONTENTION = 0.25
+# Poll interval of the nodetool status loop of seed 1
+CLUSTER_POLL_SEC = 10
+
+# Strategies the benchmark compares, as properties over the example
+STRATEGIES = collections.OrderedDict([
+    ('serial', {'bootstrapMode': 'serial'}),
+    ('parallel', {'bootstrapMode': 'parallel', 'maxConcurrentJoins': 1}),
+    ('parallel-joins-4', {'bootstrapMode': 'parallel',
+                          'maxConcurrentJoins': 4}),
+    ('parallel-prebaked', {'bootstrapMode': 'parallel',
+                           'maxConcurrentJoins': 4, 'imageMode': 'prebaked'}),
+])
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'regional_igm.yaml')
+
+
+class FakeContext(object):
+  """The parts of the Deployment Manager context GenerateConfig reads."""
+
+  def __init__(self, properties, deployment='sim', project='sim-project'):
+    self.env = {'deployment': deployment, 'project': project,
+                'name': 'dse-cluster'}
+    self.properties = properties
+
+
+def ExampleProperties():
+  """Returns the properties of the example deployment."""
+  with open(EXAMPLE) as f:
+    return dict(yaml.safe_load(f)['resources'][0]['properties'])
+
+
+def Generate(properties):
+  """Returns the resources GenerateConfig yields for the properties."""
+  return yaml.safe_load(
+      regional_igm.GenerateConfig(FakeContext(properties)))['resources']
+
+
+def ExampleResources(**properties):
+  """Returns {name: resource} of the example with properties changed."""
+  example = ExampleProperties()
+  example.update(properties)
+  return dict((r['name'], r) for r in Generate(example))
+
+
+def StartupScript(resource):
+  """Returns the startup script of an instance template resource."""
+  for item in resource['properties']['properties']['metadata']['items']:
+    if item['key'] == 'startup-script':
+      return item['value']
+  return ''
+
+
+def BootScript(by_name, template):
+  """Returns the startup script of the named instance template, with the
+  stages it runs from the bootstrap helpers inlined."""
+  stages = {}
+  for resource in by_name.values():
+    if resource['type'] != 'compute.v1.instanceTemplate':
+      continue
+    for item in resource['properties']['properties']['metadata']['items']:
+      if item['key'] == regional_igm.BOOTSTRAP_FUNCTIONS_KEY:
+        stages.update(re.findall(
+            r'^      (stage_\w+)\(\) \{\n(.*?)^      \}\n'
+            r'(?=\n      stage_\w+\(\) \{|\Z)', item['value'], re.M | re.S))
+  return re.sub(r'^      run_stage (\w+)\n',
+                lambda match: stages[match.group(1)],
+                StartupScript(by_name[template]), flags=re.M)
+
+
+def InstanceTemplate(igm):
+  """Returns the name of the instance template of an instance group."""
+  return re.search(r'\$\(ref\.([^.)]+)',
+                   igm['properties']['instanceTemplate']).group(1)
+
+
+def ScriptDc(script):
+  """Returns the datacenter a startup script deploys DSE into, if any."""
+  match = re.search(r'^\s*dc_name=(\S+)$', script, re.M)
+  return match.group(1) if match else None
+
+
+def ParseScript(script, prebaked):
+  """Returns the steps of a startup script.
+
+  Steps are ('phase', name, body) for every phase_begin..phase_end block
+  and ('signal', barrier) / ('release', None) for the barrier signals and
+  join slot releases outside of phases. Phases that signal a barrier keep
+  the signal in their body. The prebaked image check takes the
+  prebaked branch when prebaked is set, else its install fallback.
+  """
+  steps = []
+  body = None
+  skipping = False
+  for line in script.split('\n'):
+    line = line.strip()
+    if line.startswith('if [ "$(cat ' + regional_igm.PREBAKED_DIR):
+      skipping = not prebaked
+      continue
+    if line == 'else' and body is None:
+      skipping = prebaked
+      continue
+    if line == 'fi' and body is None:
+      skipping = False
+      continue
+    if skipping:
+      continue
+    if body is not None:
+      if line == 'phase_end':
+        steps.append(('phase', name, body))
+        body = None
+      else:
+        body.append(line)
+      continue
+    match = re.match(r'^phase_begin (\w+)$', line)
+    if match:
+      name, body = match.group(1), []
+    elif line.startswith('barrier_signal '):
+      steps.append(('signal', line.split()[1]))
+    elif line == 'release_join_slot':
+      steps.append(('release', None))
+  return steps
+
+
+class Simulation(object):
+  """Discrete event simulation of processes written as generators.
+
+  A process yields ('sleep', seconds), ('wait', (event, latency)),
+  ('signal', event), ('acquire', semaphore) or ('release', semaphore). The
+  join_slots semaphore has the maxConcurrentJoins slots, the bootstrap one
+  admits one bootstrapping node at a time.
+  """
+
+  def __init__(self, rng, durations, max_concurrent_joins):
+    self.rng = rng
+    self.durations = durations
+    self.now = 0.0
+    self.signalled = {}
+    # UN and expected DSE nodes per datacenter
+    self.normal_nodes = collections.Counter()
+    self.cluster_size = collections.Counter()
+    self.streaming = 0
+    self._queue = []
+    self._order = itertools.count()
+    self._waiters = collections.defaultdict(list)
+    self._free = {'join_slots': max_concurrent_joins, 'bootstrap': 1}
+    self._semaphore_waiters = collections.defaultdict(collections.deque)
+    self._running = set()
+
+  def Sample(self, key, default):
+    """Returns a random duration for the key of the durations table."""
+    distribution = self.durations.get(key, self.durations[default])
+    if distribution[0] == 'uniform':
+      return self.rng.uniform(distribution[1], distribution[2])
+    return distribution[1] * self.rng.lognormvariate(0, distribution[2])
+
+  def Start(self, process):
+    self._running.add(process)
+    self._Schedule(self.now, process)
+
+  def Run(self):
+    """Runs until no process can make progress."""
+    while self._queue:
+      self.now, _, process = heapq.heappop(self._queue)
+      self._Step(process)
+    if self._running:
+      blocked = sorted(event for event in self._waiters if self._waiters[event])
+      blocked.extend(sorted(semaphore for semaphore in self._semaphore_waiters
+                            if self._semaphore_waiters[semaphore]))
+      raise RuntimeError('Simulation stalled waiting on %s' %
+                         ', '.join(blocked))
+
+  def _Schedule(self, at, process):
+    heapq.heappush(self._queue, (at, next(self._order), process))
+
+  def _Step(self, process):
+    try:
+      kind, arg = next(process)
+    except StopIteration:
+      self._running.discard(process)
+      return
+    if kind == 'sleep':
+      self._Schedule(self.now + arg, process)
+    elif kind == 'wait':
+      event, latency = arg
+      if event in self.signalled:
+        self._Schedule(self.now + latency, process)
+      else:
+        self._waiters[event].append((process, latency))
+    elif kind == 'signal':
+      self.signalled.setdefault(arg, self.now)
+      for waiter, latency in self._waiters.pop(arg, []):
+        self._Schedule(self.now + latency, waiter)
+      self._Schedule(self.now, process)
+    elif kind == 'acquire':
+      if self._free[arg] > 0:
+        self._free[arg] -= 1
+        self._Schedule(self.now, process)
+      else:
+        self._semaphore_waiters[arg].append(process)
+    elif kind == 'release':
+      if self._semaphore_waiters[arg]:
+        self._Schedule(self.now, self._semaphore_waiters[arg].popleft())
+      else:
+        self._free[arg] += 1
+      self._Schedule(self.now, process)
+
+
+class Node(object):
+  """A VM of an instance group running its startup script.
+
+  Unless its script turns consistent range movement off, Cassandra refuses
+  to bootstrap the node while another one bootstraps.
+  """
+
+  def __init__(self, name, role, dc, steps, concurrent_bootstrap=False):
+    self.name = name
+    self.role = role
+    self.dc = dc
+    self.steps = steps
+    self.concurrent_bootstrap = concurrent_bootstrap
+    self.normal_at = None
+    self.done_at = None
+
+
+def NodeProcess(sim, node, barrier_backend, finished):
+  """Yields the requests of a node booting and running its startup script."""
+  yield ('sleep', sim.Sample('vm_boot', 'phase'))
+  holds_slot = False
+  for step in node.steps:
+    if step[0] == 'signal':
+      yield ('signal', 'barrier:' + step[1])
+      continue
+    if step[0] == 'release':
+      if holds_slot:
+        holds_slot = False
+        yield ('release', 'join_slots')
+      continue
+    name, body = step[1], ' '.join(step[2])
+    barrier = re.search(r'barrier_wait (\w+)', body)
+    if barrier:
+      latency = sim.Sample('barrier_' + barrier_backend, 'phase')
+      yield ('wait', ('barrier:' + barrier.group(1), latency))
+    elif 'acquire_join_slot' in body:
+      holds_slot = True
+      yield ('acquire', 'join_slots')
+    elif 'nodetool status' in body:
+      while sim.normal_nodes[node.dc] < sim.cluster_size[node.dc]:
+        yield ('sleep', CLUSTER_POLL_SEC)
+    elif 'wait_for_local_normal' in body:
+      while node.normal_at is None:
+        yield ('sleep', CLUSTER_POLL_SEC)
+    elif 'deploy-dse.sh' in body:
+      yield ('sleep', sim.Sample(name, 'phase'))
+      sim.Start(JoinProcess(sim, node))
+    else:
+      yield ('sleep', sim.Sample(name, 'phase'))
+    for signalled in re.findall(r'barrier_signal (\w+)', body):
+      yield ('signal', 'barrier:' + signalled)
+  node.done_at = sim.now
+  finished.append(node)
+
+
+def JoinProcess(sim, node):
+  """Yields the requests of a started DSE node becoming UN.
+
+  A node refused to bootstrap next to another one only gets in once that
+  one is done, and pays a DSE restart for it.
+  """
+  if node.role.startswith('non-seed'):
+    if not node.concurrent_bootstrap:
+      started = sim.now
+      yield ('acquire', 'bootstrap')
+      if sim.now > started:
+        yield ('sleep', sim.Sample('bootstrap_retry', 'phase'))
+    sim.streaming += 1
+    streaming = sim.Sample('join_streaming', 'phase')
+    yield ('sleep', streaming * (1 + JOIN_CONTENTION * (sim.streaming - 1)))
+    sim.streaming -= 1
+    if not node.concurrent_bootstrap:
+      yield ('release', 'bootstrap')
+  node.normal_at = sim.now
+  sim.normal_nodes[node.dc] += 1
+
+
+def Dependencies(resource):
+  """Returns the names of the resources a resource waits for."""
+  depends = set(resource.get('metadata', {}).get('dependsOn', []))
+  depends.update(re.findall(r'\$\(ref\.([^.)]+)',
+                            json.dumps(resource['properties'])))
+  return sorted(depends)
+
+
+def ResourceProcess(sim, resource, spawn):
+  """Yields the requests of Deployment Manager creating a resource."""
+  for dependency in Dependencies(resource):
+    yield ('wait', ('resource:' + dependency, 0))
+  yield ('sleep', sim.Sample(resource['type'], 'resource'))
+  if resource['type'] == 'runtimeconfig.v1beta1.waiter':
+    path = resource['properties']['success']['cardinality']['path']
+    yield ('wait', ('barrier:' + path.split('/')[-1], 1))
+  elif resource['type'].endswith('InstanceGroupManager'):
+    spawn(resource)
+  yield ('signal', 'resource:' + resource['name'])
+
+
+def SimulateOnce(resources, properties, rng, durations):
+  """Returns the timeline of one simulated deployment.
+
+  The timeline has the deployment_done time of Deployment Manager, the
+  cluster_ready time of the last node becoming UN and the bootstrap_done
+  time of the last startup script, plus the barrier signal times.
+  """
+  by_name = dict((r['name'], r) for r in resources)
+  sim = Simulation(rng, durations, properties.get('maxConcurrentJoins', 1))
+  barrier_backend = properties.get('barrierBackend', 'runtimeconfig')
+  prebaked = properties.get('imageMode', 'install') == 'prebaked'
+  nodes = []
+  finished = []
+
+  def Spawn(igm):
+    template = InstanceTemplate(igm)
+    role = re.sub(r'^.*?-((dse-)?(seed-\d|non-seed|dev-ops))-it$', r'\3',
+                  template)
+    script = BootScript(by_name, template)
+    dc = ScriptDc(script)
+    steps = ParseScript(script, prebaked)
+    concurrent_bootstrap = 'consistent.rangemovement=false' in script
+    for index in range(igm['properties']['targetSize']):
+      name = '%s-%d' % (role, index)
+      if dc:
+        name = dc + '-' + name
+      node = Node(name, role, dc, steps, concurrent_bootstrap)
+      nodes.append(node)
+      sim.Start(NodeProcess(sim, node, barrier_backend, finished))
+
+  for resource in resources:
+    if (resource['type'].endswith('InstanceGroupManager') and
+        '-dse-' in resource['name']):
+      dc = ScriptDc(BootScript(by_name, InstanceTemplate(resource)))
+      sim.cluster_size[dc] += resource['properties']['targetSize']
+    sim.Start(ResourceProcess(sim, resource, Spawn))
+  sim.Run()
+
+  deployment_done = max(sim.signalled['resource:' + r['name']]
+                        for r in resources)
+  dse_nodes = [n for n in nodes if n.role != 'dev-ops']
+  return {
+      'deployment_done': deployment_done,
+      'cluster_ready': max(n.normal_at for n in dse_nodes),
+      'bootstrap_done': max(n.done_at for n in nodes),
+      'barriers': dict((event.split(':', 1)[1], at)
+                       for event, at in sim.signalled.items()
+                       if event.startswith('barrier:')),
+  }
+
+
+def Simulate(properties, runs, seed, durations):
+  """Returns the p50/p95 of the time to ready over several simulated runs.
+
+  The time to ready is when the deployment finished and every node has
+  run its startup script.
+  """
+  resources = Generate(properties)
+  rng = random.Random(seed)
+  ready = []
+  for _ in range(runs):
+    timeline = SimulateOnce(resources, properties, rng, durations)
+    ready.append(max(timeline['deployment_done'], timeline['bootstrap_done']))
+  ready.sort()
+  return {
+      'p50': ready[(len(ready) - 1) // 2],
+      'p95': ready[min(len(ready) - 1, int(0.95 * len(ready)))],
+  }
+
+
+def Benchmark(sizes, runs, seed, durations, base):
+  """Returns {strategy: {size: stats}} over all STRATEGIES and sizes."""
+  results = collections.OrderedDict()
+  for strategy, overrides in STRATEGIES.items():
+    results[strategy] = collections.OrderedDict()
+    for size in sizes:
+      properties = dict(base, clusterSize=size, **overrides)
+      results[strategy][str(size)] = Simulate(properties, runs, seed,
+                                              durations)
+  return results
+
+
+def GenerationBenchmark(sizes, runs, base):
+  """Returns (size, seconds, manifest bytes, metadata bytes) per cluster size.
+
+  The manifest is the YAML GenerateConfig returns, the metadata the largest
+  metadata of an instance template, which GCE caps at 512 KB.
+  """
+  rows = []
+  for size in sizes:
+    properties = dict(base, clusterSize=size)
+    seconds = timeit.timeit(
+        lambda: regional_igm.GenerateConfig(FakeContext(properties)),
+        number=runs) / runs
+    manifest = regional_igm.GenerateConfig(FakeContext(properties))
+    metadata = max(
+        sum(len(item['value'])
+            for item in r['properties']['properties']['metadata']['items'])
+        for r in yaml.safe_load(manifest)['resources']
+        if r['type'] == 'compute.v1.instanceTemplate')
+    rows.append((size, seconds, len(manifest), metadata))
+  return rows
+
+
+def PrintBenchmark(results, baseline, tolerance):
+  """Prints the benchmark table and returns the regressed entries."""
+  regressions = []
+  sizes = list(next(iter(results.values())).keys())
+  print('%-20s' % 'p50/p95 (min)' +
+        ''.join('%14s' % ('size %s' % size) for size in sizes))
+  for strategy, by_size in results.items():
+    cells = []
+    for size, stats in by_size.items():
+      cell = '%.1f/%.1f' % (stats['p50'] / 60, stats['p95'] / 60)
+      old = baseline.get(strategy, {}).get(size)
+      if old and stats['p50'] > old['p50'] * (1 + tolerance):
+        regressions.append((strategy, size, old['p50'], stats['p50']))
+        cell += '!'
+      cells.append('%14s' % cell)
+    print('%-20s' % strategy + ''.join(cells))
+  for strategy, size, old, new in regressions:
+    print('regression: %s at size %s, p50 %.0fs -> %.0fs' %
+          (strategy, size, old, new))
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--size', type=int, default=5,
+                      help='clusterSize of a single simulation')
+  parser.add_argument('--set', action='append', default=[],
+                      metavar='PROPERTY=VALUE',
+                      help='Property over the example deployment')
+  parser.add_argument('--runs', type=int, default=20,
+                      help='Simulated deployments per configuration')
+  parser.add_argument('--seed', type=int, default=1,
+                      help='Random seed, fixed so runs are comparable')
+  parser.add_argument('--durations',
+                      help='JSON file overriding entries of the duration table')
+  parser.add_argument('--benchmark', action='store_true',
+                      help='Compare all strategies over --sizes')
+  parser.add_argument('--generation', action='store_true',
+                      help='Measure GenerateConfig over --sizes instead')
+  parser.add_argument('--sizes', default='3,6,12,25,50,100',
+                      help='Cluster sizes of the benchmark')
+  parser.add_argument('--json', help='Write the benchmark results here')
+  parser.add_argument('--baseline',
+                      help='Benchmark results to flag regressions against')
+  parser.add_argument('--tolerance', type=float, default=0.05,
+                      help='Relative p50 slowdown counted as a regression')
+  args = parser.parse_args()
+
+  durations = dict(DEFAULT_DURATIONS)
+  if args.durations:
+    with open(args.durations) as f:
+      durations.update((k, tuple(v)) for k, v in json.load(f).items())
+  base = ExampleProperties()
+  for assignment in args.set:
+    key, value = assignment.split('=', 1)
+    # Parsed as YAML, so numbers and lists work
+    base[key] = yaml.safe_load(value)
+
+  if args.generation:
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print('%6s %10s %12s %12s' % ('size', 'generate', 'manifest', 'metadata'))
+    for size, seconds, manifest, metadata in GenerationBenchmark(
+        sizes, args.runs, base):
+      print('%6d %8.1fms %9.1f KB %9.1f KB' % (size, seconds * 1000,
+                                               manifest / 1024.0,
+                                               metadata / 1024.0))
+    return
+
+  if not args.benchmark:
+    base['clusterSize'] = args.size
+    stats = Simulate(base, args.runs, args.seed, durations)
+    print('time to ready over %d runs: p50 %.0fs, p95 %.0fs' %
+          (args.runs, stats['p50'], stats['p95']))
+    return
+
+  sizes = [int(size) for size in args.sizes.split(',')]
+  results = Benchmark(sizes, args.runs, args.seed, durations, base)
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+  regressions = PrintBenchmark(results, baseline, args.tolerance)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2)
+  if regressions:
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,114 @@
+# Copyright 2019 DataStax, Inc. All rights reserved.
+
+"""Tests of the offline provisioning simulator."""
+
+import random
+import unittest
+
+import regional_igm
+import simulate
+
+SCRIPT = '''
+      phase_begin install_java
+      apt-get -y install openjdk-8-jdk
+      phase_end
+      if [ "$(cat ''' + regional_igm.PREBAKED_DIR + '''/release 2>/dev/null)" = "x" ]; then
+          phase_begin prebaked
+          cp -r /opt/ddac/ddac-gcp-install .
+          phase_end
+      else
+          phase_begin fetch_ddac
+          fetch_artifact ddac.tar.gz
+          phase_end
+      fi
+      phase_begin wait_seed_0
+      barrier_wait seed_0
+      phase_end
+      phase_begin join_slot
+      acquire_join_slot
+      phase_end
+      phase_begin deploy_dse
+      ./$ddac_repo/deploy-dse.sh $cluster_name $dc_name $seeds
+      phase_end
+      release_join_slot
+      barrier_signal seed_1
+'''
+
+# Durations without randomness: every phase takes 10s, streaming 100s and a
+# refused bootstrap 50s
+FIXED_DURATIONS = {
+    'phase': ('uniform', 10, 10),
+    'join_streaming': ('uniform', 100, 100),
+    'bootstrap_retry': ('uniform', 50, 50),
+}
+
+
+class ParseScriptTest(unittest.TestCase):
+
+  def testInstallBoot(self):
+    steps = simulate.ParseScript(SCRIPT, prebaked=False)
+    self.assertEqual([step[:2] for step in steps], [
+        ('phase', 'install_java'),
+        ('phase', 'fetch_ddac'),
+        ('phase', 'wait_seed_0'),
+        ('phase', 'join_slot'),
+        ('phase', 'deploy_dse'),
+        ('release', None),
+        ('signal', 'seed_1'),
+    ])
+    self.assertEqual(steps[2][2], ['barrier_wait seed_0'])
+
+  def testPrebakedBoot(self):
+    steps = simulate.ParseScript(SCRIPT, prebaked=True)
+    self.assertEqual([step[1] for step in steps[:3]],
+                     ['install_java', 'prebaked', 'wait_seed_0'])
+
+  def testGeneratedScriptsParse(self):
+    resources = simulate.ExampleResources()
+    for name, resource in resources.items():
+      if resource['type'] != 'compute.v1.instanceTemplate':
+        continue
+      steps = simulate.ParseScript(simulate.BootScript(resources, name),
+                                   False)
+      if name.endswith('-functions-it'):
+        self.assertEqual(steps, [])
+      else:
+        self.assertIn('install_java', [step[1] for step in steps])
+
+
+class JoinProcessTest(unittest.TestCase):
+
+  def NormalTimes(self, concurrent_bootstrap):
+    """Returns when three pool nodes started together become UN."""
+    sim = simulate.Simulation(random.Random(0), FIXED_DURATIONS, 1)
+    nodes = [simulate.Node('non-seed-%d' % i, 'non-seed', 'dc-1', [],
+                           concurrent_bootstrap) for i in range(3)]
+    for node in nodes:
+      sim.Start(simulate.JoinProcess(sim, node))
+    sim.Run()
+    return [node.normal_at for node in nodes]
+
+  def testConsistentRangeMovementSerializesBootstraps(self):
+    self.assertEqual(self.NormalTimes(False), [100, 250, 400])
+
+  def testConcurrentBootstrapsContend(self):
+    # Each node streams slower for every node already streaming
+    self.assertEqual(self.NormalTimes(True),
+                     [100 * (1 + simulate.JOIN_CONTENTION * i)
+                      for i in range(3)])
+
+  def testSerialPoolIsNotMuchFasterThanOneJoinSlot(self):
+    # Serial mode saves the join slot handoffs, but its pool still
+    # bootstraps one node at a time
+    base = simulate.ExampleProperties()
+    base['clusterSize'] = 12
+    serial = simulate.Simulate(dict(base, bootstrapMode='serial'), 3, 1,
+                               simulate.DEFAULT_DURATIONS)
+    parallel = simulate.Simulate(
+        dict(base, bootstrapMode='parallel', maxConcurrentJoins=1), 3, 1,
+        simulate.DEFAULT_DURATIONS)
+    self.assertGreater(serial['p50'], 0.5 * parallel['p50'])
+
+
+if __name__ == '__main__':
+  unittest.main()